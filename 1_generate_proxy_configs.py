@@ -1,13 +1,34 @@
 import os
 import secrets
 import string
-import json
 import argparse
 from datetime import datetime
 import re
 import subprocess # Добавляем импорт для выполнения внешних команд
 import sys # Добавляем импорт для sys
 import ipaddress # Добавляем импорт для работы с IP-адресами
+import shutil
+from itertools import chain, repeat
+from ipv6_allocator import BIND_PREFIXLEN, FIRST_PROXY_INCREMENT, get_increment_layout, iter_ipv6_addresses
+from range_allocator import RangeAllocator, ranges_from_values
+from listening_ports import find_3proxy_socket_owners, find_occupied_ports, read_listening_sockets
+from rtnetlink import RtnetlinkSocket
+from capacity_planner import (
+    DEFAULT_CONNECTIONS_PER_PROXY, check_unit_limits, detect_host_resources, format_memory_bytes, get_shard_cpus,
+    plan_capacity, plan_unit_limits, write_capacity_report,
+)
+from sysctl_profile import (
+    SYSCTL_PROFILE_FILENAME, build_sysctl_profile, check_sysctl_profile, format_port_list, read_sysctl_profile,
+    update_reserved_ports, warn_low_ephemeral_ports, write_sysctl_profile,
+)
+from ipv6_binding import NEW_ADDRESSES_FILENAME, read_anyip_subnet, run_bind_script, write_anyip_subnet, write_bind_file
+from state_store import (
+    STATE_FILENAME, find_primary_address_owners, migrate_legacy_state, release_project, state_transaction,
+)
+from proxy_output import (
+    CREDENTIALS_FILENAME, EXTRACTED_PROXY_FILENAME, FULL_CONFIG_FILENAME, config_has_monitor,
+    count_shard_configs, get_shard_config_path, write_proxy_outputs,
+)
 # Примеры использования:
 # python3 1_generate_proxy_configs.py 20 MyProject
 # (сгенерирует 20 прокси для проекта "MyProject")
@@ -17,13 +38,14 @@ import ipaddress # Добавляем импорт для работы с IP-а
 
 
 BASE_OUTPUT_DIR = "generated_proxy_configs"
-STATE_FILE = os.path.join(BASE_OUTPUT_DIR, "proxy_states.json")
+STATE_FILE = os.path.join(BASE_OUTPUT_DIR, STATE_FILENAME)
 
-# Общие настройки 3proxy
+# Общие настройки 3proxy (лимиты подбирает capacity_planner по ресурсам сервера)
 THREE_PROXY_HEADERS_TEMPLATE = """
-maxconn 10000
-nscache 65536
-timeouts 1 5 30 60 180 1800 15 60
+maxconn {maxconn}
+nscache {nscache}
+stacksize {stacksize}
+timeouts {timeouts}
 setgid 65535
 setuid 65535
 flush
@@ -38,25 +60,157 @@ allow {username}
 DEFAULT_START_PORT = 10000
 DEFAULT_END_PORT = 65000
 
+# Владелец портов, которые уже кто-то слушает: учитывается только при выделении
+# и в файл состояния не записывается
+OCCUPIED_PORTS_OWNER = "@listening"
+# Сколько диапазонов занятых портов показывается в предупреждении
+MAX_REPORTED_PORT_RANGES = 5
+
+# Drop-in файлы systemd с ядрами для каждого шарда (шаблон unit-файла у всех шардов общий)
+SHARD_DROPINS_DIRNAME = "unit_dropins"
+
 def generate_random_string(length=10):
     """Генерирует случайную строку заданной длины."""
     characters = string.ascii_letters + string.digits
     return ''.join(secrets.choice(characters) for i in range(length))
 
-def get_state():
-    """Загружает текущее состояние из файла JSON."""
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {} # Return empty if JSON is malformed
-    return {}
+def split_evenly(total, capacities):
+    """
+    Делит total между ключами capacities поровну, не превышая емкость каждого
+    (если у одного адреса мало свободных портов, остаток уходит остальным).
+    Возвращает словарь ключ -> доля.
+    """
+    shares = {key: 0 for key in capacities}
+    remaining = total
+    by_capacity = sorted(capacities, key=lambda key: capacities[key])
+    for index, key in enumerate(by_capacity):
+        share = min(capacities[key], remaining // (len(by_capacity) - index))
+        shares[key] = share
+        remaining -= share
+    return shares
+
+def interleave(iterables):
+    """Поочередно берет по одному элементу из каждого итератора, пока все не исчерпаны."""
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        active = []
+        for iterator in iterators:
+            for item in iterator:
+                yield item
+                active.append(iterator)
+                break
+        iterators = active
+
+def format_port_ranges(ports):
+    """Первые диапазоны портов для сообщений: "10000-10119, 22000, ..."."""
+    runs = ranges_from_values(ports)
+    shown = [str(start) if end - start == 1 else f"{start}-{end - 1}" for start, end in runs[:MAX_REPORTED_PORT_RANGES]]
+    if len(runs) > MAX_REPORTED_PORT_RANGES:
+        shown.append("...")
+    return ", ".join(shown)
+
+def warn_occupied_ports(listen_ipv4, skipped_ports):
+    """Предупреждение о свободных по состоянию портах, которые уже слушает другой процесс."""
+    by_owner = {}
+    for port, owner in skipped_ports.items():
+        by_owner.setdefault(owner, []).append(port)
+    print(f"Предупреждение: на {listen_ipv4} пропущено {len(skipped_ports)} портов, которые уже слушаются:")
+    for owner, ports in sorted(by_owner.items(), key=lambda item: (item[0] is None, item[0] or "")):
+        owner_label = f"3proxy проекта {owner}" if owner else "другие процессы"
+        print(f"  {owner_label}: {len(ports)} ({format_port_ranges(ports)})")
+    if any(owner for owner in by_owner):
+        print("  Порты запущенных 3proxy других проектов не закреплены за ними в состоянии: "
+              "остановите эти проекты или сгенерируйте их заново.")
+
+def allocate_project_ranges(state, project_name, external_ipv4s, ipv6_network, num_proxies, append=False, occupied_ports=None):
+    """
+    Выделяет проекту порты на каждом из external_ipv4s и инкременты IPv6 в подсети
+    ipv6_network, изменяя state. С append=True прежние диапазоны проекта сохраняются,
+    а возвращаются только новые. occupied_ports - словарь ipv4 -> {порт: проект
+    3proxy или None}, порты, которые уже слушаются: они пропускаются при выделении.
+    Возвращает (количество_прокси, [(ipv4, диапазоны_портов), ...], диапазоны_инкрементов).
+    """
+    subnet_str = str(ipv6_network)
+    _, suffix_capacity = get_increment_layout(ipv6_network.prefixlen)
+
+    # Инициализация состояния для каждого external_ipv4 и subnet_ipv6, если не существует
+    for listen_ipv4 in external_ipv4s:
+        ipv4_state = state.setdefault(listen_ipv4, {"ports": {}, "ipv6_subnets": {}})
+        ipv4_state["ipv6_subnets"].setdefault(subnet_str, {"suffixes": {}})
+
+    # Повторная генерация проекта перезаписывает его файлы, поэтому прежние диапазоны освобождаются
+    if not append:
+        released_ports, _ = release_project(state, project_name)
+        if released_ports:
+            print(f"Освобождено {released_ports} портов предыдущей генерации проекта {project_name}.")
+
+    # У каждого IPv4 свое пространство портов. Порты, которые уже кто-то слушает,
+    # но которые не закреплены ни за одним проектом, временно отдаются
+    # отдельному владельцу, поэтому распределитель их просто пропускает
+    port_allocators = {}
+    for listen_ipv4 in external_ipv4s:
+        port_owners = dict(state[listen_ipv4]["ports"])
+        busy_ports = (occupied_ports or {}).get(listen_ipv4)
+        if busy_ports:
+            owned_ports = set(chain.from_iterable(
+                range(start, end) for runs in port_owners.values() for start, end in runs
+            ))
+            skipped_ports = {port: owner for port, owner in busy_ports.items() if port not in owned_ports}
+            if skipped_ports:
+                warn_occupied_ports(listen_ipv4, skipped_ports)
+                port_owners[OCCUPIED_PORTS_OWNER] = ranges_from_values(skipped_ports)
+        port_allocators[listen_ipv4] = RangeAllocator(DEFAULT_START_PORT, DEFAULT_END_PORT + 1, port_owners)
+    # Адреса подсети не должны повторяться ни на одном IPv4, поэтому занятые
+    # инкременты собираются со всех IPv4, где используется эта подсеть
+    used_suffixes = {}
+    for ipv4_state in state.values():
+        subnet_suffixes = ipv4_state.get("ipv6_subnets", {}).get(subnet_str, {}).get("suffixes", {})
+        for owner, runs in subnet_suffixes.items():
+            used_suffixes.setdefault(owner, []).extend(runs)
+    suffix_allocator = RangeAllocator(FIRST_PROXY_INCREMENT, suffix_capacity, used_suffixes)
+
+    # Определяем, сколько прокси помещается в свободные порты и в подсеть
+    free_ports = sum(allocator.free_count for allocator in port_allocators.values())
+    proxies_to_generate = min(num_proxies, free_ports, suffix_allocator.free_count)
+    if proxies_to_generate < num_proxies:
+        if free_ports <= suffix_allocator.free_count:
+            print(f"Предупреждение: Нет свободных портов в диапазоне {DEFAULT_START_PORT}-{DEFAULT_END_PORT} на {', '.join(external_ipv4s)}. Сгенерировано {proxies_to_generate} прокси из {num_proxies}.")
+        else:
+            print(f"Предупреждение: Исчерпаны адреса подсети {subnet_str} ({suffix_capacity - FIRST_PROXY_INCREMENT}). Сгенерировано {proxies_to_generate} прокси из {num_proxies}.")
 
-def save_state(state):
-    """Сохраняет текущее состояние в файл JSON."""
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f, indent=4)
+    # Прокси делятся между IPv4 поровну, чтобы ни один адрес не держал все слушающие сокеты
+    ipv4_shares = split_evenly(
+        proxies_to_generate,
+        {listen_ipv4: allocator.free_count for listen_ipv4, allocator in port_allocators.items()}
+    )
+    port_runs_by_ipv4 = []
+    for listen_ipv4 in external_ipv4s:
+        port_runs = port_allocators[listen_ipv4].allocate(project_name, ipv4_shares[listen_ipv4])
+        state[listen_ipv4]["ports"] = {
+            owner: runs for owner, runs in port_allocators[listen_ipv4].owners.items() if owner != OCCUPIED_PORTS_OWNER
+        }
+        if port_runs:
+            print(f"IPv4 {listen_ipv4}: {ipv4_shares[listen_ipv4]} прокси.")
+        port_runs_by_ipv4.append((listen_ipv4, port_runs))
+    suffix_runs = suffix_allocator.allocate(project_name, proxies_to_generate)
+    # Все инкременты проекта в этой подсети записываются на первый IPv4
+    if suffix_runs:
+        for ipv4_state in state.values():
+            ipv4_state.get("ipv6_subnets", {}).get(subnet_str, {}).get("suffixes", {}).pop(project_name, None)
+        state[external_ipv4s[0]]["ipv6_subnets"][subnet_str]["suffixes"][project_name] = suffix_allocator.owned(project_name)
+
+    return proxies_to_generate, port_runs_by_ipv4, suffix_runs
+
+def format_headers(capacity_plan, username, password):
+    """Заголовки конфига 3proxy с лимитами из плана capacity_planner."""
+    return THREE_PROXY_HEADERS_TEMPLATE.format(
+        username=username,
+        password=password,
+        maxconn=capacity_plan["maxconn"],
+        nscache=capacity_plan["nscache"],
+        stacksize=capacity_plan["stacksize"],
+        timeouts=" ".join(map(str, capacity_plan["timeouts"])),
+    )
 
 def validate_ipv4(ipv4_address):
     """Проверяет, является ли строка корректным IPv4-адресом."""
@@ -75,30 +229,24 @@ def check_and_add_ipv6_default_route(ipv6_subnet, interface):
     """
     Проверяет существование IPv6 маршрута по умолчанию и добавляет его, если он отсутствует.
     Первым доступным IP в подсети считается шлюз.
+    Маршруты читаются и добавляются через netlink; без прав root маршрут
+    добавляется через sudo ip.
     """
     try:
-        # Проверяем, существует ли маршрут по умолчанию
-        result = subprocess.run(['ip', '-6', 'route', 'show', 'default'], capture_output=True, text=True, check=False)
-        if "default via" in result.stdout:
-            print("IPv6 маршрут по умолчанию уже существует. Пропускаем добавление.")
-            return
-
-        # Если маршрут не существует, определяем шлюз как первый IP в подсети
-        # Создаем объект IPv6Network
         ipv6_network = ipaddress.IPv6Network(ipv6_subnet, strict=True)
-        # Получаем первый доступный IP-адрес в подсети для использования в качестве шлюза
-        # Для /64 подсети, первый доступный адрес будет network_address + 1
-        # Для других префиксов, просто используем network_address + 1, если это не будет адресом сети
-        if ipv6_network.prefixlen <= 127: # убедимся, что это не /128
-            gateway_ip_int = int(ipv6_network.network_address) + 1
-            gateway_ip = str(ipaddress.IPv6Address(gateway_ip_int))
-        else:
-            print(f"Предупреждение: Подсеть {ipv6_subnet} слишком мала для определения шлюза (+1). Используем адрес сети как шлюз.", file=sys.stderr)
-            gateway_ip = str(ipv6_network.network_address)
-
-        print(f"Добавляем IPv6 маршрут по умолчанию через {gateway_ip} на интерфейс {interface}...")
-        add_route_command = ['sudo', 'ip', '-6', 'route', 'add', 'default', 'via', gateway_ip, 'dev', interface]
-        subprocess.run(add_route_command, check=True)
+        with RtnetlinkSocket() as rtnl:
+            # Проверяем, существует ли маршрут по умолчанию
+            if any(rtnl.get_ipv6_default_gateways()):
+                print("IPv6 маршрут по умолчанию уже существует. Пропускаем добавление.")
+                return
+
+            # Если маршрут не существует, шлюзом считается первый адрес подсети (network_address + 1)
+            gateway_ip = str(ipv6_network.network_address + 1)
+            print(f"Добавляем IPv6 маршрут по умолчанию через {gateway_ip} на интерфейс {interface}...")
+            try:
+                rtnl.add_ipv6_default_route(gateway_ip, interface)
+            except PermissionError:
+                subprocess.run(['sudo', 'ip', '-6', 'route', 'add', 'default', 'via', gateway_ip, 'dev', interface, 'onlink'], check=True)
         print("IPv6 маршрут по умолчанию успешно добавлен.")
 
     except subprocess.CalledProcessError as e:
@@ -106,74 +254,90 @@ def check_and_add_ipv6_default_route(ipv6_subnet, interface):
         print(f"Команда: {' '.join(e.cmd)}", file=sys.stderr)
     except ipaddress.AddressValueError as e:
         print(f"Ошибка: Некорректный формат IPv6 подсети '{ipv6_subnet}': {e}", file=sys.stderr)
+    except OSError as e:
+        print(f"Ошибка при добавлении IPv6 маршрута по умолчанию через {interface}: {e}", file=sys.stderr)
     except Exception as e:
         print(f"Неожиданная ошибка при работе с IPv6 маршрутом: {e}", file=sys.stderr)
 
 def bind_ipv6_address(ipv6_subnet, interface):
     """
-    Привязывает первый доступный IPv6-адрес из подсети к указанному интерфейсу.
+    Привязывает первый доступный IPv6-адрес из подсети к указанному интерфейсу
+    (через netlink, без ожидания DAD; без прав root - через sudo ip).
     """
     try:
         ipv6_network = ipaddress.IPv6Network(ipv6_subnet, strict=True)
         # Первый доступный IP-адрес для привязки
-        address_to_bind = str(ipv6_network.network_address + 2)
-        
-        # Проверяем, привязан ли уже этот адрес к интерфейсу
-        check_command = ['ip', '-6', 'addr', 'show', 'dev', interface]
-        result = subprocess.run(check_command, capture_output=True, text=True, check=True)
-        if address_to_bind in result.stdout:
-            print(f"IPv6 адрес {address_to_bind} уже привязан к {interface}. Пропускаем привязку.")
-            return
-
-        print(f"Привязка IPv6-адреса {address_to_bind} к интерфейсу {interface}...")
-        command = ['sudo', 'ip', '-6', 'addr', 'add', f"{address_to_bind}/{ipv6_network.prefixlen}", 'dev', interface]
-        subprocess.run(command, check=True)
+        address_to_bind = ipv6_network.network_address + 2
+
+        with RtnetlinkSocket() as rtnl:
+            # Проверяем, привязан ли уже этот адрес к интерфейсу
+            if int(address_to_bind) in rtnl.get_ipv6_addresses(interface):
+                print(f"IPv6 адрес {address_to_bind} уже привязан к {interface}. Пропускаем привязку.")
+                return
+
+            print(f"Привязка IPv6-адреса {address_to_bind} к интерфейсу {interface}...")
+            try:
+                error_code = rtnl.add_addresses(interface, [(str(address_to_bind), ipv6_network.prefixlen)]).get(0)
+                if error_code:
+                    raise OSError(error_code, os.strerror(error_code))
+            except PermissionError:
+                command = ['sudo', 'ip', '-6', 'addr', 'add', f"{address_to_bind}/{ipv6_network.prefixlen}", 'dev', interface]
+                subprocess.run(command, check=True)
         print(f"IPv6-адрес {address_to_bind} успешно привязан к {interface}.")
     except subprocess.CalledProcessError as e:
         print(f"Ошибка при привязке IPv6-адреса: {e}", file=sys.stderr)
         print(f"Команда: {' '.join(e.cmd)}", file=sys.stderr)
     except ipaddress.AddressValueError as e:
         print(f"Ошибка: Некорректный формат IPv6 подсети '{ipv6_subnet}': {e}", file=sys.stderr)
+    except OSError as e:
+        print(f"Ошибка при привязке IPv6-адреса к {interface}: {e}", file=sys.stderr)
     except Exception as e:
         print(f"Неожиданная ошибка при привязке IPv6-адреса: {e}", file=sys.stderr)
 
-def extract_proxies_from_content(file_content, output_file_path, username, password):
+def bind_new_ipv6_addresses(project_output_dir, project_name, interface, ipv6_network, suffix_runs):
     """
-    Извлекает прокси-серверы из содержимого конфигурации 3proxy, форматирует их
-    и сохраняет в новый файл. Это интегрированная версия extract_proxies.
+    Привязывает к интерфейсу только адреса, выделенные при дозаписи: они
+    сохраняются в proxy_configs.new и передаются 2_bind_ipv6_addresses.py.
     """
-    extracted_count = 0
-    proxies_list = []
-
-    for line in file_content.splitlines():
-        if line.strip().startswith("proxy"):
-            ipv4_match = re.search(r'-i(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})', line)
-            port_match = re.search(r'-p(\d+)', line)
-
-            if ipv4_match and port_match:
-                ipv4_address = ipv4_match.group(1)
-                port = port_match.group(1)
-                proxy_string = f"{ipv4_address}:{port}@{username}:{password}"
-                proxies_list.append(proxy_string)
-                extracted_count += 1
-    
-    with open(output_file_path, 'w') as f:
-        for proxy in proxies_list:
-            f.write(proxy + '\n')
+    write_bind_file(
+        os.path.join(project_output_dir, NEW_ADDRESSES_FILENAME),
+        chain.from_iterable(iter_ipv6_addresses(ipv6_network, start, end - start) for start, end in suffix_runs)
+    )
+    run_bind_script(project_output_dir, project_name, interface, "add", NEW_ADDRESSES_FILENAME)
 
-    print(f"Извлечено и сохранено {extracted_count} прокси в файл '{output_file_path}'.")
+def warn_unit_limits(project_output_dir, unit_filename):
+    """Предупреждает, если лимиты unit-файла не соответствуют maxconn и портам шардов."""
+    for warning in check_unit_limits(project_output_dir, unit_filename):
+        print(f"Предупреждение: {warning}", file=sys.stderr)
 
 def generate_proxy_configs(
     num_proxies,
     project_name,
     ipv6_subnet,
     interface,
-    external_ipv4, # Добавляем внешний IPv4 как аргумент
+    external_ipv4, # Внешний IPv4 или список IPv4, между которыми распределяются прокси
+    shard_count=None,
+    append=False,
+    connections_per_proxy=DEFAULT_CONNECTIONS_PER_PROXY,
+    anyip=False,
 ):
     """
     Генерирует конфигурации прокси для указанного проекта.
     Использует внутренние параметры для портов и IPv6.
+    Если передано несколько внешних IPv4, прокси распределяются между ними поровну,
+    у каждого адреса свой диапазон портов.
+    Прокси делятся на shard_count процессов 3proxy (по умолчанию - по числу ядер).
+    maxconn, nscache, stacksize и timeouts подбираются по ядрам, памяти и пределу
+    дескрипторов сервера из расчета connections_per_proxy соединений на прокси.
+    С append=True к существующему проекту добавляются num_proxies новых прокси:
+    выделяются и привязываются только новые порты и адреса, а запущенный 3proxy
+    подхватывает их по директиве monitor без перезапуска.
+    С anyip=True адреса прокси не привязываются к интерфейсу: вся подсеть
+    маршрутизируется локально (local <подсеть> dev lo) и включается
+    net.ipv6.ip_nonlocal_bind. Подсеть должна быть маршрутизирована на сервер
+    провайдером (не on-link), иначе на запросы NDP к адресам прокси никто не ответит.
     """
+    external_ipv4s = [external_ipv4] if isinstance(external_ipv4, str) else list(dict.fromkeys(external_ipv4))
     # Перед проверкой и добавлением маршрута, убедимся, что к интерфейсу привязан хотя бы один IPv6 адрес
     bind_ipv6_address(ipv6_subnet, interface)
     # Проверяем и добавляем IPv6 маршрут по умолчанию, если необходимо
@@ -185,20 +349,44 @@ def generate_proxy_configs(
     session_output_dir = project_output_dir
     os.makedirs(session_output_dir, exist_ok=True) # This still needs to ensure the base project directory exists
 
-    state = get_state()
+    if append and not os.path.exists(os.path.join(session_output_dir, FULL_CONFIG_FILENAME)):
+        print(f"Ошибка: Проект {project_name} еще не сгенерирован, дописывать некуда.", file=sys.stderr)
+        sys.exit(1)
+    if append:
+        # Режим привязки задается при генерации проекта, дозапись его наследует
+        anyip = read_anyip_subnet(session_output_dir) is not None
+
     # external_ipv4 теперь передается как аргумент, автоматическое определение удалено
     try:
         ipv6_network = ipaddress.IPv6Network(ipv6_subnet, strict=True)
     except ipaddress.AddressValueError as e:
         print(f"Ошибка: Некорректный формат IPv6 подсети '{ipv6_subnet}': {e}", file=sys.stderr)
         sys.exit(1)
-    
-    current_ipv6_base_network_str = str(ipv6_network) # Для сохранения в состоянии
 
     # ******************* Создание setup_network_ipv6.sh *******************
     primary_ipv6_address = str(ipv6_network.network_address + 2) # Основной IP
     gateway_ipv6_address = str(ipv6_network.network_address + 1) # Шлюз
 
+    if anyip:
+        # Вся подсеть - локальный маршрут на lo, 3proxy может использовать любой ее адрес
+        # как -e без привязки; шлюз из той же подсети исключается более точным маршрутом
+        proxy_addresses_setup = f"""echo "AnyIP: подсеть {ipv6_network} маршрутизируется локально, адреса прокси не привязываются по одному..."
+sudo ip -6 route replace {gateway_ipv6_address}/128 dev {interface} table local
+sudo ip -6 route replace local {ipv6_network} dev lo
+"""
+    else:
+        # ensure: при совпавшем отпечатке проверяет только выборку адресов, иначе
+        # сверяет одним снимком интерфейса и привязывает только недостающие (лишние
+        # не удаляет), поэтому повторный старт сервиса не привязывает заново все
+        # адреса и не трогает чужие адреса интерфейса
+        proxy_addresses_setup = f"""echo "Проверка и привязка прокси IPv6-адресов для проекта {project_name}..."
+# Активируем виртуальное окружение, если оно существует
+if [ -f "$BASE_DIR/venv/bin/activate" ]; then
+    source "$BASE_DIR/venv/bin/activate"
+fi
+sudo "$BASE_DIR/venv/bin/python" ${{PYTHON_SCRIPT}} ${{PROJECT_NAME}} --action ensure --interface {interface}
+"""
+
     setup_network_script_content = f"""#!/bin/bash
 echo "Настройка основного IPv6-адреса и маршрута по умолчанию..."
 
@@ -220,134 +408,148 @@ BASE_DIR=$(cd $(dirname "${{BASH_SOURCE[0]}}")/../.. && pwd)
 PYTHON_SCRIPT="$BASE_DIR/2_bind_ipv6_addresses.py"
 PROJECT_NAME="{project_name}"
 
-echo "Запуск привязки всех прокси IPv6-адресов для проекта {project_name}..."
-# Активируем виртуальное окружение, если оно существует
-if [ -f "$BASE_DIR/venv/bin/activate" ]; then
-    source "$BASE_DIR/venv/bin/activate"
-fi
-sudo "$BASE_DIR/venv/bin/python" ${{PYTHON_SCRIPT}} ${{PROJECT_NAME}} --action add_all --interface {interface}
+# Лимиты ядра (таблица соседей, маршруты, порты, очереди) - до привязки адресов.
+# Повторное применение ничего не меняет, значения выше рекомендованных не уменьшаются
+echo "Применение sysctl-профиля проекта {project_name}..."
+sudo "$BASE_DIR/venv/bin/python" "$BASE_DIR/sysctl_profile.py" "$(dirname "${{BASH_SOURCE[0]}}")/{SYSCTL_PROFILE_FILENAME}" --apply
 
+{proxy_addresses_setup}
 echo "Настройка сети IPv6 завершена."
 """
     setup_network_script_filename = os.path.join(session_output_dir, "setup_network_ipv6.sh")
-    with open(setup_network_script_filename, "w") as f:
-        f.write(setup_network_script_content)
-    os.chmod(setup_network_script_filename, 0o755)
-    print(f"Скрипт настройки сети IPv6: {setup_network_script_filename}")
+    if not append:
+        write_anyip_subnet(session_output_dir, str(ipv6_network) if anyip else None)
+        with open(setup_network_script_filename, "w") as f:
+            f.write(setup_network_script_content)
+        os.chmod(setup_network_script_filename, 0o755)
+        print(f"Скрипт настройки сети IPv6: {setup_network_script_filename}")
     # *****************************************************************
 
-    # Инициализация состояния для external_ipv4, если не существует
-    if external_ipv4 not in state:
-        state[external_ipv4] = {
-            "latest_port": DEFAULT_START_PORT - 1,
-            "ipv6_subnets": {}
-        }
-
-    # Инициализация состояния для subnet_ipv6, если не существует для текущего external_ipv4
-    if current_ipv6_base_network_str not in state[external_ipv4]["ipv6_subnets"]:
-        state[external_ipv4]["ipv6_subnets"][current_ipv6_base_network_str] = {
-            "latest_suffix_increment": 0x0000 # Инкремент для последних 64 бит
-        }
-
-    current_port = state[external_ipv4]["latest_port"] + 1
-    current_ipv6_suffix_increment = state[external_ipv4]["ipv6_subnets"][current_ipv6_base_network_str]["latest_suffix_increment"]
-
-    if current_port < DEFAULT_START_PORT:
-        current_port = DEFAULT_START_PORT
-
-    generated_count = 0
-    proxy_lines = []
-    credentials_list = []
-
     # Use project name as both username and password
     proxy_username = project_name
     proxy_password = project_name
 
-    for i in range(num_proxies):
-        if current_port > DEFAULT_END_PORT:
-            print(f"Предупреждение: Достигнут конец диапазона портов ({DEFAULT_START_PORT}-{DEFAULT_END_PORT}). Сгенерировано {generated_count} прокси из {num_proxies}.")
-            break
-
-        # Определяем IPv6-адрес в зависимости от prefixlen
-        bind_ipv6_prefixlen = 64 # Для привязки всегда используем /64
-        if ipv6_network.prefixlen == 48:
-            # Для /48 подсети, инкрементируем префикс /64.
-            # current_ipv6_suffix_increment будет определять четвертый хекстет.
-            # Например, если network_address = 2a12:5940:dfaa::/48
-            # и current_ipv6_suffix_increment = 0x0001,
-            # мы хотим получить 2a12:5940:dfaa:0001::, а затем добавить ::2
-            
-            # Получаем первые 48 бит (3 хекстета)
-            base_address_parts = ipv6_network.exploded.split(':')[:3]
-            
-            # Формируем новую /64 подсеть
-            # Избегаем создания прямой строки адреса для network_address_with_new_hextet,
-            # вместо этого работаем с целыми числами для корректных вычислений.
-            
-            # Преобразуем первые 48 бит в целое число, сдвигаем на 16 бит влево (чтобы освободить место для 4-го хекстета)
-            # Затем добавляем инкремент и сдвигаем на 64 бита влево (чтобы сформировать префикс /64)
-            # После этого добавляем 2 для final_address_int в конце
-            
-            # network_address_int = int(ipaddress.IPv6Address(':'.join(base_address_parts) + '::'))
-            # new_64_bit_prefix_int = network_address_int | (current_ipv6_suffix_increment << (128 - 64))
-            
-            # Более простой и правильный способ - формируем подсеть /64 и берем из неё адрес
-            # Используем ipaddress.IPv6Network для правильного формирования /64 из /48
-            new_subnet_str = f"{':'.join(base_address_parts)}:{format(current_ipv6_suffix_increment, 'x')}::{bind_ipv6_prefixlen}"
-            try:
-                new_64_subnet = ipaddress.IPv6Network(new_subnet_str, strict=False)
-                # Берем, например, 2-й адрес в этой /64 подсети (::2) для прокси
-                final_address_int = int(new_64_subnet.network_address) + 2
-                ipv6_address = str(ipaddress.IPv6Address(final_address_int))
-            except ipaddress.AddressValueError as e:
-                print(f"Ошибка при формировании /64 подсети из /48 '{new_subnet_str}': {e}", file=sys.stderr)
-                sys.exit(1)
-
-        elif ipv6_network.prefixlen == 64:
-            # Для /64 подсети, инкрементируем последние 64 бита (последний суффикс)
-            # Прибавляем current_ipv6_suffix_increment к числовому представлению адреса сети
-            # и получаем новый адрес.
-            # Например, для 2a03:a03:c4:d::/64 и increment=1, хотим 2a03:a03:c4:d::1
-            new_address_int = int(ipv6_network.network_address) + (current_ipv6_suffix_increment << 48) + 2 # Тут было +2, оставил как было
-            ipv6_address = str(ipaddress.IPv6Address(new_address_int))
-        else:
-            print(f"Ошибка: Неподдерживаемая длина префикса IPv6: {ipv6_network.prefixlen}. Поддерживаются только /48 и /64.", file=sys.stderr)
-            sys.exit(1)
-            
-        # Только строка прокси для основного файла конфига
-        proxy_line = (
-            f"proxy -64 -n -a -p{current_port} "
-            f"-i{external_ipv4} -e{ipv6_address}"
-        )
-        proxy_lines.append(proxy_line)
+    bind_ipv6_prefixlen = BIND_PREFIXLEN # Для привязки всегда используем /64
+
+    # Один проход по /proc/net/tcp{,6} до захвата блокировки: порты, которые уже
+    # кто-то слушает, пропускаются при выделении (3proxy самого проекта - нет)
+    listeners = read_listening_sockets()
+    socket_owners, unreadable_count = find_3proxy_socket_owners() if listeners else ({}, 0)
+    occupied_ports = {
+        listen_ipv4: find_occupied_ports(listeners, listen_ipv4, DEFAULT_START_PORT, DEFAULT_END_PORT,
+                                         socket_owners, project_name)
+        for listen_ipv4 in external_ipv4s
+    }
+    if unreadable_count and any(owner is None for ports in occupied_ports.values() for owner in ports.values()):
+        print(f"Предупреждение: без прав root дескрипторы {unreadable_count} процессов 3proxy прочитать нельзя: "
+              f"владелец их портов неизвестен, и порты запущенного 3proxy этого же проекта тоже будут пропущены "
+              f"(запустите генератор через sudo).")
+
+    # Выделение диапазонов и запись состояния - одна транзакция под блокировкой,
+    # поэтому параллельные запуски генератора не выдадут одни и те же порты и адреса
+    try:
+        with state_transaction(STATE_FILE) as state:
+            migrate_legacy_state(state, BASE_OUTPUT_DIR)
+            proxies_to_generate, port_runs_by_ipv4, suffix_runs = allocate_project_ranges(
+                state, project_name, external_ipv4s, ipv6_network, num_proxies, append, occupied_ports
+            )
+            # Все порты проекта (при дозаписи - вместе с прежними) для ip_local_reserved_ports
+            reserved_ports = format_port_list([
+                run for ipv4_state in state.values() for run in ipv4_state.get("ports", {}).get(project_name, [])
+            ])
+            primary_address_owners = find_primary_address_owners(state)
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
+    for subnet_str, owner in primary_address_owners:
+        print(f"Предупреждение: прокси проекта {owner} используют основной адрес сервера в подсети {subnet_str} "
+              f"(инкремент 0). Выполните 5_rotate_ipv6_egress.py {owner} или сгенерируйте проект заново.")
+
+    listen_ports = [
+        zip(repeat(listen_ipv4), chain.from_iterable(range(start, end) for start, end in port_runs))
+        for listen_ipv4, port_runs in port_runs_by_ipv4
+    ]
+
+    # Адреса считаются целыми числами и форматируются по мере записи;
+    # IPv4 чередуются, чтобы в каждом шарде были порты всех адресов
+    ipv6_addresses = chain.from_iterable(
+        iter_ipv6_addresses(ipv6_network, start, end - start) for start, end in suffix_runs
+    )
+    proxy_records = (
+        (port, listen_ipv4, ipv6_address)
+        for (listen_ipv4, port), ipv6_address in zip(interleave(listen_ports), ipv6_addresses)
+    )
 
-        # Данные для файла с учетными данными
-        # Сохраняем полный адрес с длиной префикса для корректной привязки
-        credentials_list.append(
-            f"user:{proxy_username} pass:{proxy_password} proxy_ip:{external_ipv4} proxy_port:{current_port} ipv6:{ipv6_address}/{bind_ipv6_prefixlen}"
+    full_config_filename = os.path.join(session_output_dir, FULL_CONFIG_FILENAME)
+    credentials_output_filename = os.path.join(session_output_dir, CREDENTIALS_FILENAME)
+    extracted_proxy_filename = os.path.join(session_output_dir, EXTRACTED_PROXY_FILENAME)
+
+    # Один процесс 3proxy на шард: соединения и потоки распределяются по ядрам,
+    # а перезапуск одного шарда не затрагивает порты остальных.
+    # При дозаписи новые прокси распределяются по уже существующим шардам.
+    if append:
+        shard_count = count_shard_configs(session_output_dir)
+        if not config_has_monitor(full_config_filename):
+            print("Предупреждение: в конфигах проекта нет директивы monitor. Она будет добавлена, "
+                  "но запущенный 3proxy подхватит изменения только после одного перезапуска сервиса.")
+    else:
+        if shard_count is None:
+            shard_count = os.cpu_count() or 1
+        shard_count = max(1, min(shard_count, proxies_to_generate))
+
+    # При дозаписи заголовки не меняются: существующие конфиги копируются как есть,
+    # в sysctl-профиле обновляются только зарезервированные порты
+    formatted_headers = ""
+    full_config_headers = None
+    sysctl_profile_path = os.path.join(session_output_dir, SYSCTL_PROFILE_FILENAME)
+    if append and os.path.exists(sysctl_profile_path):
+        update_reserved_ports(sysctl_profile_path, reserved_ports)
+        print(f"sysctl-профиль: порты проекта обновлены в {sysctl_profile_path} "
+              f"(применить без перезапуска: sudo python3 sysctl_profile.py {sysctl_profile_path} --apply)")
+    if not append:
+        host_resources = detect_host_resources()
+        capacity_plan = plan_capacity(proxies_to_generate, shard_count, host_resources, connections_per_proxy)
+        formatted_headers = format_headers(capacity_plan, proxy_username, proxy_password)
+        # full_proxy_config запускается через PM2 одним процессом на все прокси:
+        # его maxconn - нагрузка всех шардов, ограниченная дескрипторами и памятью одного процесса
+        full_config_plan = plan_capacity(proxies_to_generate, 1, host_resources, connections_per_proxy)
+        full_config_headers = format_headers(full_config_plan, proxy_username, proxy_password)
+        capacity_report_filename = write_capacity_report(session_output_dir, capacity_plan)
+        sysctl_profile_filename = write_sysctl_profile(
+            session_output_dir,
+            build_sysctl_profile(
+                proxies_to_generate, shard_count, capacity_plan["maxconn"],
+                plan_unit_limits(capacity_plan)["LimitNOFILE"], reserved_ports,
+                anyip
+            ),
+            project_name
         )
+        print(f"sysctl-профиль: {sysctl_profile_filename}")
+        print(f"maxconn {capacity_plan['maxconn']} на шард (всего до {capacity_plan['maxconn'] * shard_count} соединений), "
+              f"{full_config_plan['maxconn']} в {FULL_CONFIG_FILENAME} для PM2, отчет о ресурсах: {capacity_report_filename}")
+    # Порты проекта резервируются на весь сервер: хватит ли исходящих портов после этого
+    if os.path.exists(sysctl_profile_path):
+        warn_low_ephemeral_ports(check_sysctl_profile(read_sysctl_profile(sysctl_profile_path)))
+
+    # Каждая запись за один проход попадает в full_proxy_config, proxy_configs, extracted_proxy и конфиг своего шарда
+    generated_count = write_proxy_outputs(
+        session_output_dir, formatted_headers, proxy_records, proxy_username, proxy_password, bind_ipv6_prefixlen,
+        total_count=proxies_to_generate, shard_count=shard_count, append=append,
+        full_config_headers=full_config_headers
+    )
+    print(f"Сохранено {generated_count} прокси в файл '{extracted_proxy_filename}'.")
 
-        current_port += 1
-        current_ipv6_suffix_increment += 1
-        generated_count += 1
-
-    formatted_headers = THREE_PROXY_HEADERS_TEMPLATE.format(username=proxy_username, password=proxy_password)
-
-    full_config_filename = os.path.join(session_output_dir, "full_proxy_config")
-    with open(full_config_filename, "w") as f:
-        f.write(formatted_headers) # Добавляем заголовки
-        f.write("\n".join(proxy_lines) + "\n") # Добавляем пустую строку в конце для чистоты
-
-    credentials_output_filename = os.path.join(session_output_dir, "proxy_configs")
-    with open(credentials_output_filename, "w") as f:
-        f.write("\n".join(credentials_list) + "\n")
-
-    # Получаем содержимое full_proxy_config для извлечения прокси
-    with open(full_config_filename, "r") as f:
-        full_proxy_content = f.read()
+    if append:
+        # Скрипты и unit-файлы проекта не меняются, привязываются только новые адреса
+        bind_new_ipv6_addresses(session_output_dir, project_name, interface, ipv6_network, suffix_runs)
+        warn_unit_limits(session_output_dir, f"3proxy-{project_name}@.service")
+        print(f"Добавлено {generated_count} прокси в проект {project_name}. 3proxy перечитает конфиги по директиве monitor.")
+        return
 
     # ******************* Создание start.sh для PM2 *******************
     start_script_content = f"""#!/bin/bash
+# Лимит дескрипторов для maxconn из {os.path.basename(full_config_filename)} (действует, если демон PM2 запускается этим скриптом)
+ulimit -n {plan_unit_limits(full_config_plan)["LimitNOFILE"]} 2>/dev/null
 pm2 start {os.path.join("..", "..", "3proxy_binaries", "3proxy")} --name {project_name} -- {os.path.basename(full_config_filename)}
 """
     start_script_filename = os.path.join(session_output_dir, "start.sh")
@@ -357,22 +559,48 @@ pm2 start {os.path.join("..", "..", "3proxy_binaries", "3proxy")} --name {projec
     print(f"Скрипт запуска PM2: {start_script_filename}")
     # *****************************************************************
 
-    # ******************* Создание start_systemctl.sh *******************
+    # ******************* Создание unit-файлов systemd *******************
     # Абсолютные пути для systemctl сервиса
     three_proxy_binary_abs_path = os.path.abspath(os.path.join(BASE_OUTPUT_DIR, os.pardir, "3proxy_binaries", "3proxy"))
-    full_config_abs_path = os.path.abspath(full_config_filename)
+    project_output_abs_dir = os.path.abspath(session_output_dir)
+    network_service_name = f"3proxy-{project_name}-network.service"
+    shard_template_service_name = f"3proxy-{project_name}@.service"
+
+    unit_limits = plan_unit_limits(capacity_plan)
+
+    # Настройка сети выполняется один раз для всех шардов, а не в ExecStartPre каждого
+    network_service_content = f"""[Unit]
+Description=IPv6 network setup for 3proxy {project_name}
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+WorkingDirectory={project_output_abs_dir}
+ExecStart=/bin/bash {os.path.abspath(setup_network_script_filename)}
+
+[Install]
+WantedBy=multi-user.target
+"""
 
-    systemctl_service_content = f"""[Unit]
-Description=3proxy Service for {project_name}
-After=network.target
+    # Шаблон: 3proxy-<project>@<N>.service запускает 3proxy с конфигом шарда N
+    shard_service_content = f"""[Unit]
+Description=3proxy Service for {project_name} (shard %i)
+After=network.target {network_service_name}
+Requires={network_service_name}
 
 [Service]
 Type=simple
 User=root
-WorkingDirectory={os.path.dirname(full_config_abs_path)}
-ExecStartPre=/bin/bash {os.path.abspath(setup_network_script_filename)}
-ExecStart={three_proxy_binary_abs_path} {os.path.basename(full_config_abs_path)}
-LimitNOFILE=65535
+WorkingDirectory={project_output_abs_dir}
+ExecStart={three_proxy_binary_abs_path} {get_shard_config_path("%i")}
+# Лимиты рассчитаны из maxconn {capacity_plan["maxconn"]} и {capacity_plan["ports_per_shard"]} портов на шард
+LimitNOFILE={unit_limits["LimitNOFILE"]}
+TasksMax={unit_limits["TasksMax"]}
+MemoryMax={format_memory_bytes(unit_limits["MemoryMax"])}
+Nice={unit_limits["Nice"]}
+IOSchedulingClass={unit_limits["IOSchedulingClass"]}
 Restart=always
 RestartSec=3
 
@@ -380,23 +608,63 @@ RestartSec=3
 WantedBy=multi-user.target
 """
 
+    for service_name, service_content in (
+        (network_service_name, network_service_content),
+        (shard_template_service_name, shard_service_content),
+    ):
+        with open(os.path.join(session_output_dir, service_name), "w") as f:
+            f.write(service_content)
+    # Каждому шарду - свои ядра: drop-in 3proxy-<project>@<N>.service.d/cpus.conf
+    dropins_dir = os.path.join(session_output_dir, SHARD_DROPINS_DIRNAME)
+    shutil.rmtree(dropins_dir, ignore_errors=True)
+    cores = capacity_plan["resources"]["cores"]
+    for shard_index in range(shard_count):
+        shard_dropin_dir = os.path.join(dropins_dir, f"3proxy-{project_name}@{shard_index}.service.d")
+        os.makedirs(shard_dropin_dir)
+        shard_cpus = get_shard_cpus(shard_index, shard_count, cores)
+        with open(os.path.join(shard_dropin_dir, "cpus.conf"), "w") as f:
+            f.write(f"[Service]\nCPUAffinity={shard_cpus}\nAllowedCPUs={shard_cpus}\n")
+    print(f"Unit-файлы systemd: {network_service_name}, {shard_template_service_name} ({shard_count} шардов), "
+          f"LimitNOFILE={unit_limits['LimitNOFILE']}, TasksMax={unit_limits['TasksMax']}, "
+          f"MemoryMax={format_memory_bytes(unit_limits['MemoryMax'])} на шард")
+    warn_unit_limits(session_output_dir, shard_template_service_name)
+    # *****************************************************************
+
+    shard_units = " ".join(f"3proxy-{project_name}@{shard_index}.service" for shard_index in range(shard_count))
+
+    # ******************* Создание start_systemctl.sh *******************
     start_systemctl_script_content = f"""#!/bin/bash
 
-SERVICE_FILE_PATH="/etc/systemd/system/3proxy-{project_name}.service"
+PROJECT_DIR=$(cd $(dirname "${{BASH_SOURCE[0]}}") && pwd)
+SHARD_UNITS="{shard_units}"
+
+# Сервис без шардов от предыдущих версий генератора занимает те же порты
+if systemctl is-active --quiet 3proxy-{project_name}.service || systemctl is-enabled --quiet 3proxy-{project_name}.service; then
+    echo "Остановка старого сервиса 3proxy-{project_name}.service..."
+    sudo systemctl disable --now 3proxy-{project_name}.service
+    sudo rm -f /etc/systemd/system/3proxy-{project_name}.service
+fi
 
-echo "Creating systemd service file: ${{SERVICE_FILE_PATH}}"
-echo "{systemctl_service_content}" | sudo tee ${{SERVICE_FILE_PATH}} > /dev/null
+echo "Копирование unit-файлов в /etc/systemd/system..."
+sudo cp "$PROJECT_DIR/{network_service_name}" "$PROJECT_DIR/{shard_template_service_name}" /etc/systemd/system/
+# Drop-in файлы с ядрами шардов; оставшиеся от прошлой генерации удаляются
+sudo rm -rf /etc/systemd/system/3proxy-{project_name}@*.service.d
+sudo cp -r "$PROJECT_DIR/{SHARD_DROPINS_DIRNAME}/." /etc/systemd/system/
 
 echo "Reloading systemd daemon..."
 sudo systemctl daemon-reload
 
-echo "Enabling and starting service 3proxy-{project_name}..."
-sudo systemctl enable --now 3proxy-{project_name}.service
+echo "Enabling and starting service {network_service_name}..."
+sudo systemctl enable --now {network_service_name}
+
+echo "Enabling and starting {shard_count} shards of 3proxy-{project_name}..."
+sudo systemctl enable --now ${{SHARD_UNITS}}
 
-echo "Status of service 3proxy-{project_name}:"
-echo "Проверка статуса сервиса 3proxy-{project_name}:"
-sudo systemctl is-active --quiet 3proxy-{project_name}.service && echo "Сервис активен." || echo "Сервис не активен."
-sudo systemctl is-enabled --quiet 3proxy-{project_name}.service && echo "Сервис включен в автозагрузку." || echo "Сервис не включен в автозагрузку."
+echo "Проверка статуса сервисов 3proxy-{project_name}:"
+for UNIT in ${{SHARD_UNITS}}; do
+    sudo systemctl is-active --quiet ${{UNIT}} && echo "${{UNIT}}: активен." || echo "${{UNIT}}: не активен."
+    sudo systemctl is-enabled --quiet ${{UNIT}} && echo "${{UNIT}}: включен в автозагрузку." || echo "${{UNIT}}: не включен в автозагрузку."
+done
 """
 
     # Записываем start_systemctl.sh скрипт
@@ -411,26 +679,31 @@ sudo systemctl is-enabled --quiet 3proxy-{project_name}.service && echo "Сер
     stop_systemctl_script_content = f"""#!/bin/bash
 
 PROJECT_NAME="{project_name}"
-SERVICE_FILE_PATH="/etc/systemd/system/3proxy-${{PROJECT_NAME}}.service"
+SHARD_UNITS="{shard_units}"
 
-echo "Остановка сервиса 3proxy-${{PROJECT_NAME}}..."
-# Проверяем, существует ли сервис, прежде чем пытаться его остановить/отключить
-if systemctl is-active --quiet 3proxy-${{PROJECT_NAME}}.service; then
-    sudo systemctl stop 3proxy-${{PROJECT_NAME}}.service
-fi
+echo "Остановка шардов 3proxy-${{PROJECT_NAME}}..."
+# Останавливаем все запущенные экземпляры шаблона, включая оставшиеся от прошлой генерации
+sudo systemctl stop "3proxy-${{PROJECT_NAME}}@*.service"
 
-echo "Отключение сервиса 3proxy-${{PROJECT_NAME}}..."
-if systemctl is-enabled --quiet 3proxy-${{PROJECT_NAME}}.service; then
-    sudo systemctl disable 3proxy-${{PROJECT_NAME}}.service
+echo "Отключение шардов 3proxy-${{PROJECT_NAME}}..."
+sudo systemctl disable ${{SHARD_UNITS}} 2>/dev/null
+
+echo "Остановка и отключение {network_service_name}..."
+sudo systemctl disable --now {network_service_name} 2>/dev/null
+
+# Сервис без шардов от предыдущих версий генератора
+if systemctl is-enabled --quiet 3proxy-${{PROJECT_NAME}}.service || systemctl is-active --quiet 3proxy-${{PROJECT_NAME}}.service; then
+    sudo systemctl disable --now 3proxy-${{PROJECT_NAME}}.service
 fi
 
-echo "Удаление файла сервиса: ${{SERVICE_FILE_PATH}}"
-sudo rm -f ${{SERVICE_FILE_PATH}}
+echo "Удаление unit-файлов..."
+sudo rm -f /etc/systemd/system/{shard_template_service_name} /etc/systemd/system/{network_service_name} /etc/systemd/system/3proxy-${{PROJECT_NAME}}.service
+sudo rm -rf /etc/systemd/system/3proxy-${{PROJECT_NAME}}@*.service.d
 
 echo "Перезагрузка daemon systemd..."
 sudo systemctl daemon-reload
 
-echo "Сервис 3proxy-${{PROJECT_NAME}} удален."
+echo "Сервисы 3proxy-${{PROJECT_NAME}} удалены."
 """
     # Записываем stop_systemctl.sh скрипт
     stop_systemctl_script_filename = os.path.join(session_output_dir, "stop_systemctl.sh")
@@ -524,14 +797,23 @@ source "$BASE_DIR/venv/bin/activate" # Активируем виртуально
     print(f"Скрипт отвязки IPv6: {unbind_script_filename}")
     # *****************************************************************
 
-    # Извлекаем и сохраняем прокси в отдельный файл
-    extracted_proxy_filename = os.path.join(session_output_dir, "extracted_proxy")
-    extract_proxies_from_content(full_proxy_content, extracted_proxy_filename, proxy_username, proxy_password)
+    # ******************* Создание rotate.sh *******************
+    rotate_script_content = f"""#!/bin/bash
+BASE_DIR=$(cd $(dirname "${{BASH_SOURCE[0]}}")/../.. && pwd) # Определяем базовую директорию проекта
 
-    # Обновляем состояние после генерации всех прокси
-    state[external_ipv4]["latest_port"] = current_port - 1
-    state[external_ipv4]["ipv6_subnets"][current_ipv6_base_network_str]["latest_suffix_increment"] = current_ipv6_suffix_increment
-    save_state(state)
+# Ротация исходящих IPv6-адресов проекта без перезапуска 3proxy
+# Пример использования: ./rotate.sh --drain-seconds 120
+if [ -f "$BASE_DIR/venv/bin/activate" ]; then
+    source "$BASE_DIR/venv/bin/activate"
+fi
+cd "$BASE_DIR" && sudo "${{VIRTUAL_ENV:-/usr}}/bin/python3" 5_rotate_ipv6_egress.py {project_name} --interface {interface} "$@"
+"""
+    rotate_script_filename = os.path.join(session_output_dir, "rotate.sh")
+    with open(rotate_script_filename, "w") as f:
+        f.write(rotate_script_content)
+    os.chmod(rotate_script_filename, 0o755) # Делаем файл исполняемым
+    print(f"Скрипт ротации IPv6: {rotate_script_filename}")
+    # *****************************************************************
 
     print(f"Сгенерировано {generated_count} прокси и их учетные данные в папке: {session_output_dir}")
     print(f"Основной конфиг: {full_config_filename}")
@@ -554,7 +836,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--ipv6-subnet",
         type=str,
-        help="IPv6 подсеть для использования (например, 2a03:a03:a03:a03::/48 или 2a03:a03:a03:a03::/64).",
+        help="IPv6 подсеть для использования, от /32 до /64 (например, 2a03:a03:a03::/48 или 2a03:a03:a03:a03::/64).",
         default=None # По умолчанию None, чтобы можно было запросить интерактивно
     )
     parser.add_argument(
@@ -566,10 +848,59 @@ if __name__ == "__main__":
     parser.add_argument(
         "--external-ipv4",
         type=str,
-        help="Внешний IPv4-адрес сервера (например, 192.168.1.1).",
+        nargs="+",
+        help="Внешний IPv4-адрес сервера (например, 192.168.1.1). Можно указать несколько адресов - прокси распределятся между ними поровну.",
         default=None # По умолчанию None, чтобы можно было запросить интерактивно
     )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Количество процессов 3proxy (шардов) для проекта. По умолчанию - число ядер CPU.",
+        default=None
+    )
+    parser.add_argument(
+        "--connections-per-proxy",
+        type=int,
+        help=f"Ожидаемое число одновременных соединений на прокси для расчета maxconn (по умолчанию {DEFAULT_CONNECTIONS_PER_PROXY}).",
+        default=DEFAULT_CONNECTIONS_PER_PROXY
+    )
+    parser.add_argument(
+        "--anyip",
+        action="store_true",
+        help="Режим AnyIP: маршрутизировать всю подсеть локально вместо привязки каждого адреса (подсеть должна быть маршрутизирована на сервер)."
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Добавить num_proxies новых прокси к существующему проекту без перезапуска 3proxy."
+    )
+    parser.add_argument(
+        "--release-project",
+        type=str,
+        help="Освободить порты и IPv6-адреса удаленного проекта в proxy_states.json и выйти.",
+        default=None
+    )
     args = parser.parse_args()
+    if args.shards is not None and args.shards <= 0:
+        parser.error("Количество шардов должно быть положительным числом.")
+    if args.connections_per_proxy <= 0:
+        parser.error("Число соединений на прокси должно быть положительным.")
+    for ipv4 in args.external_ipv4 or []:
+        try:
+            validate_ipv4(ipv4)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.release_project:
+        try:
+            with state_transaction(STATE_FILE) as state:
+                migrate_legacy_state(state, BASE_OUTPUT_DIR)
+                released_ports, released_suffixes = release_project(state, args.release_project)
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Проект {args.release_project}: освобождено {released_ports} портов и {released_suffixes} IPv6-адресов.")
+        sys.exit(0)
 
     # Проверяем, предоставлены ли аргументы через командную строку, иначе запрашиваем
     num_proxies_input = args.num_proxies
@@ -611,9 +942,13 @@ if __name__ == "__main__":
     # Если внешний IPv4 не был предоставлен, запрашиваем у пользователя
     while external_ipv4_input is None:
         try:
-            input_ipv4 = input("Пожалуйста, введите внешний IPv4-адрес сервера: ")
-            validate_ipv4(input_ipv4) # Проверяем формат
-            external_ipv4_input = input_ipv4
+            input_ipv4 = input("Пожалуйста, введите внешний IPv4-адрес сервера (несколько адресов - через пробел или запятую): ")
+            input_ipv4s = input_ipv4.replace(",", " ").split()
+            if not input_ipv4s:
+                raise ValueError("адрес не указан")
+            for ipv4 in input_ipv4s:
+                validate_ipv4(ipv4) # Проверяем формат
+            external_ipv4_input = input_ipv4s
         except ValueError as e:
             print(f"Ошибка ввода IPv4: {e}. Пожалуйста, введите корректный IPv4-адрес.", file=sys.stderr)
             external_ipv4_input = None # Сбросить, чтобы запросить снова
@@ -626,5 +961,9 @@ if __name__ == "__main__":
         project_name=project_name_input,
         ipv6_subnet=ipv6_subnet_input,
         interface=interface_input,
-        external_ipv4=external_ipv4_input # Передаем внешний IPv4
+        external_ipv4=external_ipv4_input, # Передаем внешний IPv4
+        shard_count=args.shards,
+        append=args.append,
+        connections_per_proxy=args.connections_per_proxy,
+        anyip=args.anyip
     )
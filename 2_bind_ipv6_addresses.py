@@ -1,9 +1,19 @@
 import argparse
+import bisect
 import re
+import socket
 import subprocess
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import sys # Добавляем импорт sys
+from ipv6_allocator import BIND_PREFIXLEN, HOST_OFFSET, get_increment_layout
+from ipv6_binding import (get_network_fingerprint, read_anyip_subnet, read_network_fingerprint,
+                          remove_network_fingerprint, write_network_fingerprint)
+from state_store import STATE_FILENAME, read_state
+import rtnetlink
 
 # Примеры использования:
 # Привязать IPv6-адреса:
@@ -12,8 +22,30 @@ import sys # Добавляем импорт sys
 #
 # Отвязка IPv6-адресов:
 # sudo python3 proxy_configs/2_bind_ipv6_addresses.py MyProject --interface ens3 --action del
+#
+# Через ip -6 -batch вместо netlink (например, если нужен sudo для каждого вызова):
+# python3 2_bind_ipv6_addresses.py MyProject --interface ens3 --engine ip
+#
+# Привести интерфейс в соответствие с proxy_configs (добавить недостающие, удалить лишние адреса проекта):
+# sudo python3 2_bind_ipv6_addresses.py MyProject --interface ens3 --action reconcile
+#
+# Быстрая проверка при старте сервиса (сверка со снимком - только если отпечаток устарел
+# или выборочная проверка нашла недостающие адреса):
+# sudo python3 2_bind_ipv6_addresses.py MyProject --interface ens3 --action ensure
+#
+# Несколько проектов или все проекты generated_proxy_configs за один запуск (из корня репозитория):
+# sudo python3 2_bind_ipv6_addresses.py ProjectA ProjectB --action ensure
+# sudo python3 2_bind_ipv6_addresses.py --all-projects --action ensure
 
 BASE_OUTPUT_DIR = "generated_proxy_configs"
+# Сколько адресов обрабатывается за один пакет (одним процессом ip -batch или
+# серией окон netlink); прогресс обновляется после каждого пакета
+BATCH_CHUNK_SIZE = 5000
+# Сколько ошибок выводится по отдельным адресам (остальные только считаются)
+MAX_REPORTED_ERRORS = 50
+BATCH_FAILED_PATTERN = re.compile(r"^Command failed .*:(\d+)$")
+# Сколько адресов проверяется выборочно, если отпечаток сетевого состояния совпал
+ENSURE_SAMPLE_SIZE = 64
 
 def extract_ipv6_addresses(file_path):
     """
@@ -35,12 +67,509 @@ def extract_ipv6_addresses(file_path):
 
 def get_ipv6_command(ipv6_address_with_prefix, interface, action):
     """
-    Возвращает строку команды для добавления или удаления IPv6-адреса.
-    action: 'add' или 'del'
+    Возвращает строку для пакетного режима ip (ip -6 -batch -) для добавления
+    или удаления IPv6-адреса. action: 'add' или 'del'
+    """
+    # Используем извлеченный IPv6-адрес, который уже содержит префикс.
+    # "ip -6" задается один раз при запуске пакетного процесса.
+    return f"addr {action} {ipv6_address_with_prefix} dev {interface}"
+
+def get_privilege_prefix():
+    """sudo нужен, только если скрипт запущен не от root."""
+    return [] if os.geteuid() == 0 else ["sudo"]
+
+def parse_batch_errors(stderr):
+    """
+    Разбирает stderr пакетного ip: сообщения об ошибке печатаются перед строкой
+    "Command failed -:<номер строки>". Возвращает словарь номер_строки (с 1) -> сообщение.
+    """
+    errors = {}
+    messages = []
+    for line in stderr.splitlines():
+        match = BATCH_FAILED_PATTERN.match(line)
+        if match:
+            errors[int(match.group(1))] = " ".join(messages) or "неизвестная ошибка"
+            messages = []
+        elif line.strip():
+            messages.append(line.strip())
+    return errors
+
+def run_ip_batch(commands):
+    """
+    Выполняет команды одним процессом "ip -6 -force -batch -": -force продолжает
+    выполнение после ошибок. Возвращает словарь индекс_команды (с 0) -> сообщение об ошибке.
+    """
+    result = subprocess.run(
+        get_privilege_prefix() + ["ip", "-6", "-force", "-batch", "-"],
+        input="\n".join(commands) + "\n", capture_output=True, text=True, check=False
+    )
+    errors = {line_number - 1: message for line_number, message in parse_batch_errors(result.stderr).items()}
+    if result.returncode != 0 and not errors:
+        # ip завершился с ошибкой, не указав строку - считаем ошибочным весь пакет
+        message = result.stderr.strip() or f"код возврата {result.returncode}"
+        errors = {index: message for index in range(len(commands))}
+    return errors
+
+def is_noop_error(action, message):
+    """Адрес уже привязан (при добавлении) или уже отсутствует (при удалении) - это не ошибка."""
+    if action == "add":
+        return "File exists" in message or "already assigned" in message
+    return "Cannot assign requested address" in message or "No such" in message
+
+def process_chunk_ip(ipv6_addresses, interface, action):
+    """
+    Пакет адресов через ip -6 -force -batch. Возвращает словарь
+    индекс -> (не_ошибка, сообщение) для адресов, которые не удалось обработать.
+    """
+    errors = run_ip_batch([get_ipv6_command(ipv6, interface, action) for ipv6 in ipv6_addresses])
+    return {index: (is_noop_error(action, message), message) for index, message in errors.items()}
+
+def process_chunk_netlink(rtnl, ipv6_addresses, interface, action):
+    """
+    Пакет адресов через rtnetlink (RTM_NEWADDR с nodad / RTM_DELADDR).
+    Возвращает словарь индекс -> (не_ошибка, сообщение).
+    """
+    addresses = []
+    for ipv6 in ipv6_addresses:
+        address, prefixlen = ipv6.split("/")
+        addresses.append((address, int(prefixlen)))
+    if action == "add":
+        errors = rtnl.add_addresses(interface, addresses)
+    else:
+        errors = rtnl.delete_addresses(interface, addresses)
+    return {
+        index: (rtnetlink.is_noop_error(action, error_code), os.strerror(error_code))
+        for index, error_code in errors.items()
+    }
+
+def parse_ipv6_int(ipv6_address_with_prefix):
+    """Адрес вида "2a03::2/64" как целое число."""
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, ipv6_address_with_prefix.split("/", 1)[0]), "big")
+
+def get_reconcile_scope(state_file, project_name):
+    """
+    Подсети, в которых сверка может удалять адреса: те, где у проекта есть
+    инкременты в proxy_states.json. Для каждой возвращается (сеть, длина
+    префикса, сдвиг, начала, концы), где начала/концы - отсортированные
+    диапазоны инкрементов остальных владельцев (других проектов и адресов
+    этого проекта, ожидающих отвязки после ротации): их адреса не трогаются.
+    """
+    scope = []
+    for ipv4_state in read_state(state_file).values():
+        for subnet_str, subnet_state in ipv4_state.get("ipv6_subnets", {}).items():
+            suffixes = subnet_state.get("suffixes", {})
+            if project_name not in suffixes:
+                continue
+            address, prefixlen = subnet_str.split("/")
+            shift, _ = get_increment_layout(int(prefixlen))
+            foreign_ranges = sorted(
+                (start, end)
+                for owner, ranges in suffixes.items() if owner != project_name
+                for start, end in ranges
+            )
+            scope.append((
+                parse_ipv6_int(address), int(prefixlen), shift,
+                [start for start, _ in foreign_ranges], [end for _, end in foreign_ranges],
+            ))
+    return scope
+
+def exclude_primary_addresses(ipv6_addresses, state_file):
+    """
+    Убирает из списка на отвязку основные адреса сервера (сеть + HOST_OFFSET,
+    инкремент 0) всех подсетей из proxy_states.json: прежние версии генератора
+    выдавали этот адрес прокси, но отвязывать его нельзя.
+    Возвращает (оставшиеся адреса, сколько исключено).
+    """
+    primary_addresses = {
+        parse_ipv6_int(subnet_str) + HOST_OFFSET
+        for ipv4_state in read_state(state_file).values()
+        for subnet_str in ipv4_state.get("ipv6_subnets", {})
+    }
+    kept = [address for address in ipv6_addresses if parse_ipv6_int(address) not in primary_addresses]
+    return kept, len(ipv6_addresses) - len(kept)
+
+def is_stale_address(address, prefixlen, scope):
+    """
+    Адрес на интерфейсе лишний, если он привязан с длиной префикса прокси,
+    лежит в подсети проекта, построен по схеме аллокатора (сеть + (инкремент
+    << shift) + HOST_OFFSET) и его инкремент не закреплен за другим владельцем.
+    Остальные адреса подсети (SLAAC/EUI-64, временные, добавленные вручную)
+    и инкремент 0 (основной адрес сервера) не удаляются никогда.
+    """
+    if prefixlen != BIND_PREFIXLEN:
+        return False
+    for network, network_prefixlen, shift, foreign_starts, foreign_ends in scope:
+        if address >> (128 - network_prefixlen) != network >> (128 - network_prefixlen):
+            continue
+        offset = address - network
+        if offset & ((1 << shift) - 1) != HOST_OFFSET:
+            return False
+        increment = offset >> shift
+        if increment == 0:
+            return False
+        position = bisect.bisect_right(foreign_starts, increment) - 1
+        return position < 0 or increment >= foreign_ends[position]
+    return False
+
+def compute_drift(ipv6_addresses, bound_addresses, scope):
+    """
+    Сравнивает адреса из файла с одним снимком адресов интерфейса
+    (целое число -> длина префикса). Возвращает (недостающие, лишние) -
+    списки адресов с префиксом в формате файла proxy_configs.
+    """
+    inet_pton = socket.inet_pton
+    from_bytes = int.from_bytes
+    desired = {
+        from_bytes(inet_pton(socket.AF_INET6, ipv6.partition("/")[0]), "big"): ipv6
+        for ipv6 in ipv6_addresses
+    }
+    missing = [ipv6 for address, ipv6 in desired.items() if address not in bound_addresses]
+    if not scope:
+        return missing, []
+    stale = [
+        f"{socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, 'big'))}/{prefixlen}"
+        for address, prefixlen in bound_addresses.items()
+        if address not in desired and is_stale_address(address, prefixlen, scope)
+    ]
+    return missing, stale
+
+def process_addresses(rtnl, ipv6_addresses, interface, action, description):
+    """
+    Добавляет или удаляет адреса пакетами по BATCH_CHUNK_SIZE через netlink
+    (если передан rtnl) или ip -batch. Возвращает (выполнено, уже_в_нужном_состоянии, ошибок).
     """
-    # Используем извлеченный IPv6-адрес, который уже содержит префикс
-    # Команды будут выполняться через sudo, поэтому 'sudo' здесь не добавляем.
-    return f"ip -6 addr {action} {ipv6_address_with_prefix} dev {interface}"
+    done_count = 0
+    noop_count = 0
+    failed_count = 0
+    with tqdm(total=len(ipv6_addresses), desc=description) as progress:
+        for chunk_start in range(0, len(ipv6_addresses), BATCH_CHUNK_SIZE):
+            chunk = ipv6_addresses[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+            if rtnl:
+                errors = process_chunk_netlink(rtnl, chunk, interface, action)
+            else:
+                errors = process_chunk_ip(chunk, interface, action)
+            for index, (is_noop, message) in sorted(errors.items()):
+                if is_noop:
+                    noop_count += 1
+                else:
+                    failed_count += 1
+                    if failed_count <= MAX_REPORTED_ERRORS:
+                        tqdm.write(f"Ошибка: {ipv6_addresses[chunk_start + index]}: {message}")
+            done_count += len(chunk) - len(errors)
+            progress.update(len(chunk))
+    if failed_count > MAX_REPORTED_ERRORS:
+        tqdm.write(f"... и еще {failed_count - MAX_REPORTED_ERRORS} ошибок.")
+    return done_count, noop_count, failed_count
+
+def get_anyip_commands(anyip_subnet, action, file_path):
+    """
+    Команды для проекта в режиме AnyIP: вместо адресов добавляется или удаляется
+    один локальный маршрут на всю подсеть. Маршрут удаляется только при отвязке
+    всего проекта (proxy_configs) - отвязка части адресов (например, старых
+    адресов после ротации) не требует действий.
+    """
+    if action in ("add", "reconcile", "ensure"):
+        return [
+            "sysctl -w net.ipv6.ip_nonlocal_bind=1",
+            f"ip -6 route replace local {anyip_subnet} dev lo",
+        ]
+    if os.path.basename(file_path) == "proxy_configs":
+        return [f"ip -6 route del local {anyip_subnet} dev lo"]
+    return []
+
+def run_anyip_commands(anyip_subnet, action, file_path):
+    """Выполняет команды режима AnyIP. Возвращает число ошибок."""
+    failed_count = 0
+    for cmd in get_anyip_commands(anyip_subnet, action, file_path):
+        result = subprocess.run(get_privilege_prefix() + cmd.split(), capture_output=True, text=True)
+        if result.returncode != 0:
+            tqdm.write(f"Ошибка выполнения команды: {cmd}")
+            tqdm.write(f"Ошибка stderr: {result.stderr}")
+            failed_count += 1
+    return failed_count
+
+def reconcile_addresses(rtnl, ipv6_addresses, interface, project_name, file_path, remove_stale=True):
+    """
+    Сверка интерфейса с файлом адресов: один снимок адресов интерфейса через
+    netlink (дамп доступен без root), разница множеств целых чисел, затем
+    добавление только недостающих и удаление только лишних адресов проекта
+    (если remove_stale). Время работы ядра пропорционально расхождению,
+    а не числу прокси. Возвращает число ошибок.
+    """
+    try:
+        with rtnetlink.RtnetlinkSocket() as snapshot_rtnl:
+            bound_addresses = snapshot_rtnl.get_ipv6_address_prefixes(interface)
+    except OSError as e:
+        tqdm.write(f"Ошибка: не удалось получить адреса {interface}: {e}")
+        return 1
+
+    scope = []
+    if remove_stale:
+        state_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(file_path))), STATE_FILENAME)
+        try:
+            scope = get_reconcile_scope(state_file, project_name)
+        except ValueError as e:
+            tqdm.write(f"Ошибка: {e}")
+            return 1
+        if not scope:
+            tqdm.write(f"Предупреждение: за проектом {project_name} нет подсетей в {state_file}, лишние адреса не удаляются.")
+
+    missing, stale = compute_drift(ipv6_addresses, bound_addresses, scope)
+    tqdm.write(f"\nАдресов в {os.path.basename(file_path)}: {len(ipv6_addresses)}, на {interface}: {len(bound_addresses)}. "
+               f"Недостает: {len(missing)}, лишних: {len(stale)}.")
+    if not missing and not stale:
+        tqdm.write("Расхождений нет.")
+        return 0
+
+    failed_count = 0
+    if missing:
+        done_count, noop_count, missing_failed = process_addresses(rtnl, missing, interface, "add", "Привязка недостающих IPv6")
+        tqdm.write(f"Привязано: {done_count}, уже привязано: {noop_count}, ошибок: {missing_failed}.")
+        failed_count += missing_failed
+    if stale:
+        done_count, noop_count, stale_failed = process_addresses(rtnl, stale, interface, "del", "Отвязка лишних IPv6")
+        tqdm.write(f"Отвязано: {done_count}, уже отвязано: {noop_count}, ошибок: {stale_failed}.")
+        failed_count += stale_failed
+    return failed_count
+
+def sample_addresses(ipv6_addresses, sample_size=ENSURE_SAMPLE_SIZE):
+    """Равномерная выборка адресов файла (первый и последний входят всегда)."""
+    if len(ipv6_addresses) <= sample_size:
+        return list(ipv6_addresses)
+    last = len(ipv6_addresses) - 1
+    return [ipv6_addresses[index * last // (sample_size - 1)] for index in range(sample_size)]
+
+def count_missing_samples(ipv6_addresses, interface):
+    """
+    Сколько адресов из выборки нет на интерфейсе (запросы RTM_GETADDR к
+    отдельным адресам вместо снимка всех адресов интерфейса). Если проверить
+    не удалось, отсутствующими считаются все адреса выборки.
+    """
+    samples = sample_addresses(ipv6_addresses)
+    try:
+        with rtnetlink.RtnetlinkSocket() as probe_rtnl:
+            errors = probe_rtnl.probe_ipv6_addresses(interface, [
+                (address, int(prefixlen)) for address, prefixlen in (sample.split("/", 1) for sample in samples)
+            ])
+    except OSError:
+        return len(samples)
+    return len(errors)
+
+def check_ensure_fast_path(file_path, interface, ipv6_addresses):
+    """
+    Быстрая проверка для ensure: отпечаток совпадает с сохраненным (та же
+    загрузка системы, тот же интерфейс, тот же файл адресов) и выборка
+    адресов на месте - тогда снимок интерфейса и сверка не нужны.
+    Возвращает (текущий отпечаток, можно ли пропустить сверку).
+    """
+    fingerprint = get_network_fingerprint(file_path, interface, rtnetlink.get_interface_index(interface))
+    if read_network_fingerprint(os.path.dirname(os.path.abspath(file_path))) != fingerprint:
+        return fingerprint, False
+    return fingerprint, not count_missing_samples(ipv6_addresses, interface)
+
+def ensure_addresses(rtnl, ipv6_addresses, interface, project_name, file_path):
+    """
+    Настройка сети при старте сервиса: добавляются только недостающие адреса,
+    лишние не удаляются никогда (после перезагрузки отпечаток всегда
+    устаревший, и удаление на каждой загрузке задело бы чужие адреса
+    интерфейса; лишние адреса проекта удаляет только явный reconcile).
+    Если отпечаток совпадает и выборочная проверка адресов прошла, снимок
+    интерфейса и сверка пропускаются. После успешной сверки отпечаток
+    обновляется. Возвращает число ошибок.
+    """
+    try:
+        fingerprint, is_current = check_ensure_fast_path(file_path, interface, ipv6_addresses)
+    except OSError as e:
+        tqdm.write(f"Ошибка: {interface}: {e}")
+        return 1
+    if is_current:
+        tqdm.write(f"Отпечаток сетевого состояния совпадает, выборка из {len(sample_addresses(ipv6_addresses))} "
+                   f"адресов на {interface}: все привязаны. Сверка не нужна.")
+        return 0
+    tqdm.write("Отпечаток сетевого состояния отсутствует, устарел или выборка нашла недостающие адреса: "
+               "привязываются недостающие адреса (лишние адреса удаляет --action reconcile).")
+    failed_count = reconcile_addresses(rtnl, ipv6_addresses, interface, project_name, file_path, remove_stale=False)
+    if not failed_count:
+        write_network_fingerprint(os.path.dirname(os.path.abspath(file_path)), fingerprint)
+    return failed_count
+
+class ProjectsProgress:
+    """Общий индикатор и счетчик выведенных ошибок для параллельных обработчиков интерфейсов."""
+
+    def __init__(self, description):
+        self.lock = threading.Lock()
+        self.bar = tqdm(total=0, desc=description)
+        self.reported_errors = 0
+
+    def add_total(self, count):
+        if not count:
+            return
+        with self.lock:
+            self.bar.total += count
+            self.bar.refresh()
+
+    def update(self, count):
+        with self.lock:
+            self.bar.update(count)
+
+    def report_error(self, message):
+        with self.lock:
+            self.reported_errors += 1
+            if self.reported_errors <= MAX_REPORTED_ERRORS:
+                tqdm.write(message)
+
+def plan_project_operations(project_name, file_path, interface, action, get_bound_addresses):
+    """
+    Адреса проекта для добавления и удаления: для add/del - все адреса файла,
+    для reconcile/ensure - расхождение с общим снимком интерфейса, который
+    возвращает get_bound_addresses() (ensure с совпавшим отпечатком и
+    прошедшей выборочной проверкой снимок не запрашивает).
+    Возвращает (добавить, удалить, отпечаток для записи после успеха или None).
+    """
+    ipv6_addresses = extract_ipv6_addresses(file_path)
+    if action == "add":
+        return ipv6_addresses, [], None
+    project_output_dir = os.path.dirname(os.path.abspath(file_path))
+    state_file = os.path.join(os.path.dirname(project_output_dir), STATE_FILENAME)
+    if action == "del":
+        ipv6_addresses, primary_count = exclude_primary_addresses(ipv6_addresses, state_file)
+        if primary_count:
+            tqdm.write(f"{project_name}: основной адрес сервера не отвязывается.")
+        return [], ipv6_addresses, None
+    scope = []
+    if action == "reconcile":
+        fingerprint = get_network_fingerprint(file_path, interface, rtnetlink.get_interface_index(interface))
+        scope = get_reconcile_scope(state_file, project_name)
+    else:
+        # ensure лишние адреса не удаляет (см. ensure_addresses)
+        fingerprint, is_current = check_ensure_fast_path(file_path, interface, ipv6_addresses)
+        if is_current:
+            return [], [], None
+    missing, stale = compute_drift(ipv6_addresses, get_bound_addresses(), scope)
+    return missing, stale, fingerprint
+
+def bind_interface_projects(interface, projects, action, use_netlink, progress):
+    """
+    Обрабатывает все проекты одного интерфейса: для reconcile/ensure - один
+    снимок интерфейса на все проекты (берется, только если он нужен хотя бы
+    одному проекту), затем адреса всех проектов идут одним
+    потоком пакетов (добавления, потом удаления) через один сокет netlink или
+    ip -batch. Возвращает словарь проект -> [выполнено, уже_в_нужном_состоянии, ошибок].
+    """
+    results = {project_name: [0, 0, 0] for project_name, _ in projects}
+    try:
+        snapshot = []
+
+        def get_bound_addresses():
+            if not snapshot:
+                with rtnetlink.RtnetlinkSocket() as snapshot_rtnl:
+                    snapshot.append(snapshot_rtnl.get_ipv6_address_prefixes(interface))
+            return snapshot[0]
+
+        operations = {"add": [], "del": []}
+        fingerprints = {}
+        for project_name, file_path in projects:
+            to_add, to_delete, fingerprint = plan_project_operations(
+                project_name, file_path, interface, action, get_bound_addresses)
+            operations["add"] += [(ipv6, project_name) for ipv6 in to_add]
+            operations["del"] += [(ipv6, project_name) for ipv6 in to_delete]
+            if fingerprint:
+                fingerprints[project_name] = (os.path.dirname(os.path.abspath(file_path)), fingerprint)
+        progress.add_total(len(operations["add"]) + len(operations["del"]))
+    except (OSError, ValueError) as e:
+        for project_name, _ in projects:
+            progress.report_error(f"Ошибка: {project_name} ({interface}): {e}")
+            results[project_name][2] += 1
+        return results
+
+    rtnl = rtnetlink.RtnetlinkSocket() if use_netlink else None
+    try:
+        for operation, items in operations.items():
+            for chunk_start in range(0, len(items), BATCH_CHUNK_SIZE):
+                chunk = items[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+                chunk_addresses = [ipv6 for ipv6, _ in chunk]
+                if rtnl:
+                    errors = process_chunk_netlink(rtnl, chunk_addresses, interface, operation)
+                else:
+                    errors = process_chunk_ip(chunk_addresses, interface, operation)
+                for index, (ipv6, project_name) in enumerate(chunk):
+                    if index not in errors:
+                        results[project_name][0] += 1
+                    elif errors[index][0]:
+                        results[project_name][1] += 1
+                    else:
+                        results[project_name][2] += 1
+                        progress.report_error(f"Ошибка: {project_name}: {ipv6}: {errors[index][1]}")
+                progress.update(len(chunk))
+    except OSError as e:
+        progress.report_error(f"Ошибка: {interface}: {e}")
+        for project_name, _ in projects:
+            results[project_name][2] += 1
+    finally:
+        if rtnl:
+            rtnl.close()
+
+    for project_name, (project_output_dir, fingerprint) in fingerprints.items():
+        if not results[project_name][2]:
+            write_network_fingerprint(project_output_dir, fingerprint)
+    return results
+
+def bind_projects(project_names, filename, default_interface, action, use_netlink, workers):
+    """
+    Несколько проектов за один запуск: проекты группируются по интерфейсу
+    (из --interface, отпечатка сетевого состояния проекта или маршрута по
+    умолчанию), интерфейсы обрабатываются параллельно, по одному обработчику
+    на интерфейс. Возвращает общее число ошибок.
+    """
+    started = time.monotonic()
+    groups = {}
+    results = {}
+    interfaces = {}
+    failed_count = 0
+    for project_name in project_names:
+        project_output_dir = os.path.join(BASE_OUTPUT_DIR, project_name)
+        file_path = os.path.join(project_output_dir, filename)
+        if not os.path.exists(file_path):
+            tqdm.write(f"Ошибка: Указанный файл не существует: {file_path}")
+            failed_count += 1
+            continue
+        fingerprint = read_network_fingerprint(project_output_dir)
+        interface = default_interface or (fingerprint or {}).get("interface") or get_default_ipv6_interface()
+        interfaces[project_name] = interface
+        anyip_subnet = read_anyip_subnet(project_output_dir)
+        if anyip_subnet:
+            anyip_failed = run_anyip_commands(anyip_subnet, action, file_path)
+            results[project_name] = [0, 0, anyip_failed]
+            continue
+        if action == "del" and filename == "proxy_configs":
+            remove_network_fingerprint(project_output_dir)
+        groups.setdefault(interface, []).append((project_name, file_path))
+
+    if groups:
+        workers = min(workers or len(groups), len(groups))
+        tqdm.write(f"\nПроектов: {sum(len(projects) for projects in groups.values())}, интерфейсов: {len(groups)}, "
+                   f"обработчиков: {workers} ({'netlink' if use_netlink else 'ip -batch'}).")
+        progress = ProjectsProgress(f"Выполнение {action} IPv6")
+        with progress.bar, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(bind_interface_projects, interface, projects, action, use_netlink, progress)
+                for interface, projects in groups.items()
+            ]
+            for future in futures:
+                results.update(future.result())
+        if progress.reported_errors > MAX_REPORTED_ERRORS:
+            tqdm.write(f"... и еще {progress.reported_errors - MAX_REPORTED_ERRORS} ошибок.")
+
+    name_width = max([len(project_name) for project_name in results] + [len("Проект")])
+    tqdm.write(f"\n{'Проект':<{name_width}}  {'Интерфейс':<12}  {'Выполнено':>10}  {'Без изменений':>13}  {'Ошибок':>7}")
+    for project_name in sorted(results):
+        done_count, noop_count, project_failed = results[project_name]
+        tqdm.write(f"{project_name:<{name_width}}  {interfaces[project_name]:<12}  {done_count:>10}  {noop_count:>13}  {project_failed:>7}")
+        failed_count += project_failed
+    totals = [sum(values) for values in zip(*results.values())] if results else [0, 0, 0]
+    tqdm.write(f"Итого: выполнено {totals[0]}, без изменений {totals[1]}, ошибок {failed_count} "
+               f"за {time.monotonic() - started:.1f} с.")
+    return failed_count
 
 def get_default_ipv6_interface():
     """
@@ -84,10 +613,22 @@ def get_default_ipv6_interface():
 
 def main():
     parser = argparse.ArgumentParser(description="Инструмент для привязки/отвязки IPv6-адресов к сетевому интерфейсу.")
-    parser.add_argument("project_name", help="Имя проекта, содержащего файл proxy_configs.")
+    parser.add_argument("project_names", nargs="*", metavar="project_name",
+                        help="Имя проекта, содержащего файл proxy_configs. Несколько проектов обрабатываются "
+                             "параллельно по интерфейсам (запуск из корня репозитория).")
+    parser.add_argument("--all-projects", action="store_true", help=f"Обработать все проекты в {BASE_OUTPUT_DIR}.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Сколько интерфейсов обрабатывать параллельно при нескольких проектах (по умолчанию - все сразу).")
     parser.add_argument("--interface", default=None, help="Имя сетевого интерфейса. Если не указан, будет предпринята попытка автоматического определения.")
-    parser.add_argument("--action", choices=["add", "del", "add_all"], default="add",
-                        help="Действие: 'add' (добавить адреса), 'del' (удалить адреса) или 'add_all' (добавить все адреса для проекта). По умолчанию: add.")
+    parser.add_argument("--action", choices=["add", "del", "add_all", "reconcile", "ensure"], default="add",
+                        help="Действие: 'add' (добавить адреса), 'del' (удалить адреса), 'add_all' (добавить все адреса для проекта), "
+                             "'reconcile' (добавить недостающие и удалить лишние адреса проекта) или 'ensure' (при совпавшем "
+                             "отпечатке сетевого состояния - только выборочная проверка, иначе добавить недостающие и обновить "
+                             "отпечаток; для запуска сервиса). По умолчанию: add.")
+    parser.add_argument("--engine", choices=["netlink", "ip"], default="netlink",
+                        help="Способ привязки: 'netlink' (в процессе, нужен root) или 'ip' (ip -6 -batch). По умолчанию: netlink.")
+    parser.add_argument("--file", default="proxy_configs",
+                        help="Файл с адресами в директории проекта (по умолчанию proxy_configs; proxy_configs.new - адреса последнего --append).")
 
     args = parser.parse_args()
 
@@ -95,6 +636,25 @@ def main():
     if args.action == "add_all":
         args.action = "add"
 
+    if args.all_projects:
+        if not os.path.isdir(BASE_OUTPUT_DIR):
+            tqdm.write(f"Ошибка: Директория {BASE_OUTPUT_DIR} не найдена. Запустите скрипт из корня репозитория.")
+            sys.exit(1)
+        args.project_names = sorted(
+            name for name in os.listdir(BASE_OUTPUT_DIR)
+            if os.path.isfile(os.path.join(BASE_OUTPUT_DIR, name, "proxy_configs"))
+        )
+    if not args.project_names:
+        parser.error("укажите имя проекта или --all-projects")
+    if len(args.project_names) > 1 or args.all_projects:
+        use_netlink = args.engine == "netlink" and os.geteuid() == 0
+        if args.engine == "netlink" and not use_netlink:
+            tqdm.write("netlink требует прав root, адреса будут обработаны через sudo ip -6 -batch.")
+        if bind_projects(args.project_names, args.file, args.interface, args.action, use_netlink, args.workers):
+            sys.exit(1)
+        return
+    args.project_name = args.project_names[0]
+
     # Если интерфейс не указан, пытаемся определить его автоматически
     if args.interface is None:
         detected_interface = get_default_ipv6_interface()
@@ -108,44 +668,76 @@ def main():
 
     # file_path = os.path.join(BASE_OUTPUT_DIR, args.project_name, "proxy_configs")
     # Так как скрипт bind.sh запускается из директории проекта, достаточно указать относительный путь
-    file_path = "proxy_configs"
+    file_path = args.file
 
     # Проверяем, существует ли файл
     if not os.path.exists(file_path):
         tqdm.write(f"Ошибка: Указанный файл не существует: {file_path}")
         return
 
+    # Проект в режиме AnyIP: адреса не привязываются по одному
+    anyip_subnet = read_anyip_subnet(os.path.dirname(os.path.abspath(file_path)))
+    if anyip_subnet:
+        tqdm.write(f"Проект в режиме AnyIP: подсеть {anyip_subnet} маршрутизируется локально, адреса по одному не {'отвязываются' if args.action == 'del' else 'привязываются'}.")
+        run_anyip_commands(anyip_subnet, args.action, file_path)
+        tqdm.write("\nОперация завершена.")
+        return
+
     ipv6_addresses = extract_ipv6_addresses(file_path)
 
     if not ipv6_addresses:
         tqdm.write(f"В файле {file_path} не найдено IPv6-адресов для обработки.")
         return
 
-    tqdm.write(f"\nСобираю команды для {'привязки' if args.action == 'add' else 'отвязки'} IPv6-адресов...")
-    commands_to_execute = []
-    # Собираем команды в список, используя tqdm для отображения прогресса
-    for ipv6 in tqdm(ipv6_addresses, desc="Сбор команд IPv6"):
-        commands_to_execute.append(get_ipv6_command(ipv6, args.interface, args.action))
+    # netlink работает в процессе и требует root; без него - ip -batch через sudo
+    rtnl = None
+    if args.engine == "netlink":
+        if os.geteuid() == 0:
+            try:
+                rtnl = rtnetlink.RtnetlinkSocket()
+                rtnetlink.get_interface_index(args.interface)
+            except OSError as e:
+                tqdm.write(f"Ошибка: {args.interface}: {e}")
+                sys.exit(1)
+        else:
+            tqdm.write("netlink требует прав root, адреса будут обработаны через sudo ip -6 -batch.")
 
-    tqdm.write(f"\nCобранно {len(commands_to_execute)} команд. Выполняю пакетную привязку/отвязку IPv6-адресов...")
+    if args.action == "del":
+        ipv6_addresses, primary_count = exclude_primary_addresses(
+            ipv6_addresses, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(file_path))), STATE_FILENAME))
+        if primary_count:
+            tqdm.write("Основной адрес сервера (инкремент 0 подсети) не отвязывается.")
 
-    for cmd in tqdm(commands_to_execute, desc="Выполнение команд IPv6"):
-        try:
-            # Предупреждение: выполнение команд с sudo требует прав.
-            # Если скрипт запускается без sudo, то эти команды будут требовать пароль.
-            # Ожидается, что скрипт будет запущен с sudo.
-            result = subprocess.run(f"sudo {cmd}", shell=True, capture_output=True, text=True, check=True)
-            if result.stdout:
-                # tqdm.write(f"Успех: {cmd.strip()} - {result.stdout.strip()}")
-                pass # Пропускаем stdout, чтобы не засорять вывод, но можем включить для отладки
-        except subprocess.CalledProcessError as e:
-            tqdm.write(f"Ошибка выполнения команды: {cmd.strip()}")
-            tqdm.write(f"Статус: {e.returncode}")
-            tqdm.write(f"Ошибка stdout: {e.stdout}")
-            tqdm.write(f"Ошибка stderr: {e.stderr}") # Вывод ошибки stderr
-        except FileNotFoundError:
-            tqdm.write("Ошибка: Команда 'ip' не найдена. Убедитесь, что iproute2 установлен.")
+    if args.action == "del" and os.path.basename(file_path) == "proxy_configs":
+        # Проект отвязывается целиком: до удаления адресов, чтобы
+        # 6_watch_ipv6_bindings.py не возвращал их, пока идет отвязка
+        remove_network_fingerprint(os.path.dirname(os.path.abspath(file_path)))
+
+    try:
+        if args.action == "reconcile":
+            failed_count = reconcile_addresses(rtnl, ipv6_addresses, args.interface, args.project_name, file_path)
+            if not failed_count:
+                write_network_fingerprint(os.path.dirname(os.path.abspath(file_path)), get_network_fingerprint(
+                    file_path, args.interface, rtnetlink.get_interface_index(args.interface)))
+        elif args.action == "ensure":
+            failed_count = ensure_addresses(rtnl, ipv6_addresses, args.interface, args.project_name, file_path)
+        else:
+            action_name = 'привязки' if args.action == 'add' else 'отвязки'
+            tqdm.write(f"\nНайдено {len(ipv6_addresses)} адресов. Выполняю пакетную {'привязку' if args.action == 'add' else 'отвязку'} "
+                       f"IPv6-адресов пакетами по {BATCH_CHUNK_SIZE} ({'netlink' if rtnl else 'ip -batch'})...")
+            done_count, noop_count, failed_count = process_addresses(
+                rtnl, ipv6_addresses, args.interface, args.action, f"Выполнение {action_name} IPv6")
+            tqdm.write(f"\nГотово: {done_count} адресов, "
+                       f"{'уже привязано' if args.action == 'add' else 'уже отвязано'}: {noop_count}, ошибок: {failed_count}.")
+    except FileNotFoundError:
+        tqdm.write("Ошибка: Команда 'ip' не найдена. Убедитесь, что iproute2 установлен.")
+        sys.exit(1)
+    finally:
+        if rtnl:
+            rtnl.close()
 
+    if failed_count:
+        sys.exit(1)
 
     tqdm.write("\nОперация завершена.")
 
@@ -1,68 +1,106 @@
 import argparse
+import ipaddress
+import json
 import re
+import socket
 import subprocess
 import os
+import sys
+import time
+from ipv6_binding import NONLOCAL_BIND_SYSCTL, read_anyip_subnet
+import rtnetlink
 # Примеры использования:
 # Проверить привязку IPv6-адресов:
 # python3 3_check_ipv6_bindings.py MyProject --interface ens3
+#
+# Отчет в JSON (сводка выводится в stderr):
+# python3 3_check_ipv6_bindings.py MyProject --interface ens3 --json > report.json
 
 BASE_OUTPUT_DIR = "generated_proxy_configs"
+# Сколько непривязанных адресов выводится в текстовом отчете (в JSON - все)
+MAX_REPORTED_ADDRESSES = 50
+# Формат строки proxy_configs, который пишет генератор: ... ipv6:<адрес>/<префикс>
+IPV6_ADDRESS_PATTERN = re.compile(r"ipv6:([0-9a-fA-F:]+)/(\d{1,3})")
 
 def extract_ipv6_addresses(file_path):
-    ipv6_addresses = []
-    ipv6_pattern = re.compile(r"ipv6:([0-9a-fA-F:]+?)::2")
+    """Адреса из proxy_configs: список (адрес, длина префикса строкой)."""
     try:
         with open(file_path, 'r') as f:
-            for line in f:
-                match = ipv6_pattern.search(line)
-                if match:
-                    ipv6_addresses.append(match.group(1))
+            return IPV6_ADDRESS_PATTERN.findall(f.read())
     except FileNotFoundError:
-        print(f"Ошибка: Файл не найден по пути {file_path}")
-    return ipv6_addresses
+        print(f"Ошибка: Файл не найден по пути {file_path}", file=sys.stderr)
+        return []
 
-def check_ipv6_binding(ipv6_address_prefix, interface):
+def check_ipv6_bindings(ipv6_addresses, bound_addresses):
     """
-    Проверяет, привязан ли IPv6-адрес (с учетом ::/64) к указанному сетевому интерфейсу.
+    Сверяет адреса проекта со снимком адресов интерфейса (целое число ->
+    длина префикса): по одному поиску в словаре на адрес.
+    Возвращает (непривязанные, привязанные_с_другим_префиксом).
     """
-    command = ['ip', '-6', 'addr', 'show', 'dev', interface]
+    inet_pton = socket.inet_pton
+    from_bytes = int.from_bytes
+    # Длины префикса в файле - строки; различных значений на интерфейсе единицы
+    bound_prefixlens = {prefixlen: str(prefixlen) for prefixlen in set(bound_addresses.values())}
+    missing = []
+    wrong_prefix = []
+    for address, prefixlen in ipv6_addresses:
+        bound_prefixlen = bound_addresses.get(from_bytes(inet_pton(socket.AF_INET6, address), "big"))
+        if bound_prefixlen is None:
+            missing.append(f"{address}/{prefixlen}")
+        elif bound_prefixlens[bound_prefixlen] != prefixlen:
+            wrong_prefix.append(f"{address}/{prefixlen}")
+    return missing, wrong_prefix
+
+def check_anyip_project(file_path, anyip_subnet, report_stream=sys.stdout):
+    """
+    Проверка проекта в режиме AnyIP: вместо каждого адреса проверяются локальный
+    маршрут на подсеть, net.ipv6.ip_nonlocal_bind и то, что все адреса прокси
+    лежат в этой подсети. Возвращает True, если все в порядке.
+    """
+    ok = True
+    result = subprocess.run(['ip', '-6', 'route', 'show', 'table', 'local', 'type', 'local', anyip_subnet],
+                            capture_output=True, text=True, check=False)
+    if "dev lo" in result.stdout:
+        print(f"  Маршрут local {anyip_subnet} dev lo: ЕСТЬ", file=report_stream)
+    else:
+        print(f"  Маршрут local {anyip_subnet} dev lo: НЕТ", file=report_stream)
+        ok = False
+
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        # Ищем полный IPv6-адрес в выводе, с учетом ::/64
-        # ip output typically shows the full address including ::/64
-        # Разделим префикс на сегменты и сформируем регулярное выражение для поиска
-        # Учитываем, что в выводе `ip` ведущие нули в хекстетах могут отсутствовать (например, 03ea -> 3ea)
-        segments = ipv6_address_prefix.split(':')
-        regex_segments = []
-        for seg in segments:
-            if re.match(r"0[0-9a-fA-F]{1,3}", seg) and seg != "0": # Если сегмент начинается с нуля и не равен "0" (например, "03ea")
-                regex_segments.append(f"({re.escape(seg)}|{re.escape(seg.lstrip('0'))})")
-            else:
-                regex_segments.append(re.escape(seg))
-        
-        # Собираем паттерн для поиска полного IPv6-адреса с учетом "::/64"
-        # Ищем "inet6 <адрес>::/64"
-        ipv6_regex_pattern_str = r"inet6\s+" + ":".join(regex_segments) + r":{1,2}/64"
-        ipv6_regex_pattern = re.compile(ipv6_regex_pattern_str)
-        
-        if ipv6_regex_pattern.search(result.stdout):
-            return True
-        else:
-            return False
-    except subprocess.CalledProcessError as e:
-        print(f"Ошибка выполнения команды 'ip' для интерфейса {interface}:")
-        print(f"Статус: {e.returncode}")
-        print(f"Ошибка: {e.stderr}")
-        return False
-    except FileNotFoundError:
-        print("Ошибка: Команда 'ip' не найдена. Убедитесь, что iproute2 установлен.")
-        return False
+        with open(NONLOCAL_BIND_SYSCTL, "r") as f:
+            nonlocal_bind = f.read().strip()
+    except OSError:
+        nonlocal_bind = None
+    print(f"  net.ipv6.ip_nonlocal_bind = {nonlocal_bind}", file=report_stream)
+    if nonlocal_bind != "1":
+        ok = False
+
+    network = ipaddress.IPv6Network(anyip_subnet)
+    address_pattern = re.compile(r"ipv6:([0-9a-fA-F:]+)/")
+    total_count = 0
+    outside = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            match = address_pattern.search(line)
+            if not match:
+                continue
+            total_count += 1
+            if ipaddress.IPv6Address(match.group(1)) not in network:
+                outside.append(match.group(1))
+    for ipv6_address in outside:
+        print(f"  {ipv6_address}: ВНЕ ПОДСЕТИ {anyip_subnet}", file=report_stream)
+    if outside:
+        ok = False
+    print(f"  Адресов прокси: {total_count}, вне подсети AnyIP: {len(outside)}", file=report_stream)
+    return ok
 
 def main():
     parser = argparse.ArgumentParser(description="Проверка привязки IPv6-адресов к сетевому интерфейсу.")
     parser.add_argument("project_name", help="Имя проекта, содержащего файл proxy_configs.")
     parser.add_argument("--interface", default="ens3", help="Сетевой интерфейс для проверки (по умолчанию ens3).")
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в JSON в stdout (текстовая сводка - в stderr).")
     args = parser.parse_args()
+    report_stream = sys.stderr if args.json else sys.stdout
 
     file_path = os.path.join(BASE_OUTPUT_DIR, args.project_name, "proxy_configs")
 
@@ -71,18 +109,63 @@ def main():
         print(f"Ошибка: Файл {file_path} не найден.")
         return
 
-    ipv6_prefixes = extract_ipv6_addresses(file_path)
+    anyip_subnet = read_anyip_subnet(os.path.dirname(file_path))
+    if anyip_subnet:
+        print(f"Проверка проекта {args.project_name} в режиме AnyIP:", file=report_stream)
+        anyip_ok = check_anyip_project(file_path, anyip_subnet, report_stream)
+        if anyip_ok:
+            print("Все адреса прокси обслуживаются локальным маршрутом подсети.", file=report_stream)
+        else:
+            print("Режим AnyIP настроен не полностью. Запустите setup_network_ipv6.sh проекта.", file=report_stream)
+        if args.json:
+            json.dump({"project": args.project_name, "mode": "anyip", "subnet": anyip_subnet, "ok": anyip_ok}, sys.stdout, indent=2)
+            print()
+        if not anyip_ok:
+            sys.exit(1)
+        return
 
-    if not ipv6_prefixes:
-        print(f"В файле {file_path} не найдено IPv6-адресов для проверки.")
+    started = time.monotonic()
+    ipv6_addresses = extract_ipv6_addresses(file_path)
+    if not ipv6_addresses:
+        print(f"В файле {file_path} не найдено IPv6-адресов для проверки.", file=report_stream)
         return
 
-    print(f"Проверка привязки IPv6-адресов на интерфейсе {args.interface}:")
-    for prefix in ipv6_prefixes:
-        if check_ipv6_binding(prefix, args.interface):
-            print(f"  {prefix}::/64: ПРИВЯЗАН")
-        else:
-            print(f"  {prefix}::/64: НЕ ПРИВЯЗАН")
+    # Один снимок адресов интерфейса вместо вызова ip на каждый адрес
+    try:
+        with rtnetlink.RtnetlinkSocket() as rtnl:
+            bound_addresses = rtnl.get_ipv6_address_prefixes(args.interface)
+    except OSError as e:
+        print(f"Ошибка: не удалось получить адреса интерфейса {args.interface}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    missing, wrong_prefix = check_ipv6_bindings(ipv6_addresses, bound_addresses)
+    elapsed = time.monotonic() - started
+    bound_count = len(ipv6_addresses) - len(missing) - len(wrong_prefix)
+
+    print(f"Проверка привязки IPv6-адресов проекта {args.project_name} на интерфейсе {args.interface}:", file=report_stream)
+    for ipv6_address in missing[:MAX_REPORTED_ADDRESSES]:
+        print(f"  {ipv6_address}: НЕ ПРИВЯЗАН", file=report_stream)
+    for ipv6_address in wrong_prefix[:MAX_REPORTED_ADDRESSES]:
+        print(f"  {ipv6_address}: ПРИВЯЗАН С ДРУГИМ ПРЕФИКСОМ", file=report_stream)
+    if len(missing) > MAX_REPORTED_ADDRESSES or len(wrong_prefix) > MAX_REPORTED_ADDRESSES:
+        print("  ... (полный список - с --json)", file=report_stream)
+    print(f"Адресов: {len(ipv6_addresses)}, привязано: {bound_count}, не привязано: {len(missing)}, "
+          f"с другим префиксом: {len(wrong_prefix)} (проверено за {elapsed:.3f} с).", file=report_stream)
+
+    if args.json:
+        json.dump({
+            "project": args.project_name,
+            "interface": args.interface,
+            "mode": "bind",
+            "total": len(ipv6_addresses),
+            "bound": bound_count,
+            "missing": missing,
+            "wrong_prefix": wrong_prefix,
+            "elapsed_seconds": round(elapsed, 6),
+        }, sys.stdout, indent=2)
+        print()
+    if missing or wrong_prefix:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,20 +1,85 @@
 import argparse
 import asyncio
+import base64
+import json
+import multiprocessing
 import os
+import queue
 import re
+import socket
+import sys
+import time
+from urllib.parse import urlsplit
 import aiohttp
 from aiohttp import ClientError, ClientProxyConnectionError, ClientConnectionError, ClientResponseError, ClientTimeout
 from tqdm.asyncio import tqdm
+from egress_echo_server import run_echo_server
+from proxy_output import CREDENTIALS_FILENAME
+# Примеры использования (из директории проекта):
+# python3 ../../4_proxy_checker.py --project-name MyProject --concurrency 500
+#
+# 100 тысяч прокси на всех ядрах: 8 процессов, каждый со своим циклом событий
+# и своей долей параллелизма (2000 / 8), общий прогресс-бар и файл результатов:
+# python3 ../../4_proxy_checker.py --project-name MyProject --engine streams --concurrency 2000 --workers 8
+#
+# Легкий движок на потоках asyncio (только http-URL проверки) для больших пулов:
+# python3 ../../4_proxy_checker.py --project-name MyProject --engine streams --concurrency 2000 --connect-timeout 3
+#
+# Через свой сервер адреса клиента (egress_echo_server.py) со сверкой исходящего
+# адреса каждого порта с назначенным в proxy_configs:
+# python3 ../../4_proxy_checker.py --project-name MyProject --check-url http://[2001:db8::1]:8080/ --verify-egress
+#
+# Замер скорости проверки на локальном тестовом прокси (старый и новый способ):
+# python3 4_proxy_checker.py --benchmark 5000 --concurrency 200
 
 # Определение базовой директории для сгенерированных прокси
 BASE_PROXY_CONFIGS_DIR = "generated_proxy_configs"
 DEFAULT_CONCURRENCY = 20
+DEFAULT_TIMEOUT = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+ENGINES = ("aiohttp", "streams")
+# Процесс проверки (--workers) отправляет результаты пачками: по столько штук
+# или раз в столько секунд, если результаты приходят медленно
+RESULT_BATCH_SIZE = 256
+RESULT_BATCH_INTERVAL = 0.2
 DEFAULT_OUTPUT_FILENAME = "proxy_check_results.txt"
+# Файлы результатов сбрасываются на диск не реже, чем раз в столько секунд:
+# при аварийном завершении теряются только последние результаты
+RESULT_FLUSH_INTERVAL = 1.0
 CHECK_URL = "http://ifconfig.me/ip"
+# Запасной адрес, если CHECK_URL ответил 403 (только для публичного CHECK_URL)
+FALLBACK_CHECK_URL = "https://ip6.me"
+# Движок streams читает ответ прокси блоками до конца заголовков и тела, но
+# не больше этого размера (ответ сервера адреса клиента - несколько десятков байт)
+PROBE_READ_SIZE = 4096
+MAX_PROBE_RESPONSE_SIZE = 16384
+CONTENT_LENGTH_PATTERN = re.compile(rb"\r\ncontent-length:[ \t]*(\d+)", re.IGNORECASE)
+# Формат строки proxy_configs: ... proxy_ip:<ip> proxy_port:<порт> ipv6:<адрес>/<префикс>
+CREDENTIALS_EGRESS_PATTERN = re.compile(r"proxy_ip:(\S+) proxy_port:(\d+) ipv6:([0-9a-fA-F:]+)/")
+# Сколько секунд хранится результат DNS (адрес CHECK_URL и HTTPS-запасного адреса)
+DNS_CACHE_TTL = 300
 
-async def check_proxy(proxy_info: dict, semaphore: asyncio.Semaphore, timeout: int = 10, current_check_url: str = CHECK_URL, is_retry: bool = False) -> tuple:
+def create_session(concurrency: int, timeout: int = DEFAULT_TIMEOUT) -> aiohttp.ClientSession:
     """
-    Асинхронно проверяет один прокси.
+    Одна сессия на всю проверку: пул соединений размером с --concurrency и
+    кэш DNS. Соединения закрываются после ответа (force_close): ключ соединения
+    в пуле - адрес прокси и его учетные данные, у каждого прокси они свои, и
+    простаивающее соединение никогда не было бы использовано повторно, а
+    только держало бы дескриптор и поток 3proxy.
+    """
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=DNS_CACHE_TTL, force_close=True)
+    return aiohttp.ClientSession(connector=connector, timeout=ClientTimeout(total=timeout))
+
+def proxy_authorization(username: str, password: str) -> dict:
+    """Заголовок Proxy-Authorization (Basic) для запроса через общую сессию."""
+    credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Proxy-Authorization": f"Basic {credentials}"}
+
+async def check_proxy(proxy_info: dict, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, timeout: int = DEFAULT_TIMEOUT, current_check_url: str = CHECK_URL, is_retry: bool = False, fallback_url: str = FALLBACK_CHECK_URL) -> tuple:
+    """
+    Асинхронно проверяет один прокси через общую сессию (учетные данные
+    прокси передаются в каждом запросе). При ответе 403 повторяет запрос
+    через fallback_url, если он задан.
     Возвращает кортеж: (оригинальная_строка_прокси, статус_работоспособности, обнаруженный_IP, сообщение_об_ошибке)
     """
     proxy_string = proxy_info["original_string"]
@@ -23,20 +88,18 @@ async def check_proxy(proxy_info: dict, semaphore: asyncio.Semaphore, timeout: i
     username = proxy_info["username"]
     password = proxy_info["password"]
 
-    proxy_url = f"http://{username}:{password}@{ip}:{port}"
+    proxy_url = f"http://[{ip}]:{port}" if ":" in ip else f"http://{ip}:{port}"
 
     try:
         async with semaphore:
-            timeout_obj = ClientTimeout(total=timeout)
-            async with aiohttp.ClientSession(timeout=timeout_obj) as client:
-                async with client.get(current_check_url, proxy=proxy_url) as response:
-                    response.raise_for_status()  # Выбросит исключение для статусов 4xx/5xx
-                    detected_ip = await response.text()
-
-                detected_ip_stripped = detected_ip.strip()
-                # Проверяем, является ли обнаруженный IP IPv4-адресом
-                # Если proxy_info["ip"] - это IPv4, и ifconfig.me/ip возвращает IPv6, это означает, что прокси не был использован.
-                return (proxy_string, True, detected_ip_stripped, "")
+            async with session.get(current_check_url, proxy=proxy_url, proxy_headers=proxy_authorization(username, password)) as response:
+                response.raise_for_status()  # Выбросит исключение для статусов 4xx/5xx
+                detected_ip = await response.text()
+
+            detected_ip_stripped = detected_ip.strip()
+            # Проверяем, является ли обнаруженный IP IPv4-адресом
+            # Если proxy_info["ip"] - это IPv4, и ifconfig.me/ip возвращает IPv6, это означает, что прокси не был использован.
+            return (proxy_string, True, detected_ip_stripped, "")
     except ClientProxyConnectionError as e:
         return (proxy_string, False, "", f"Ошибка прокси ({type(e).__name__}): {e}")
     except (ClientConnectionError, ConnectionRefusedError) as e:
@@ -44,16 +107,274 @@ async def check_proxy(proxy_info: dict, semaphore: asyncio.Semaphore, timeout: i
     except asyncio.TimeoutError as e:
         return (proxy_string, False, "", f"Таймаут в {timeout} секунд ({type(e).__name__})")
     except ClientResponseError as e:
-        if e.status == 403 and not is_retry:
-            print(f"Получена ошибка 403 для {proxy_string}, повторная попытка с https://ip6.me")
+        if e.status == 403 and not is_retry and fallback_url:
+            print(f"Получена ошибка 403 для {proxy_string}, повторная попытка с {fallback_url}")
             # Повторная попытка с другим URL, указав, что это повторный запрос
-            return await check_proxy(proxy_info, semaphore, timeout, "https://ip6.me", True)
+            return await check_proxy(proxy_info, session, semaphore, timeout, fallback_url, True)
         return (proxy_string, False, "", f"HTTP ошибка статуса: {e.status}, URL: {e.request_info.url if e.request_info else 'N/A'} ({type(e).__name__})")
     except ClientError as e:
         return (proxy_string, False, "", f"Ошибка клиента AIOHTTP ({type(e).__name__}): {e}")
     except Exception as e:
         return (proxy_string, False, "", f"Неизвестная ошибка ({type(e).__name__}): {e}")
 
+def build_probe_request(check_url: str) -> tuple:
+    """
+    Запрос к прокси для движка streams, закодированный один раз: (начало, конец),
+    между ними вставляются учетные данные прокси в base64. Поддерживается только http.
+    """
+    parts = urlsplit(check_url)
+    if parts.scheme != "http" or not parts.netloc:
+        raise ValueError(f"движок streams поддерживает только http-URL проверки, получено: {check_url}")
+    request_head = f"GET {check_url} HTTP/1.1\r\nHost: {parts.netloc}\r\nProxy-Authorization: Basic ".encode()
+    request_tail = b"\r\nConnection: close\r\n\r\n"
+    return request_head, request_tail
+
+async def _read_probe_response(reader: asyncio.StreamReader) -> bytes:
+    """Читает ответ до конца тела (Content-Length), закрытия соединения или MAX_PROBE_RESPONSE_SIZE."""
+    response = b""
+    while len(response) < MAX_PROBE_RESPONSE_SIZE:
+        chunk = await reader.read(PROBE_READ_SIZE)
+        if not chunk:
+            break
+        response += chunk
+        header_end = response.find(b"\r\n\r\n")
+        if header_end >= 0:
+            match = CONTENT_LENGTH_PATTERN.search(response, 0, header_end + 2)
+            if match and len(response) >= header_end + 4 + int(match.group(1)):
+                break
+    return response
+
+class _Deadline:
+    """
+    Таймаут для await в движке streams без отдельной задачи на каждое ожидание
+    (asyncio.wait_for создает задачу, asyncio.timeout есть только с Python 3.11):
+    по таймеру отменяет текущую задачу, а отмена по таймеру превращается в
+    asyncio.TimeoutError. Внешняя отмена (Ctrl+C) проходит как есть.
+    """
+    __slots__ = ("delay", "handle", "expired")
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.handle = None
+        self.expired = False
+
+    def _expire(self, task):
+        self.expired = True
+        task.cancel()
+
+    def __enter__(self):
+        self.handle = asyncio.get_running_loop().call_later(self.delay, self._expire, asyncio.current_task())
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.handle.cancel()
+        if exc_type is asyncio.CancelledError and self.expired:
+            raise asyncio.TimeoutError() from exc
+        return False
+
+async def probe_proxy(proxy_info: dict, request: tuple, semaphore: asyncio.Semaphore, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_TIMEOUT) -> tuple:
+    """
+    Проверка прокси на голых потоках asyncio (--engine streams): соединение с
+    прокси, заранее закодированный запрос (request из build_probe_request),
+    строка статуса и небольшое тело ответа. Таймауты подключения и ответа раздельные.
+    Возвращает кортеж того же вида, что check_proxy.
+    """
+    proxy_string = proxy_info["original_string"]
+    request_head, request_tail = request
+    credentials = base64.b64encode(f"{proxy_info['username']}:{proxy_info['password']}".encode())
+    async with semaphore:
+        try:
+            with _Deadline(connect_timeout):
+                reader, writer = await asyncio.open_connection(proxy_info["ip"], proxy_info["port"])
+        except asyncio.TimeoutError as e:
+            return (proxy_string, False, "", f"Таймаут подключения к прокси в {connect_timeout} секунд ({type(e).__name__})")
+        except OSError as e:
+            return (proxy_string, False, "", f"Ошибка подключения к прокси ({type(e).__name__}): {e}")
+        try:
+            writer.write(request_head + credentials + request_tail)
+            with _Deadline(read_timeout):
+                response = await _read_probe_response(reader)
+        except asyncio.TimeoutError as e:
+            return (proxy_string, False, "", f"Таймаут ответа в {read_timeout} секунд ({type(e).__name__})")
+        except OSError as e:
+            return (proxy_string, False, "", f"Ошибка подключения ({type(e).__name__}): {e}")
+        finally:
+            writer.transport.abort()
+
+    status_line, _, rest = response.partition(b"\r\n")
+    status_parts = status_line.split(None, 2)
+    if len(status_parts) < 2 or not status_parts[0].startswith(b"HTTP/") or not status_parts[1].isdigit():
+        return (proxy_string, False, "", f"Некорректный ответ прокси: {status_line[:100]!r}")
+    status = int(status_parts[1])
+    if status == 407:
+        return (proxy_string, False, "", "Ошибка прокси: HTTP 407, учетные данные не приняты")
+    if status >= 400:
+        return (proxy_string, False, "", f"HTTP ошибка статуса: {status}")
+    detected_ip = rest.partition(b"\r\n\r\n")[2].decode("ascii", errors="replace").strip()
+    return (proxy_string, True, detected_ip, "")
+
+async def _legacy_check_proxy(proxy_info: dict, semaphore: asyncio.Semaphore, timeout: int = DEFAULT_TIMEOUT) -> tuple:
+    """Старый способ (для сравнения в --benchmark): новая сессия, пул и кэш DNS на каждый прокси."""
+    proxy_url = f"http://{proxy_info['username']}:{proxy_info['password']}@{proxy_info['ip']}:{proxy_info['port']}"
+    try:
+        async with semaphore:
+            async with aiohttp.ClientSession(timeout=ClientTimeout(total=timeout)) as client:
+                async with client.get(CHECK_URL, proxy=proxy_url) as response:
+                    response.raise_for_status()
+                    return (proxy_info["original_string"], True, (await response.text()).strip(), "")
+    except Exception as e:
+        return (proxy_info["original_string"], False, "", f"{type(e).__name__}: {e}")
+
+async def _measure(checks) -> tuple:
+    """Выполняет проверки. Возвращает (результаты, секунды, секунды CPU этого процесса)."""
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    results = await asyncio.gather(*checks)
+    return results, time.perf_counter() - started, time.process_time() - cpu_started
+
+async def run_benchmark(count: int, concurrency: int, timeout: int, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+    """
+    Проверяет count прокси, указывающих на локальный тестовый прокси: старым
+    способом (сессия на прокси), движком aiohttp (общая сессия) и движком streams.
+    Тестовый прокси - egress_echo_server в отдельном процессе (чтобы его работа
+    не попадала в замер CPU проверки): он отвечает адресом клиента на любой
+    запрос, в том числе на запрос к прокси.
+    """
+    port_queue = multiprocessing.Queue()
+    mock_proxy = multiprocessing.Process(target=run_echo_server, args=("127.0.0.1", 0, port_queue), daemon=True)
+    mock_proxy.start()
+    try:
+        port = port_queue.get(timeout=10)
+        proxies = [
+            {"original_string": f"127.0.0.1:{port}@user{index}:pass{index}", "ip": "127.0.0.1", "port": port,
+             "username": f"user{index}", "password": f"pass{index}"}
+            for index in range(count)
+        ]
+        semaphore = asyncio.Semaphore(concurrency)
+        measurements = [("Сессия на каждый прокси", *await _measure(
+            _legacy_check_proxy(proxy, semaphore, timeout) for proxy in proxies
+        ))]
+        async with create_session(concurrency, timeout) as session:
+            measurements.append(("Движок aiohttp", *await _measure(
+                check_proxy(proxy, session, semaphore, timeout) for proxy in proxies
+            )))
+        request = build_probe_request(CHECK_URL)
+        measurements.append(("Движок streams", *await _measure(
+            probe_proxy(proxy, request, semaphore, connect_timeout, timeout) for proxy in proxies
+        )))
+    finally:
+        mock_proxy.terminate()
+        mock_proxy.join()
+
+    for title, results, elapsed, cpu in measurements:
+        ok = sum(1 for result in results if result[1])
+        print(f"{title + ':':<25}{count / elapsed:>7.0f} проверок/с, CPU {cpu * 1000 / count:.3f} мс "
+              f"на проверку ({ok} из {count} успешно)")
+    (_, _, legacy_elapsed, legacy_cpu), (_, _, elapsed, cpu), (_, _, streams_elapsed, streams_cpu) = measurements
+    print(f"Общая сессия против сессии на прокси: ускорение x{legacy_elapsed / max(elapsed, 1e-9):.1f}, "
+          f"CPU меньше в {legacy_cpu / max(cpu, 1e-9):.1f} раза.")
+    print(f"streams против aiohttp: ускорение x{elapsed / max(streams_elapsed, 1e-9):.1f}, "
+          f"CPU меньше в {cpu / max(streams_cpu, 1e-9):.1f} раза (параллелизм {concurrency}).")
+
+async def check_proxies(proxies, args: argparse.Namespace, on_result):
+    """
+    Проверяет прокси из итератора proxies в текущем цикле событий движком
+    args.engine. Одновременно выполняется не больше args.concurrency проверок:
+    столько же обработчиков по очереди берут следующий прокси из общего
+    итератора, поэтому файл читается по мере проверки, а память не зависит от
+    размера пула. on_result((ip, порт), результат) вызывается по мере готовности.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    session = None
+    if args.engine == "streams":
+        request = build_probe_request(args.check_url)
+        make_check = lambda proxy: probe_proxy(proxy, request, semaphore, args.connect_timeout, args.timeout)
+    else:
+        fallback_url = FALLBACK_CHECK_URL if args.check_url == CHECK_URL else None
+        session = create_session(args.concurrency, args.timeout)
+        make_check = lambda proxy: check_proxy(proxy, session, semaphore, args.timeout, args.check_url, fallback_url=fallback_url)
+
+    proxies = iter(proxies)
+
+    async def run_checks():
+        for proxy in proxies:
+            on_result((proxy["ip"], proxy["port"]), await make_check(proxy))
+
+    try:
+        await asyncio.gather(*(run_checks() for _ in range(args.concurrency)))
+    finally:
+        if session is not None:
+            await session.close()
+
+def run_check_worker(worker_index: int, worker_count: int, proxy_file_path: str, args: argparse.Namespace, result_queue):
+    """
+    Процесс --workers: сам читает свою часть файла прокси (каждую worker_count-ю
+    строку), проверяет ее в собственном цикле событий и отправляет в
+    result_queue пачки ((ip, порт), результат). В конце отправляет None.
+    """
+    batch = []
+    last_flush = time.monotonic()
+
+    def on_result(proxy_key, result):
+        nonlocal batch, last_flush
+        batch.append((proxy_key, result))
+        now = time.monotonic()
+        if len(batch) >= RESULT_BATCH_SIZE or now - last_flush >= RESULT_BATCH_INTERVAL:
+            result_queue.put(batch)
+            batch = []
+            last_flush = now
+
+    try:
+        asyncio.run(check_proxies(iter_proxies(proxy_file_path, worker_index, worker_count), args, on_result))
+    except KeyboardInterrupt:
+        return
+    if batch:
+        result_queue.put(batch)
+    result_queue.put(None)
+
+async def check_proxies_in_workers(proxy_file_path: str, args: argparse.Namespace, on_result):
+    """
+    Делит файл прокси между args.workers процессами (строки через одну, чтобы
+    медленные диапазоны портов распределились равномерно), каждому - своя доля
+    args.concurrency. Результаты приходят пачками и передаются в
+    on_result((ip, порт), результат), как в check_proxies.
+    """
+    worker_count = args.workers
+    result_queue = multiprocessing.Queue()
+    processes = []
+    for worker_index in range(worker_count):
+        worker_concurrency = args.concurrency // worker_count + (1 if worker_index < args.concurrency % worker_count else 0)
+        worker_args = argparse.Namespace(**{**vars(args), "concurrency": max(1, worker_concurrency)})
+        processes.append(multiprocessing.Process(
+            target=run_check_worker,
+            args=(worker_index, worker_count, proxy_file_path, worker_args, result_queue),
+            daemon=True,
+        ))
+    for process in processes:
+        process.start()
+
+    loop = asyncio.get_running_loop()
+    finished_count = 0
+    try:
+        while finished_count < worker_count:
+            try:
+                batch = await loop.run_in_executor(None, result_queue.get, True, 1)
+            except queue.Empty:
+                for worker_index, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError(f"процесс проверки {worker_index} завершился с кодом {process.exitcode}")
+                continue
+            if batch is None:
+                finished_count += 1
+                continue
+            for proxy_key, result in batch:
+                on_result(proxy_key, result)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
 def parse_proxy_line(line: str) -> dict or None:
     """Парсит строку прокси в словарь."""
     # Ожидаемый формат: IP:PORT@USERNAME:PASSWORD
@@ -70,46 +391,123 @@ def parse_proxy_line(line: str) -> dict or None:
         }
     return None
 
-async def load_proxies(project_name: str) -> list:
+def iter_proxies(proxy_file_path: str, part: int = 0, parts: int = 1):
     """
-    Загружает прокси из файла extracted_proxy, расположенного в директории проекта.
+    Лениво читает прокси из файла (extracted_proxy в директории проекта).
+    part/parts - только каждая parts-я строка, начиная с part (часть процесса --workers).
     """
-    proxy_file_path = "extracted_proxy"
-    proxies = []
-    if not os.path.exists(proxy_file_path):
-        print(f"Ошибка: Файл прокси не найден по пути: {proxy_file_path}")
-        return []
-
     with open(proxy_file_path, 'r') as f:
-        for line in f:
+        for line_number, line in enumerate(f):
+            if line_number % parts != part:
+                continue
             proxy_data = parse_proxy_line(line)
             if proxy_data:
-                proxies.append(proxy_data)
-    print(f"Загружено {len(proxies)} прокси из {proxy_file_path}")
-    return proxies
-
-def write_results_to_file(results: list, output_filepath: str):
-    """
-    Записывает результаты проверки прокси в указанный файл.
-    """
-    with open(output_filepath, 'w') as f:
-        for original_string, is_working, detected_ip, error_message in results:
-            status = "РАБОТАЕТ" if is_working else "НЕ РАБОТАЕТ"
-            output_line = f"{original_string} - {status}"
-            if not is_working:
-                if detected_ip:
-                    output_line += f" (Фактический IP: {detected_ip}, Ошибка: {error_message})"
-                else:
-                    output_line += f" (Ошибка: {error_message})"
-            f.write(output_line + "\n")
-    print(f"Результаты проверки сохранены в: {output_filepath}")
+                yield proxy_data
+
+def count_proxies(proxy_file_path: str) -> int:
+    """Число прокси в файле (для прогресс-бара); файл читается построчно, в памяти не хранится."""
+    return sum(1 for _ in iter_proxies(proxy_file_path))
+
+def _pack_ip(address: str):
+    """Адрес в упакованном виде для сравнения (разные записи одного IPv6 совпадают) или None."""
+    for family in (socket.AF_INET6, socket.AF_INET):
+        try:
+            return socket.inet_pton(family, address)
+        except OSError:
+            continue
+    return None
+
+def load_egress_index(credentials_path: str) -> dict:
+    """
+    Индекс назначенных исходящих адресов из proxy_configs: (ip прокси, порт) -> адрес (-e).
+    Строится один раз; сверка результата - поиск в словаре.
+    """
+    egress_index = {}
+    with open(credentials_path, "r") as f:
+        for proxy_ip, port, ipv6_address in CREDENTIALS_EGRESS_PATTERN.findall(f.read()):
+            egress_index[(proxy_ip, int(port))] = ipv6_address
+    return egress_index
+
+def verify_egress(proxy_key: tuple, result: tuple, egress_index: dict) -> tuple:
+    """
+    Сверяет обнаруженный адрес работающего прокси (proxy_key - (ip, порт)) с
+    назначенным его порту. Возвращает результат как есть или неуспешный с
+    описанием расхождения.
+    """
+    proxy_string, is_working, detected_ip, _ = result
+    if not is_working:
+        return result
+    expected_ip = egress_index.get(proxy_key)
+    if expected_ip is None:
+        return (proxy_string, False, detected_ip, f"Порт {proxy_key[1]} не найден в {CREDENTIALS_FILENAME}")
+    if _pack_ip(detected_ip) != _pack_ip(expected_ip):
+        return (proxy_string, False, detected_ip, f"Исходящий адрес не совпадает с назначенным {expected_ip}")
+    return result
+
+def format_result_line(result: tuple) -> str:
+    """Строка текстового файла результатов."""
+    original_string, is_working, detected_ip, error_message = result
+    status = "РАБОТАЕТ" if is_working else "НЕ РАБОТАЕТ"
+    output_line = f"{original_string} - {status}"
+    if not is_working:
+        if detected_ip:
+            output_line += f" (Фактический IP: {detected_ip}, Ошибка: {error_message})"
+        else:
+            output_line += f" (Ошибка: {error_message})"
+    return output_line
+
+def get_jsonl_path(output_filepath: str) -> str:
+    """Файл результатов JSONL рядом с текстовым: proxy_check_results.txt -> proxy_check_results.jsonl."""
+    return f"{os.path.splitext(output_filepath)[0]}.jsonl"
+
+class ResultWriter:
+    """
+    Дописывает каждый результат в текстовый файл и в JSONL по мере готовности
+    (в порядке завершения проверок). Файлы сбрасываются на диск не реже раза
+    в RESULT_FLUSH_INTERVAL секунд и при закрытии, поэтому при прерывании
+    проверки уже полученные результаты сохраняются.
+    """
+
+    def __init__(self, output_filepath: str, jsonl_filepath: str):
+        self.output_filepath = output_filepath
+        self.jsonl_filepath = jsonl_filepath
+        self.text_file = None
+        self.jsonl_file = None
+        self.last_flush = 0.0
+        self.written_count = 0
+        self.working_count = 0
+
+    def __enter__(self):
+        self.text_file = open(self.output_filepath, 'w')
+        self.jsonl_file = open(self.jsonl_filepath, 'w')
+        self.last_flush = time.monotonic()
+        return self
+
+    def write(self, result: tuple):
+        original_string, is_working, detected_ip, error_message = result
+        self.text_file.write(format_result_line(result) + "\n")
+        self.jsonl_file.write(json.dumps(
+            {"proxy": original_string, "working": is_working, "detected_ip": detected_ip, "error": error_message},
+            ensure_ascii=False,
+        ) + "\n")
+        self.written_count += 1
+        self.working_count += is_working
+        now = time.monotonic()
+        if now - self.last_flush >= RESULT_FLUSH_INTERVAL:
+            self.text_file.flush()
+            self.jsonl_file.flush()
+            self.last_flush = now
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.text_file.close()
+        self.jsonl_file.close()
+        return False
 
 async def main():
     parser = argparse.ArgumentParser(description="Прокси-чекер с асинхронной проверкой.")
     parser.add_argument(
         "--project-name",
         type=str,
-        required=True,
         help="Имя проекта (название подпапки в generated_proxy_configs/, например 'mexc_5000')."
     )
     parser.add_argument(
@@ -124,41 +522,136 @@ async def main():
         default=DEFAULT_OUTPUT_FILENAME,
         help=f"Имя файла для сохранения результатов (по умолчанию: {DEFAULT_OUTPUT_FILENAME})."
     )
+    parser.add_argument(
+        "--jsonl-file",
+        type=str,
+        help="Файл результатов в формате JSONL, по строке на прокси (по умолчанию: имя --output-file с расширением .jsonl)."
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=DEFAULT_TIMEOUT,
+        help=f"Таймаут проверки одного прокси в секундах (по умолчанию: {DEFAULT_TIMEOUT})."
+    )
+    parser.add_argument(
+        "--check-url",
+        type=str,
+        default=CHECK_URL,
+        help=f"URL, который отвечает адресом клиента (по умолчанию: {CHECK_URL}; свой сервер - egress_echo_server.py). "
+             f"Запасной {FALLBACK_CHECK_URL} при ответе 403 используется только для URL по умолчанию."
+    )
+    parser.add_argument(
+        "--verify-egress",
+        action="store_true",
+        help=f"Сверять обнаруженный адрес с исходящим IPv6, назначенным порту в {CREDENTIALS_FILENAME}; "
+             f"прокси с другим адресом считаются неработающими."
+    )
     parser.add_argument(
         "--no-progress",
         action="store_true",
         help="Отключить отображение прогресс-бара."
     )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="aiohttp",
+        help="Движок проверки: aiohttp (по умолчанию; поддерживает https и запасной URL) или streams - "
+             "запрос на голых потоках asyncio, намного дешевле по CPU, только http-URL проверки."
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help=f"Движок streams: таймаут подключения к прокси в секундах (по умолчанию: {DEFAULT_CONNECT_TIMEOUT}); "
+             f"--timeout для него - таймаут ответа."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Число процессов проверки, каждый со своим циклом событий и долей --concurrency "
+             "(по умолчанию 1 - все в текущем процессе). Обычно - число ядер."
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="N",
+        help="Замерить скорость проверки N прокси на локальном тестовом прокси (старый способ и оба движка) и выйти."
+    )
     args = parser.parse_args()
 
+    if args.benchmark:
+        await run_benchmark(args.benchmark, args.concurrency, args.timeout, args.connect_timeout)
+        return
+    if not args.project_name:
+        parser.error("требуется --project-name")
+    if args.workers < 1:
+        parser.error("--workers должен быть не меньше 1")
+    if args.engine == "streams":
+        try:
+            build_probe_request(args.check_url)
+        except ValueError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            sys.exit(1)
+
     project_name = args.project_name
     concurrency = args.concurrency
     output_file = args.output_file
     show_progress = not args.no_progress
 
-    print(f"Запуск прокси-чекера для проекта '{project_name}' с параллелизмом {concurrency}...")
+    workers_note = f" в {args.workers} процессах" if args.workers > 1 else ""
+    print(f"Запуск прокси-чекера для проекта '{project_name}' с параллелизмом {concurrency}{workers_note}...")
 
-    proxies_to_check = await load_proxies(project_name)
-    if not proxies_to_check:
+    proxy_file_path = "extracted_proxy"
+    if not os.path.exists(proxy_file_path):
+        print(f"Ошибка: Файл прокси не найден по пути: {proxy_file_path}")
+        return
+    total_count = count_proxies(proxy_file_path)
+    print(f"Найдено {total_count} прокси в {proxy_file_path}")
+    if not total_count:
         print("Нет прокси для проверки. Завершение работы.")
         return
 
-    semaphore = asyncio.Semaphore(concurrency)
-    tasks = [asyncio.create_task(check_proxy(proxy, semaphore)) for proxy in proxies_to_check]
-
-    if show_progress:
-        # Использование tqdm.asyncio.tqdm в качестве асинхронного контекстного менеджера
-        # для отслеживания прогресса завершения задач.
-        # Задачи уже созданы выше с asyncio.create_task.
-        # await asyncio.gather(*tasks) будет ждать их завершения и собирать результаты.
-        with tqdm(total=len(proxies_to_check), desc="Проверка прокси") as pbar:
-            for f in asyncio.as_completed(tasks):
-                await f
-                pbar.update(1)
-    results = await asyncio.gather(*tasks)
-
-    write_results_to_file(results, output_file)
+    egress_index = None
+    if args.verify_egress:
+        if not os.path.exists(CREDENTIALS_FILENAME):
+            print(f"Ошибка: Файл {CREDENTIALS_FILENAME} не найден, сверка исходящих адресов невозможна.", file=sys.stderr)
+            sys.exit(1)
+        egress_index = load_egress_index(CREDENTIALS_FILENAME)
+
+    jsonl_file = args.jsonl_file or get_jsonl_path(output_file)
+    mismatched_count = 0
+    with ResultWriter(output_file, jsonl_file) as writer, \
+            tqdm(total=total_count, desc="Проверка прокси", disable=not show_progress) as pbar:
+        def on_result(proxy_key, result):
+            nonlocal mismatched_count
+            if egress_index is not None and result[1]:
+                result = verify_egress(proxy_key, result, egress_index)
+                mismatched_count += not result[1]
+            writer.write(result)
+            pbar.update(1)
+
+        try:
+            if args.workers > 1:
+                await check_proxies_in_workers(proxy_file_path, args, on_result)
+            else:
+                await check_proxies(iter_proxies(proxy_file_path), args, on_result)
+        except RuntimeError as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            pbar.close()
+            print(f"Результаты проверки ({writer.written_count} из {total_count}, работает {writer.working_count}) "
+                  f"сохранены в: {output_file} и {jsonl_file}")
+
+    if egress_index is not None:
+        print(f"Сверка исходящих адресов: {writer.working_count} совпадают, {mismatched_count} не совпадают "
+              f"с назначенными в {CREDENTIALS_FILENAME}.")
     print("Проверка прокси завершена.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Проверка прервана; уже полученные результаты сохранены.", file=sys.stderr)
+        sys.exit(130)
\ No newline at end of file
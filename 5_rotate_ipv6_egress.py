@@ -0,0 +1,257 @@
+import argparse
+import ipaddress
+import os
+import re
+import socket
+import sys
+import time
+from itertools import chain
+
+from ipv6_allocator import FIRST_PROXY_INCREMENT, HOST_OFFSET, format_ipv6_int, get_increment_layout
+from ipv6_binding import NEW_ADDRESSES_FILENAME, OLD_ADDRESSES_FILENAME, run_bind_script, write_bind_file
+from proxy_output import (
+    CREDENTIALS_FILENAME, FULL_CONFIG_FILENAME, atomic_open, config_has_monitor, count_shard_configs,
+    get_shard_config_path,
+)
+from range_allocator import RangeAllocator, count_in_ranges
+from state_store import STATE_FILENAME, get_draining_owner, migrate_legacy_state, state_transaction
+
+# Примеры использования:
+# Выдать всем прокси проекта новые исходящие IPv6-адреса (порты и логины не меняются):
+# sudo python3 5_rotate_ipv6_egress.py MyProject --interface ens3
+#
+# Завершить прерванную ротацию (отвязать старые адреса и вернуть их в пул):
+# sudo python3 5_rotate_ipv6_egress.py MyProject --interface ens3 --finish
+
+BASE_OUTPUT_DIR = "generated_proxy_configs"
+STATE_FILE = os.path.join(BASE_OUTPUT_DIR, STATE_FILENAME)
+
+# Сколько ждать после переключения конфигов, прежде чем отвязывать старые адреса:
+# за это время 3proxy перечитает конфиги, а открытые соединения успеют завершиться
+DEFAULT_DRAIN_SECONDS = 60
+
+CREDENTIALS_IPV6_PATTERN = re.compile(r"ipv6:([0-9a-fA-F:]+)/")
+
+def find_project_subnet(state, project_name, owner):
+    """
+    Находит (ipv4, подсеть), в которой за owner закреплены инкременты проекта.
+    Ротация поддерживается для проектов, все адреса которых взяты из одной подсети.
+    """
+    entries = [
+        (external_ipv4, subnet_str)
+        for external_ipv4, ipv4_state in state.items()
+        for subnet_str, subnet_state in ipv4_state.get("ipv6_subnets", {}).items()
+        if subnet_state.get("suffixes", {}).get(owner)
+    ]
+    if not entries:
+        return None
+    if len({subnet_str for _, subnet_str in entries}) > 1:
+        raise ValueError(f"Адреса проекта {project_name} взяты из нескольких подсетей, ротация не поддерживается.")
+    return entries[0]
+
+def allocate_rotation(state, project_name):
+    """
+    Переносит инкременты проекта на владельца <проект>@draining и выделяет
+    проекту столько же новых инкрементов в той же подсети - первых свободных
+    после старых, по кругу. Старые адреса остаются занятыми до отвязки. Возвращает (подсеть, старые_диапазоны, новые_диапазоны).
+    """
+    draining_owner = get_draining_owner(project_name)
+    if find_project_subnet(state, project_name, draining_owner):
+        raise ValueError(
+            f"Предыдущая ротация проекта {project_name} не завершена. "
+            f"Запустите скрипт с --finish, чтобы отвязать старые адреса."
+        )
+    location = find_project_subnet(state, project_name, project_name)
+    if location is None:
+        raise ValueError(f"В состоянии нет IPv6-адресов проекта {project_name}.")
+    external_ipv4, subnet_str = location
+    ipv6_network = ipaddress.IPv6Network(subnet_str, strict=True)
+    _, suffix_capacity = get_increment_layout(ipv6_network.prefixlen)
+
+    # Занятые инкременты подсети со всех IPv4; старые адреса проекта - уже под draining
+    used_suffixes = {}
+    for ipv4_state in state.values():
+        subnet_suffixes = ipv4_state.get("ipv6_subnets", {}).get(subnet_str, {}).get("suffixes", {})
+        for owner, runs in subnet_suffixes.items():
+            used_suffixes.setdefault(draining_owner if owner == project_name else owner, []).extend(runs)
+    suffix_allocator = RangeAllocator(FIRST_PROXY_INCREMENT, suffix_capacity, used_suffixes)
+    old_runs = suffix_allocator.owned(draining_owner)
+    rotate_count = count_in_ranges(old_runs)
+    if suffix_allocator.free_count < rotate_count:
+        raise ValueError(
+            f"В подсети {subnet_str} свободно {suffix_allocator.free_count} адресов, "
+            f"а для ротации нужно {rotate_count}."
+        )
+    # Новые адреса берутся сразу за старыми и дальше по кругу: наименьшее
+    # подходящее окно (allocate) вернуло бы адреса, освобожденные прошлой ротацией
+    new_runs = suffix_allocator.allocate_after(project_name, rotate_count, max(end for _, end in old_runs))
+    if suffix_allocator.free_count < rotate_count:
+        print(f"Предупреждение: в подсети {subnet_str} после ротации свободно {suffix_allocator.free_count} адресов "
+              f"(меньше {rotate_count}), следующая ротация вернет проекту часть адресов, освобождаемых этой.")
+
+    for ipv4_state in state.values():
+        ipv4_state.get("ipv6_subnets", {}).get(subnet_str, {}).get("suffixes", {}).pop(project_name, None)
+    subnet_suffixes = state[external_ipv4]["ipv6_subnets"][subnet_str]["suffixes"]
+    subnet_suffixes[project_name] = new_runs
+    subnet_suffixes[draining_owner] = old_runs
+    return ipv6_network, old_runs, new_runs
+
+def cancel_rotation(state, project_name):
+    """Возвращает проекту старые инкременты, освобождая выделенные для ротации."""
+    draining_owner = get_draining_owner(project_name)
+    for ipv4_state in state.values():
+        for subnet_state in ipv4_state.get("ipv6_subnets", {}).values():
+            subnet_suffixes = subnet_state.get("suffixes", {})
+            if draining_owner in subnet_suffixes:
+                subnet_suffixes[project_name] = subnet_suffixes.pop(draining_owner)
+
+def release_draining(state, project_name):
+    """Освобождает старые инкременты проекта после отвязки. Возвращает их количество."""
+    draining_owner = get_draining_owner(project_name)
+    released_count = 0
+    for ipv4_state in state.values():
+        for subnet_state in ipv4_state.get("ipv6_subnets", {}).values():
+            released_count += count_in_ranges(subnet_state.get("suffixes", {}).pop(draining_owner, []))
+    return released_count
+
+def build_address_map(credentials_path, ipv6_network, old_runs, new_runs):
+    """
+    Сопоставляет каждому адресу из proxy_configs новый адрес. Старый адрес
+    переводится в инкремент (так же учитываются адреса старых версий генератора
+    с другим смещением), инкременты сопоставляются по порядку.
+    """
+    network_int = int(ipv6_network.network_address)
+    shift, _ = get_increment_layout(ipv6_network.prefixlen)
+    new_increments = dict(zip(
+        chain.from_iterable(range(start, end) for start, end in old_runs),
+        chain.from_iterable(range(start, end) for start, end in new_runs),
+    ))
+    address_map = {}
+    with open(credentials_path, "r") as f:
+        for line in f:
+            match = CREDENTIALS_IPV6_PATTERN.search(line)
+            if not match or match.group(1) in address_map:
+                continue
+            old_address = match.group(1)
+            increment = (int.from_bytes(socket.inet_pton(socket.AF_INET6, old_address), "big") - network_int) >> shift
+            if increment not in new_increments:
+                raise ValueError(f"Адрес {old_address} из {credentials_path} не закреплен за проектом в состоянии.")
+            address_map[old_address] = format_ipv6_int(network_int + (new_increments[increment] << shift) + HOST_OFFSET)
+    return address_map
+
+def rewrite_config(config_path, address_map):
+    """Атомарно заменяет исходящие адреса (-e) в строках proxy конфига 3proxy."""
+    with open(config_path, "r") as src, atomic_open(config_path) as dst:
+        for line in src:
+            if line.startswith("proxy "):
+                head, separator, old_address = line.rstrip("\n").rpartition(" -e")
+                if separator and old_address in address_map:
+                    line = f"{head}{separator}{address_map[old_address]}\n"
+            dst.write(line)
+
+def rewrite_credentials(credentials_path, address_map):
+    """Атомарно заменяет адреса в proxy_configs; порты и учетные данные не меняются."""
+    with open(credentials_path, "r") as src, atomic_open(credentials_path) as dst:
+        for line in src:
+            match = CREDENTIALS_IPV6_PATTERN.search(line)
+            if match and match.group(1) in address_map:
+                line = f"{line[:match.start(1)]}{address_map[match.group(1)]}{line[match.end(1):]}"
+            dst.write(line)
+
+def finish_rotation(project_output_dir, project_name, interface):
+    """Отвязывает старые адреса из proxy_configs.old и возвращает их в пул."""
+    old_addresses_path = os.path.join(project_output_dir, OLD_ADDRESSES_FILENAME)
+    if os.path.exists(old_addresses_path):
+        print("Отвязка старых IPv6-адресов...")
+        if not run_bind_script(project_output_dir, project_name, interface, "del", OLD_ADDRESSES_FILENAME):
+            print("Старые адреса остаются занятыми. Повторите запуск с --finish.", file=sys.stderr)
+            sys.exit(1)
+        os.remove(old_addresses_path)
+    with state_transaction(STATE_FILE) as state:
+        released_count = release_draining(state, project_name)
+    print(f"Ротация проекта {project_name} завершена: освобождено {released_count} старых IPv6-адресов.")
+
+def rotate_project(project_name, interface, drain_seconds):
+    """
+    Выдает всем прокси проекта новые исходящие IPv6-адреса без остановки 3proxy:
+    новые адреса привязываются до переключения, конфиги подменяются атомарно
+    (3proxy перечитывает их по директиве monitor), старые адреса отвязываются
+    после паузы, когда открытые через них соединения завершатся.
+    """
+    project_output_dir = os.path.join(BASE_OUTPUT_DIR, project_name)
+    credentials_path = os.path.join(project_output_dir, CREDENTIALS_FILENAME)
+    if not os.path.exists(credentials_path):
+        print(f"Ошибка: Файл {credentials_path} не найден. Сначала сгенерируйте проект.", file=sys.stderr)
+        sys.exit(1)
+
+    started = time.perf_counter()
+    with state_transaction(STATE_FILE) as state:
+        migrate_legacy_state(state, BASE_OUTPUT_DIR)
+        ipv6_network, old_runs, new_runs = allocate_rotation(state, project_name)
+
+    try:
+        address_map = build_address_map(credentials_path, ipv6_network, old_runs, new_runs)
+    except ValueError:
+        with state_transaction(STATE_FILE) as state:
+            cancel_rotation(state, project_name)
+        raise
+    # Основной адрес сервера (инкремент 0 у проектов прежних версий) после
+    # ротации остается на интерфейсе
+    primary_address = format_ipv6_int(int(ipv6_network.network_address) + HOST_OFFSET)
+    write_bind_file(os.path.join(project_output_dir, OLD_ADDRESSES_FILENAME),
+                    (address for address in address_map if address != primary_address))
+    write_bind_file(os.path.join(project_output_dir, NEW_ADDRESSES_FILENAME), address_map.values())
+    print(f"Выделено {len(address_map)} новых IPv6-адресов в подсети {ipv6_network} "
+          f"за {time.perf_counter() - started:.2f} с.")
+
+    # Новые адреса должны быть на интерфейсе до того, как 3proxy начнет их использовать
+    print("Привязка новых IPv6-адресов...")
+    if not run_bind_script(project_output_dir, project_name, interface, "add", NEW_ADDRESSES_FILENAME):
+        with state_transaction(STATE_FILE) as state:
+            cancel_rotation(state, project_name)
+        os.remove(os.path.join(project_output_dir, OLD_ADDRESSES_FILENAME))
+        print("Ротация отменена, конфиги не изменены.", file=sys.stderr)
+        sys.exit(1)
+
+    started = time.perf_counter()
+    full_config_path = os.path.join(project_output_dir, FULL_CONFIG_FILENAME)
+    config_paths = [full_config_path] + [
+        os.path.join(project_output_dir, get_shard_config_path(shard_index))
+        for shard_index in range(count_shard_configs(project_output_dir))
+    ]
+    for config_path in config_paths:
+        rewrite_config(config_path, address_map)
+    rewrite_credentials(credentials_path, address_map)
+    print(f"Конфиги переключены на новые адреса за {time.perf_counter() - started:.2f} с.")
+    if not config_has_monitor(full_config_path):
+        print("Предупреждение: в конфигах проекта нет директивы monitor, 3proxy не перечитает их сам. "
+              "Перезапустите сервисы проекта, прежде чем старые адреса будут отвязаны.")
+
+    if drain_seconds > 0:
+        print(f"Ожидание {drain_seconds} с, пока завершатся соединения через старые адреса...")
+        time.sleep(drain_seconds)
+    finish_rotation(project_output_dir, project_name, interface)
+
+def main():
+    parser = argparse.ArgumentParser(description="Ротация исходящих IPv6-адресов прокси проекта без перезапуска 3proxy.")
+    parser.add_argument("project_name", help="Имя проекта в generated_proxy_configs.")
+    parser.add_argument("--interface", default=None, help="Сетевой интерфейс. Если не указан, определяется автоматически.")
+    parser.add_argument("--drain-seconds", type=int, default=DEFAULT_DRAIN_SECONDS,
+                        help=f"Пауза перед отвязкой старых адресов (по умолчанию {DEFAULT_DRAIN_SECONDS} с).")
+    parser.add_argument("--finish", action="store_true",
+                        help="Только завершить прерванную ротацию: отвязать старые адреса и освободить их.")
+    args = parser.parse_args()
+    if args.drain_seconds < 0:
+        parser.error("Пауза не может быть отрицательной.")
+
+    try:
+        if args.finish:
+            finish_rotation(os.path.join(BASE_OUTPUT_DIR, args.project_name), args.project_name, args.interface)
+        else:
+            rotate_project(args.project_name, args.interface, args.drain_seconds)
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
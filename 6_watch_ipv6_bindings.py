@@ -0,0 +1,265 @@
+import argparse
+import errno
+import os
+import re
+import signal
+import socket
+import sys
+import time
+
+import rtnetlink
+from ipv6_binding import NETWORK_FINGERPRINT_FILENAME, read_anyip_subnet, read_boot_id, read_network_fingerprint
+# Примеры использования:
+# Следить за адресами всех проектов и возвращать пропавшие (нужен root):
+# sudo python3 6_watch_ipv6_bindings.py
+#
+# Собирать удаления 5 секунд перед повторной привязкой, счетчики - раз в минуту:
+# sudo python3 6_watch_ipv6_bindings.py --debounce 5 --stats-interval 60
+
+BASE_OUTPUT_DIR = "generated_proxy_configs"
+# Окно, в течение которого удаления копятся перед одной пакетной привязкой
+DEFAULT_DEBOUNCE_SECONDS = 2.0
+# Как часто проверяются изменения файлов проектов (по mtime, без чтения адресов)
+DEFAULT_RESCAN_SECONDS = 30.0
+DEFAULT_STATS_SECONDS = 300.0
+# Сколько адресов привязывается одним пакетом netlink
+REPAIR_CHUNK_SIZE = 5000
+IPV6_ADDRESS_PATTERN = re.compile(r"ipv6:([0-9a-fA-F:]+)/(\d{1,3})")
+
+def log(message, stream=sys.stdout):
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", file=stream, flush=True)
+
+def format_ipv6(address):
+    return socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, "big"))
+
+def read_project_addresses(file_path):
+    """Адреса proxy_configs: словарь адрес (целое число) -> длина префикса."""
+    with open(file_path, "r") as f:
+        return {
+            int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big"): int(prefixlen)
+            for address, prefixlen in IPV6_ADDRESS_PATTERN.findall(f.read())
+        }
+
+def scan_projects(base_output_dir, boot_id):
+    """
+    Проекты, адреса которых должны быть привязаны: настройка сети выполнена в
+    текущей загрузке системы (есть отпечаток с тем же boot_id) и проект не в
+    режиме AnyIP. Отвязка всего проекта удаляет отпечаток, поэтому такие
+    проекты не восстанавливаются. Возвращает словарь имя -> (интерфейс, mtime
+    proxy_configs, mtime отпечатка).
+    """
+    projects = {}
+    if not os.path.isdir(base_output_dir):
+        return projects
+    for project_name in os.listdir(base_output_dir):
+        project_dir = os.path.join(base_output_dir, project_name)
+        fingerprint = read_network_fingerprint(project_dir)
+        if not fingerprint or fingerprint.get("boot_id") != boot_id or read_anyip_subnet(project_dir):
+            continue
+        try:
+            configs_mtime = os.stat(os.path.join(project_dir, "proxy_configs")).st_mtime_ns
+            fingerprint_mtime = os.stat(os.path.join(project_dir, NETWORK_FINGERPRINT_FILENAME)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        projects[project_name] = (fingerprint["interface"], configs_mtime, fingerprint_mtime)
+    return projects
+
+class BindingWatcher:
+    """
+    Индекс ожидаемых адресов всех проектов (индекс интерфейса -> адрес ->
+    (длина префикса, проект)) и реакция на события RTM_DELADDR / RTM_NEWADDR:
+    удаленные адреса и адреса с неудачной DAD копятся debounce секунд и
+    возвращаются одним пакетом netlink.
+    """
+
+    def __init__(self, base_output_dir, debounce):
+        self.base_output_dir = base_output_dir
+        self.debounce = debounce
+        self.boot_id = read_boot_id()
+        self.projects = {}
+        self.project_addresses = {}
+        self.expected = {}
+        self.interface_names = {}
+        self.pending = {}
+        self.dad_failed = set()
+        self.first_pending_at = None
+        self.counters = {"removed": 0, "dad_failed": 0, "repaired": 0, "already_present": 0, "failed": 0, "resyncs": 0}
+
+    def refresh_index(self):
+        """
+        Перечитывает только проекты, у которых изменились proxy_configs или
+        отпечаток. Возвращает True, если набор ожидаемых адресов изменился.
+        """
+        projects = scan_projects(self.base_output_dir, self.boot_id)
+        if projects == self.projects:
+            return False
+        for project_name, signature in projects.items():
+            if self.projects.get(project_name) != signature:
+                try:
+                    self.project_addresses[project_name] = read_project_addresses(
+                        os.path.join(self.base_output_dir, project_name, "proxy_configs"))
+                except OSError as e:
+                    log(f"Ошибка чтения адресов проекта {project_name}: {e}", sys.stderr)
+                    self.project_addresses[project_name] = {}
+        for project_name in set(self.project_addresses) - set(projects):
+            del self.project_addresses[project_name]
+        self.projects = projects
+
+        expected = {}
+        interface_names = {}
+        for project_name, (interface, _, _) in projects.items():
+            try:
+                interface_index = rtnetlink.get_interface_index(interface)
+            except OSError:
+                log(f"Интерфейс {interface} проекта {project_name} не найден, адреса проекта не отслеживаются.", sys.stderr)
+                continue
+            interface_names[interface_index] = interface
+            interface_expected = expected.setdefault(interface_index, {})
+            for address, prefixlen in self.project_addresses[project_name].items():
+                interface_expected[address] = (prefixlen, project_name)
+        self.expected = expected
+        self.interface_names = interface_names
+        log(f"Отслеживается {sum(len(addresses) for addresses in expected.values())} адресов "
+            f"{len(projects)} проектов на {len(interface_names)} интерфейсах.")
+        return True
+
+    def resync(self, rtnl):
+        """Один снимок каждого интерфейса: все недостающие ожидаемые адреса - в очередь."""
+        self.counters["resyncs"] += 1
+        for interface_index, addresses in self.expected.items():
+            bound_addresses = rtnl.get_ipv6_address_prefixes(self.interface_names[interface_index])
+            for address in addresses:
+                if address not in bound_addresses:
+                    self._mark_pending(interface_index, address)
+
+    def _mark_pending(self, interface_index, address):
+        self.pending.setdefault(interface_index, set()).add(address)
+        if self.first_pending_at is None:
+            self.first_pending_at = time.monotonic()
+
+    def handle_events(self, events):
+        for msg_type, interface_index, address, _, flags in events:
+            if address not in self.expected.get(interface_index, ()):
+                continue
+            if msg_type == rtnetlink.RTM_DELADDR:
+                self.counters["removed"] += 1
+                self._mark_pending(interface_index, address)
+            elif flags & rtnetlink.IFA_F_DADFAILED:
+                # Адрес остался на интерфейсе, но не используется: удалить и привязать с nodad
+                self.counters["dad_failed"] += 1
+                self.dad_failed.add((interface_index, address))
+                self._mark_pending(interface_index, address)
+            else:
+                pending = self.pending.get(interface_index)
+                if pending:
+                    pending.discard(address)
+
+    def repair_due(self):
+        return self.first_pending_at is not None and time.monotonic() - self.first_pending_at >= self.debounce
+
+    def seconds_until_repair(self):
+        if self.first_pending_at is None:
+            return None
+        return max(0.0, self.first_pending_at + self.debounce - time.monotonic())
+
+    def repair(self, rtnl):
+        """Привязывает накопленные адреса, которые все еще ожидаются (проекты могли измениться)."""
+        self.refresh_index()
+        pending, self.pending, self.first_pending_at = self.pending, {}, None
+        dad_failed, self.dad_failed = self.dad_failed, set()
+        for interface_index, addresses in pending.items():
+            expected = self.expected.get(interface_index, {})
+            batch = [(address, expected[address][0]) for address in addresses if address in expected]
+            if not batch:
+                continue
+            interface = self.interface_names[interface_index]
+            stale_dad = [
+                (format_ipv6(address), prefixlen)
+                for address, prefixlen in batch if (interface_index, address) in dad_failed
+            ]
+            if stale_dad:
+                rtnl.delete_addresses(interface, stale_dad)
+            repaired_count = 0
+            projects = {}
+            for chunk_start in range(0, len(batch), REPAIR_CHUNK_SIZE):
+                chunk = batch[chunk_start:chunk_start + REPAIR_CHUNK_SIZE]
+                errors = rtnl.add_addresses(interface, [(format_ipv6(address), prefixlen) for address, prefixlen in chunk])
+                for index, (address, prefixlen) in enumerate(chunk):
+                    error_code = errors.get(index)
+                    if error_code is None:
+                        repaired_count += 1
+                        project_name = expected[address][1]
+                        projects[project_name] = projects.get(project_name, 0) + 1
+                    elif rtnetlink.is_noop_error("add", error_code):
+                        self.counters["already_present"] += 1
+                    else:
+                        self.counters["failed"] += 1
+                        log(f"Ошибка: {format_ipv6(address)}/{prefixlen} на {interface}: {os.strerror(error_code)}", sys.stderr)
+            self.counters["repaired"] += repaired_count
+            if repaired_count:
+                per_project = ", ".join(f"{name}: {count}" for name, count in sorted(projects.items()))
+                log(f"Возвращено {repaired_count} адресов на {interface} ({per_project}).")
+
+    def format_counters(self):
+        return ", ".join(f"{name}={value}" for name, value in self.counters.items())
+
+def watch(base_output_dir, debounce, rescan_interval, stats_interval):
+    with rtnetlink.RtnetlinkSocket(groups=rtnetlink.RTMGRP_IPV6_IFADDR) as events, rtnetlink.RtnetlinkSocket() as rtnl:
+        watcher = BindingWatcher(base_output_dir, debounce)
+        # Подписка до снимка: удаления между снимком и подпиской не теряются
+        watcher.refresh_index()
+        watcher.resync(rtnl)
+        next_rescan = time.monotonic() + rescan_interval
+        next_stats = time.monotonic() + stats_interval
+        try:
+            watch_loop(watcher, events, rtnl, rescan_interval, stats_interval, next_rescan, next_stats)
+        except KeyboardInterrupt:
+            log(f"Остановка. Счетчики: {watcher.format_counters()}")
+
+def watch_loop(watcher, events, rtnl, rescan_interval, stats_interval, next_rescan, next_stats):
+    while True:
+        timeouts = [next_rescan - time.monotonic(), next_stats - time.monotonic()]
+        if watcher.seconds_until_repair() is not None:
+            timeouts.append(watcher.seconds_until_repair())
+        try:
+            watcher.handle_events(events.receive_address_events(max(0.0, min(timeouts))))
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # Буфер событий переполнен (массовое удаление): события потеряны, сверяем снимком
+            log("События netlink потеряны (ENOBUFS), выполняется сверка по снимку интерфейсов.", sys.stderr)
+            watcher.resync(rtnl)
+
+        now = time.monotonic()
+        if watcher.repair_due():
+            watcher.repair(rtnl)
+        if now >= next_rescan:
+            if watcher.refresh_index():
+                watcher.resync(rtnl)
+            next_rescan = now + rescan_interval
+        if now >= next_stats:
+            log(f"Счетчики: {watcher.format_counters()}")
+            next_stats = now + stats_interval
+
+def main():
+    parser = argparse.ArgumentParser(description="Отслеживание и восстановление привязки IPv6-адресов проектов по событиям netlink.")
+    parser.add_argument("--base-dir", default=BASE_OUTPUT_DIR, help=f"Директория проектов (по умолчанию {BASE_OUTPUT_DIR}).")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE_SECONDS,
+                        help=f"Сколько секунд копить удаления перед пакетной привязкой (по умолчанию {DEFAULT_DEBOUNCE_SECONDS}).")
+    parser.add_argument("--rescan-interval", type=float, default=DEFAULT_RESCAN_SECONDS,
+                        help=f"Как часто проверять изменения проектов, секунд (по умолчанию {DEFAULT_RESCAN_SECONDS}).")
+    parser.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_SECONDS,
+                        help=f"Как часто выводить счетчики, секунд (по умолчанию {DEFAULT_STATS_SECONDS}).")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("Ошибка: для привязки адресов через netlink нужны права root.", file=sys.stderr)
+        sys.exit(1)
+
+    # systemctl stop: завершение с выводом счетчиков, как по Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    log(f"Отслеживание адресов проектов в {args.base_dir} (окно {args.debounce} с).")
+    watch(args.base_dir, args.debounce, args.rescan_interval, args.stats_interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import os
+import resource
+import sys
+
+from proxy_output import count_shard_configs, get_shard_config_path
+# Примеры использования:
+# Показать, какие лимиты получит проект из 50000 прокси на 16 шардах на этом сервере:
+# python3 capacity_planner.py --proxies 50000 --shards 16
+#
+# Проверить, что лимиты unit-файла проекта согласованы с maxconn в конфигах шардов:
+# python3 capacity_planner.py --check-project MyProject
+
+# Сколько одновременных соединений в среднем ожидается на один прокси (порт)
+DEFAULT_CONNECTIONS_PER_PROXY = 64
+# 3proxy создает поток на соединение; размер стека потока (директива stacksize)
+LARGE_STACK_SIZE = 131072
+SMALL_STACK_SIZE = 65536
+# Буферы 3proxy и сокетов ядра на одно соединение (клиентская и исходящая сторона), оценка
+CONNECTION_BUFFERS_BYTES = 2 * 32768
+# Доля памяти сервера, которую можно отдать соединениям 3proxy
+MEMORY_BUDGET_SHARE = 0.8
+# Дескрипторы, которые процессу нужны помимо соединений (логи, конфиг, DNS, запас)
+RESERVED_FDS = 256
+# Нижняя и верхняя граница maxconn для одного процесса 3proxy
+MIN_MAXCONN = 128
+MAX_MAXCONN = 500000
+# Границы размера кеша DNS (записей)
+MIN_NSCACHE = 4096
+MAX_NSCACHE = 262144
+# timeouts: BYTE_SHORT BYTE_LONG STRING_SHORT STRING_LONG CONNECTION_SHORT CONNECTION_LONG DNS CHAIN
+DEFAULT_TIMEOUTS = (1, 5, 30, 60, 180, 1800, 15, 60)
+# При нехватке ресурсов простаивающие соединения закрываются раньше, освобождая потоки
+CONSTRAINED_TIMEOUTS = (1, 5, 30, 60, 60, 600, 15, 60)
+
+# Потоки процесса помимо потоков соединений (слушающие сокеты обслуживает один поток на порт)
+RESERVED_TASKS = 64
+# Память процесса помимо соединений (код, конфиг, кеш DNS) и запас сверх оценки
+BASE_MEMORY_BYTES = 64 << 20
+MEMORY_HEADROOM = 1.25
+# Прокси чувствительны к задержкам, а диск почти не используют
+SHARD_NICE = -5
+SHARD_IO_SCHEDULING_CLASS = "best-effort"
+
+LIMIT_LABELS = {"demand": "нагрузка", "fds": "дескрипторы", "memory": "память"}
+
+CAPACITY_REPORT_FILENAME = "capacity_report.txt"
+
+def _read_meminfo_bytes(field):
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def detect_host_resources():
+    """
+    Возвращает ресурсы сервера: число ядер, объем памяти в байтах и предел
+    открытых файлов на процесс. Шарды запускаются systemd, который может выдать
+    процессу до fs.nr_open дескрипторов (LimitNOFILE), поэтому берется он;
+    если он недоступен - жесткий RLIMIT_NOFILE текущего процесса.
+    """
+    memory_bytes = _read_meminfo_bytes("MemTotal")
+    if memory_bytes is None:
+        memory_bytes = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    try:
+        with open("/proc/sys/fs/nr_open", "r") as f:
+            fd_limit = int(f.read())
+    except (OSError, ValueError):
+        _, fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if fd_limit == resource.RLIM_INFINITY:
+            fd_limit = 1 << 20
+    return {"cores": os.cpu_count() or 1, "memory_bytes": memory_bytes, "fd_limit": fd_limit}
+
+def _next_power_of_two(value):
+    return 1 << max(0, value - 1).bit_length()
+
+def plan_capacity(num_proxies, shard_count, resources, connections_per_proxy=DEFAULT_CONNECTIONS_PER_PROXY):
+    """
+    Подбирает maxconn, nscache, stacksize и timeouts для одного процесса 3proxy
+    (шарда) проекта из num_proxies прокси. maxconn - наименьшее из ожидаемой
+    нагрузки, предела дескрипторов (два на соединение плюс слушающие сокеты)
+    и доли памяти сервера, приходящейся на шард. Возвращает словарь с параметрами
+    и оценками для отчета.
+    """
+    shard_count = max(1, shard_count)
+    ports_per_shard = -(-num_proxies // shard_count)
+    demand = ports_per_shard * connections_per_proxy
+
+    fd_ceiling = max(0, (resources["fd_limit"] - ports_per_shard - RESERVED_FDS) // 2)
+    memory_budget = int(resources["memory_bytes"] * MEMORY_BUDGET_SHARE)
+    # Большой стек - только если памяти хватает на ожидаемую нагрузку всех шардов
+    stacksize = LARGE_STACK_SIZE
+    if memory_budget // (LARGE_STACK_SIZE + CONNECTION_BUFFERS_BYTES) < demand * shard_count:
+        stacksize = SMALL_STACK_SIZE
+    connection_bytes = stacksize + CONNECTION_BUFFERS_BYTES
+    memory_ceiling = memory_budget // connection_bytes // shard_count
+
+    limits = {"demand": demand, "fds": fd_ceiling, "memory": memory_ceiling}
+    limited_by = min(limits, key=limits.get)
+    maxconn = max(MIN_MAXCONN, min(limits[limited_by], MAX_MAXCONN))
+    constrained = limited_by != "demand"
+
+    return {
+        "num_proxies": num_proxies,
+        "shard_count": shard_count,
+        "ports_per_shard": ports_per_shard,
+        "connections_per_proxy": connections_per_proxy,
+        "maxconn": maxconn,
+        "nscache": min(MAX_NSCACHE, max(MIN_NSCACHE, _next_power_of_two(maxconn))),
+        "stacksize": stacksize,
+        "timeouts": CONSTRAINED_TIMEOUTS if constrained else DEFAULT_TIMEOUTS,
+        "connection_bytes": connection_bytes,
+        "limits": limits,
+        "limited_by": limited_by,
+        "resources": resources,
+    }
+
+def format_capacity_report(plan):
+    """Краткий отчет: ресурсы сервера, выбранные параметры и потолок соединений."""
+    resources = plan["resources"]
+    limits = plan["limits"]
+    return (
+        f"Сервер: {resources['cores']} ядер, {resources['memory_bytes'] / (1 << 30):.1f} ГиБ памяти, "
+        f"до {resources['fd_limit']} дескрипторов на процесс\n"
+        f"Проект: {plan['num_proxies']} прокси, {plan['shard_count']} шардов по {plan['ports_per_shard']} портов, "
+        f"ожидается {plan['connections_per_proxy']} соединений на прокси\n"
+        f"Потолок соединений шарда: нагрузка {limits['demand']}, дескрипторы {limits['fds']}, "
+        f"память {limits['memory']} (ограничивает: {LIMIT_LABELS[plan['limited_by']]})\n"
+        f"maxconn {plan['maxconn']} на шард, всего до {plan['maxconn'] * plan['shard_count']} соединений\n"
+        f"Память на соединение: ~{plan['connection_bytes'] // 1024} КиБ (стек {plan['stacksize'] // 1024} КиБ + буферы), "
+        f"при полной загрузке ~{plan['maxconn'] * plan['shard_count'] * plan['connection_bytes'] / (1 << 30):.2f} ГиБ\n"
+        f"nscache {plan['nscache']}, stacksize {plan['stacksize']}, timeouts {' '.join(map(str, plan['timeouts']))}\n"
+    )
+
+def write_capacity_report(output_dir, plan):
+    """Сохраняет отчет в capacity_report.txt в директории проекта и возвращает путь."""
+    report_path = os.path.join(output_dir, CAPACITY_REPORT_FILENAME)
+    with open(report_path, "w") as f:
+        f.write(format_capacity_report(plan))
+    return report_path
+
+def plan_unit_limits(plan):
+    """
+    Лимиты systemd для одного шарда, согласованные с заголовками 3proxy:
+    дескрипторы - слушающие сокеты и по два на соединение, задачи - поток на
+    соединение и на каждый порт, память - оценка на maxconn соединений с запасом.
+    """
+    return {
+        "LimitNOFILE": plan["ports_per_shard"] + 2 * plan["maxconn"] + RESERVED_FDS,
+        "TasksMax": plan["ports_per_shard"] + plan["maxconn"] + RESERVED_TASKS,
+        "MemoryMax": int((plan["maxconn"] * plan["connection_bytes"] + BASE_MEMORY_BYTES) * MEMORY_HEADROOM),
+        "Nice": SHARD_NICE,
+        "IOSchedulingClass": SHARD_IO_SCHEDULING_CLASS,
+    }
+
+def get_shard_cpus(shard_index, shard_count, cores):
+    """
+    Ядра для шарда: ядра делятся между шардами непрерывными группами, а если
+    шардов больше, чем ядер, несколько шардов делят одно ядро. Возвращает строку
+    для CPUAffinity/AllowedCPUs ("3" или "4-7").
+    """
+    first = shard_index * cores // shard_count
+    last = max(first, (shard_index + 1) * cores // shard_count - 1)
+    return str(first) if first == last else f"{first}-{last}"
+
+def format_memory_bytes(value):
+    """Размер в формате systemd с суффиксом M (округление вверх)."""
+    return f"{-(-value // (1 << 20))}M"
+
+def parse_memory_bytes(value):
+    """Разбирает размер systemd (байты или суффиксы K/M/G/T); infinity - None."""
+    value = value.strip()
+    if value == "infinity":
+        return None
+    multipliers = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if value[-1:].upper() in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1].upper()])
+    return int(value)
+
+def read_unit_settings(unit_path):
+    """Настройки секции [Service] unit-файла в виде словаря ключ -> значение."""
+    settings = {}
+    section = None
+    with open(unit_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                section = line
+            elif section == "[Service]" and "=" in line and not line.startswith("#"):
+                key, value = line.split("=", 1)
+                settings[key] = value
+    return settings
+
+def read_shard_limits(config_path):
+    """Возвращает (maxconn, stacksize, количество портов) из конфига шарда 3proxy."""
+    maxconn = None
+    stacksize = SMALL_STACK_SIZE
+    port_count = 0
+    with open(config_path, "r") as f:
+        for line in f:
+            if line.startswith("proxy "):
+                port_count += 1
+            elif line.startswith("maxconn "):
+                maxconn = int(line.split()[1])
+            elif line.startswith("stacksize "):
+                stacksize = int(line.split()[1])
+    return maxconn, stacksize, port_count
+
+def _exceeds(settings, key, needed):
+    value = settings.get(key)
+    if value is None or value == "infinity":
+        return False
+    limit = parse_memory_bytes(value) if key == "MemoryMax" else int(value)
+    return limit is not None and limit < needed
+
+def check_unit_limits(project_output_dir, unit_filename):
+    """
+    Сверяет лимиты шаблона unit-файла с maxconn, stacksize и числом портов
+    каждого шарда. Возвращает список предупреждений (пустой, если все согласовано).
+    """
+    unit_path = os.path.join(project_output_dir, unit_filename)
+    if not os.path.exists(unit_path):
+        return [f"Unit-файл {unit_path} не найден."]
+    settings = read_unit_settings(unit_path)
+    warnings = []
+    for shard_index in range(count_shard_configs(project_output_dir)):
+        maxconn, stacksize, port_count = read_shard_limits(
+            os.path.join(project_output_dir, get_shard_config_path(shard_index))
+        )
+        if maxconn is None:
+            continue
+        needed_fds = port_count + 2 * maxconn
+        if _exceeds(settings, "LimitNOFILE", needed_fds):
+            warnings.append(f"Шард {shard_index}: LimitNOFILE={settings['LimitNOFILE']} меньше {needed_fds} "
+                            f"({port_count} портов и по два дескриптора на {maxconn} соединений).")
+        needed_tasks = port_count + maxconn
+        if _exceeds(settings, "TasksMax", needed_tasks):
+            warnings.append(f"Шард {shard_index}: TasksMax={settings['TasksMax']} меньше {needed_tasks} "
+                            f"(поток на каждый из {port_count} портов и {maxconn} соединений).")
+        needed_memory = maxconn * (stacksize + CONNECTION_BUFFERS_BYTES)
+        if _exceeds(settings, "MemoryMax", needed_memory):
+            warnings.append(f"Шард {shard_index}: MemoryMax={settings['MemoryMax']} не вмещает {maxconn} соединений "
+                            f"(нужно не меньше {format_memory_bytes(needed_memory)}).")
+    return warnings
+
+def main():
+    parser = argparse.ArgumentParser(description="Расчет лимитов 3proxy по ресурсам сервера.")
+    parser.add_argument("--proxies", type=int, default=None, help="Количество прокси в проекте.")
+    parser.add_argument("--shards", type=int, default=None, help="Количество шардов (по умолчанию - число ядер).")
+    parser.add_argument("--connections-per-proxy", type=int, default=DEFAULT_CONNECTIONS_PER_PROXY,
+                        help=f"Ожидаемое число одновременных соединений на прокси (по умолчанию {DEFAULT_CONNECTIONS_PER_PROXY}).")
+    parser.add_argument("--check-project", default=None,
+                        help="Сверить лимиты unit-файла проекта из generated_proxy_configs с конфигами его шардов.")
+    args = parser.parse_args()
+
+    if args.check_project:
+        project_output_dir = os.path.join("generated_proxy_configs", args.check_project)
+        warnings = check_unit_limits(project_output_dir, f"3proxy-{args.check_project}@.service")
+        for warning in warnings:
+            print(f"Предупреждение: {warning}", file=sys.stderr)
+        if warnings:
+            sys.exit(1)
+        print(f"Лимиты systemd проекта {args.check_project} согласованы с конфигами 3proxy.")
+        return
+    if args.proxies is None:
+        parser.error("Укажите --proxies или --check-project.")
+
+    resources = detect_host_resources()
+    shard_count = max(1, min(args.shards or resources["cores"], args.proxies))
+    print(format_capacity_report(plan_capacity(args.proxies, shard_count, resources, args.connections_per_proxy)), end="")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import sys
+# Примеры использования:
+# Запустить на своем сервере (все адреса, порт 8080) вместо ifconfig.me:
+# python3 egress_echo_server.py --port 8080
+#
+# Проверка прокси через него с контролем исходящего адреса (из директории проекта):
+# python3 ../../4_proxy_checker.py --project-name MyProject --check-url http://[2001:db8::1]:8080/ --verify-egress
+
+# Легкий HTTP-сервер, который на любой запрос отвечает адресом клиента
+# (аналог http://ifconfig.me/ip без ограничения частоты запросов)
+
+DEFAULT_ECHO_PORT = 8080
+ECHO_BACKLOG = 4096
+# Заголовки запроса длиннее этого не читаются (ответ все равно отправляется)
+MAX_REQUEST_HEADER_SIZE = 16384
+# Сколько секунд ждать заголовки запроса от клиента
+REQUEST_READ_TIMEOUT = 10
+IPV4_MAPPED_PREFIX = "::ffff:"
+
+def format_peer_address(address):
+    """Адрес клиента без IPv4-mapped префикса (сокет "::" принимает и IPv4)."""
+    if address.startswith(IPV4_MAPPED_PREFIX) and "." in address:
+        return address[len(IPV4_MAPPED_PREFIX):]
+    return address
+
+def build_echo_response(address):
+    body = address.encode()
+    return b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body)
+
+async def handle_echo(reader, writer):
+    """Отвечает адресом клиента на запрос и закрывает соединение."""
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_READ_TIMEOUT)
+        writer.write(build_echo_response(format_peer_address(writer.get_extra_info("peername")[0])))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def run_echo_server(host=None, port=DEFAULT_ECHO_PORT, port_queue=None):
+    """
+    Запускает сервер до прерывания. host=None - все адреса IPv4 и IPv6.
+    Если передан port_queue, в него кладется фактический порт (port=0 - любой свободный).
+    """
+    async def serve():
+        server = await asyncio.start_server(handle_echo, host, port, backlog=ECHO_BACKLOG, limit=MAX_REQUEST_HEADER_SIZE)
+        if port_queue is not None:
+            port_queue.put(server.sockets[0].getsockname()[1])
+        else:
+            listening = ", ".join(sorted({f"{s.getsockname()[0]}:{s.getsockname()[1]}" for s in server.sockets}))
+            print(f"Сервер адреса клиента слушает {listening}")
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP-сервер, отвечающий адресом клиента (цель проверки исходящих адресов прокси).")
+    parser.add_argument("--host", default=None, help="Адрес для прослушивания (по умолчанию все адреса IPv4 и IPv6).")
+    parser.add_argument("--port", type=int, default=DEFAULT_ECHO_PORT, help=f"Порт (по умолчанию {DEFAULT_ECHO_PORT}).")
+    args = parser.parse_args()
+
+    try:
+        run_echo_server(args.host, args.port)
+    except OSError as e:
+        print(f"Ошибка: не удалось запустить сервер на порту {args.port}: {e}", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
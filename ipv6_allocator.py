@@ -0,0 +1,134 @@
+import argparse
+import ipaddress
+import socket
+import time
+# Примеры использования:
+# Сравнить скорость со старым способом формирования адресов:
+# python3 ipv6_allocator.py --subnet 2a12:5940:dfaa::/48 --count 100000
+
+# Поддерживаемые длины префикса исходной подсети
+MIN_PREFIXLEN = 32
+MAX_PREFIXLEN = 64
+# Длина префикса, с которой адреса привязываются к интерфейсу
+BIND_PREFIXLEN = 64
+# Смещение адреса прокси внутри выделенного блока (::2)
+HOST_OFFSET = 2
+# Инкремент 0 - это сеть + HOST_OFFSET, основной адрес сервера, который
+# привязывает setup_network_ipv6.sh; прокси получают инкременты начиная с 1
+FIRST_PROXY_INCREMENT = 1
+
+def get_increment_layout(prefixlen):
+    """
+    Возвращает (сдвиг, емкость) для инкремента внутри подсети.
+    Для префиксов короче /64 инкремент занимает биты подсети до границы /64
+    (каждый прокси получает свою /64), для /64 - старшие 16 бит идентификатора
+    интерфейса, как и раньше.
+    """
+    if not MIN_PREFIXLEN <= prefixlen <= MAX_PREFIXLEN:
+        raise ValueError(
+            f"Неподдерживаемая длина префикса IPv6: {prefixlen}. "
+            f"Поддерживаются префиксы от /{MIN_PREFIXLEN} до /{MAX_PREFIXLEN}."
+        )
+    if prefixlen < 64:
+        return 64, 1 << (64 - prefixlen)
+    return 48, 1 << 16
+
+def allocate_ipv6_ints(network_int, prefixlen, start_increment, count):
+    """
+    Возвращает диапазон целочисленных адресов для инкрементов
+    start_increment .. start_increment + count - 1.
+    Биты инкремента не пересекаются с битами префикса, поэтому адреса образуют
+    арифметическую прогрессию с шагом 1 << сдвиг.
+    """
+    shift, capacity = get_increment_layout(prefixlen)
+    if start_increment < 0 or start_increment + count > capacity:
+        raise ValueError(
+            f"Инкременты {start_increment}..{start_increment + count - 1} не помещаются "
+            f"в подсеть /{prefixlen} (доступно {capacity})."
+        )
+    step = 1 << shift
+    first = network_int + (start_increment << shift) + HOST_OFFSET
+    return range(first, first + count * step, step)
+
+def format_ipv6_int(value):
+    """Форматирует целочисленный IPv6-адрес в сокращенную запись, как str(IPv6Address)."""
+    if value >> 48 == 0:
+        # inet_ntop выводит ::a.b.c.d для таких адресов, ipaddress - нет
+        return str(ipaddress.IPv6Address(value))
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, "big"))
+
+def render_ipv6_addresses(values):
+    """Пакетно форматирует целочисленные адреса в строки."""
+    inet_ntop = socket.inet_ntop
+    af_inet6 = socket.AF_INET6
+    return [
+        inet_ntop(af_inet6, value.to_bytes(16, "big")) if value >> 48 else format_ipv6_int(value)
+        for value in values
+    ]
+
+def allocate_ipv6_addresses(ipv6_network, start_increment, count):
+    """
+    Выделяет count адресов прокси из подсети ipv6_network (IPv6Network),
+    начиная с инкремента start_increment. Возвращает список строк.
+    """
+    return render_ipv6_addresses(
+        allocate_ipv6_ints(int(ipv6_network.network_address), ipv6_network.prefixlen, start_increment, count)
+    )
+
+def iter_ipv6_addresses(ipv6_network, start_increment, count):
+    """
+    Ленивый вариант allocate_ipv6_addresses: адреса форматируются по одному
+    по мере чтения, список целиком в памяти не хранится.
+    """
+    values = allocate_ipv6_ints(int(ipv6_network.network_address), ipv6_network.prefixlen, start_increment, count)
+    return map(format_ipv6_int, values)
+
+def _legacy_allocate(ipv6_network, start_increment, count):
+    """
+    Старый способ из generate_proxy_configs: объекты ipaddress на каждый адрес.
+    Для /48 строка "...::64" разбиралась как адрес, а не как /64, поэтому старый
+    способ давал ::66 вместо задуманного ::2 - сравниваем результаты только для /64.
+    """
+    addresses = []
+    base_address_parts = ipv6_network.exploded.split(':')[:3]
+    for increment in range(start_increment, start_increment + count):
+        if ipv6_network.prefixlen == 48:
+            new_subnet_str = f"{':'.join(base_address_parts)}:{format(increment, 'x')}::{BIND_PREFIXLEN}"
+            new_64_subnet = ipaddress.IPv6Network(new_subnet_str, strict=False)
+            addresses.append(str(ipaddress.IPv6Address(int(new_64_subnet.network_address) + HOST_OFFSET)))
+        else:
+            new_address_int = int(ipv6_network.network_address) + (increment << 48) + HOST_OFFSET
+            addresses.append(str(ipaddress.IPv6Address(new_address_int)))
+    return addresses
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер скорости выделения IPv6-адресов.")
+    parser.add_argument("--subnet", default="2a12:5940:dfaa::/48", help="IPv6 подсеть (/48 или /64 для сравнения со старым способом).")
+    parser.add_argument("--count", type=int, default=100000, help="Количество адресов (по умолчанию 100000).")
+    args = parser.parse_args()
+
+    ipv6_network = ipaddress.IPv6Network(args.subnet, strict=True)
+    _, capacity = get_increment_layout(ipv6_network.prefixlen)
+    # Если подсеть вмещает меньше адресов, чем запрошено, проходим ее несколько раз
+    passes = [min(capacity, args.count - done) for done in range(0, args.count, capacity)]
+
+    started = time.perf_counter()
+    new_addresses = [allocate_ipv6_addresses(ipv6_network, 0, count) for count in passes]
+    new_elapsed = time.perf_counter() - started
+
+    if ipv6_network.prefixlen not in (48, 64):
+        print(f"Выделено {args.count} адресов за {new_elapsed:.3f} с (старый способ поддерживал только /48 и /64).")
+        return
+
+    started = time.perf_counter()
+    legacy_addresses = [_legacy_allocate(ipv6_network, 0, count) for count in passes]
+    legacy_elapsed = time.perf_counter() - started
+
+    if ipv6_network.prefixlen == 64 and new_addresses != legacy_addresses:
+        print("Ошибка: результаты нового и старого способа не совпадают.")
+        return
+    print(f"Старый способ: {legacy_elapsed:.3f} с, новый: {new_elapsed:.3f} с, "
+          f"ускорение x{legacy_elapsed / max(new_elapsed, 1e-9):.1f} для {args.count} адресов.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+from ipv6_allocator import BIND_PREFIXLEN
+from proxy_output import atomic_open
+
+# Адреса, добавленные последним запуском с --append или ротацией (для привязки только новых адресов)
+NEW_ADDRESSES_FILENAME = "proxy_configs.new"
+# Адреса, замененные ротацией и ожидающие отвязки
+OLD_ADDRESSES_FILENAME = "proxy_configs.old"
+
+# Файл в директории проекта с подсетью режима AnyIP: если он есть, адреса не
+# привязываются по одному, а вся подсеть маршрутизируется локально (local <подсеть> dev lo)
+ANYIP_SUBNET_FILENAME = "anyip_subnet"
+NONLOCAL_BIND_SYSCTL = "/proc/sys/net/ipv6/ip_nonlocal_bind"
+
+# Отпечаток примененного сетевого состояния: с ним повторный запуск настройки
+# сети (перезапуск сервиса) не сверяет адреса с подсетями проекта заново,
+# а 6_watch_ipv6_bindings.py по нему отличает проекты, адреса которых должны быть привязаны
+NETWORK_FINGERPRINT_FILENAME = "network_fingerprint.json"
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+FINGERPRINT_READ_SIZE = 1 << 20
+
+BIND_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2_bind_ipv6_addresses.py")
+
+def write_bind_file(file_path, ipv6_addresses):
+    """
+    Записывает адреса в формате, который понимает 2_bind_ipv6_addresses.py
+    (строки "ipv6:<адрес>/64"). Возвращает количество записанных адресов.
+    """
+    written_count = 0
+    with atomic_open(file_path) as f:
+        for ipv6_address in ipv6_addresses:
+            f.write(f"ipv6:{ipv6_address}/{BIND_PREFIXLEN}\n")
+            written_count += 1
+    return written_count
+
+def read_boot_id():
+    """Идентификатор текущей загрузки системы (None, если недоступен)."""
+    try:
+        with open(BOOT_ID_PATH, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def get_network_fingerprint(file_path, interface, interface_index):
+    """
+    Отпечаток состояния, которое получится после привязки адресов из
+    file_path: загрузка системы (после перезагрузки адресов нет), интерфейс
+    с его индексом (пересозданный интерфейс - новый индекс) и sha256 файла.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(FINGERPRINT_READ_SIZE), b""):
+            digest.update(block)
+    return {
+        "boot_id": read_boot_id(),
+        "interface": interface,
+        "interface_index": interface_index,
+        "file": os.path.basename(file_path),
+        "sha256": digest.hexdigest(),
+    }
+
+def read_network_fingerprint(project_output_dir):
+    """Сохраненный отпечаток или None, если его нет или он поврежден."""
+    try:
+        with open(os.path.join(project_output_dir, NETWORK_FINGERPRINT_FILENAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_network_fingerprint(project_output_dir, fingerprint):
+    with atomic_open(os.path.join(project_output_dir, NETWORK_FINGERPRINT_FILENAME)) as f:
+        json.dump(fingerprint, f)
+
+def remove_network_fingerprint(project_output_dir):
+    """Адреса проекта отвязаны: отпечаток больше не описывает состояние сети."""
+    fingerprint_path = os.path.join(project_output_dir, NETWORK_FINGERPRINT_FILENAME)
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+
+def read_anyip_subnet(project_output_dir):
+    """Подсеть проекта в режиме AnyIP или None, если адреса привязываются по одному."""
+    try:
+        with open(os.path.join(project_output_dir, ANYIP_SUBNET_FILENAME), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_anyip_subnet(project_output_dir, ipv6_subnet):
+    """Включает (ipv6_subnet) или выключает (None) режим AnyIP для проекта."""
+    anyip_path = os.path.join(project_output_dir, ANYIP_SUBNET_FILENAME)
+    if ipv6_subnet is None:
+        if os.path.exists(anyip_path):
+            os.remove(anyip_path)
+        return
+    with open(anyip_path, "w") as f:
+        f.write(f"{ipv6_subnet}\n")
+
+def run_bind_script(project_output_dir, project_name, interface, action, filename):
+    """
+    Запускает 2_bind_ipv6_addresses.py для файла filename из директории проекта.
+    Если interface не указан, скрипт привязки определит его сам.
+    Возвращает True, если скрипт завершился успешно.
+    """
+    command = [sys.executable, BIND_SCRIPT_PATH, project_name, "--action", action, "--file", filename]
+    if interface:
+        command += ["--interface", interface]
+    try:
+        subprocess.run(command, cwd=project_output_dir, check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Ошибка при {'привязке' if action == 'add' else 'отвязке'} IPv6-адресов из {filename}: {e}", file=sys.stderr)
+        print(f"Команда: {' '.join(e.cmd)}", file=sys.stderr)
+        return False
+    return True
@@ -0,0 +1,113 @@
+import os
+import socket
+import sys
+
+# Слушающие TCP-сокеты текущего сетевого пространства имен: один проход по
+# /proc/net/tcp и /proc/net/tcp6 вместо проверки каждого порта отдельно
+
+PROC_NET_TCP_FILES = (("/proc/net/tcp", socket.AF_INET), ("/proc/net/tcp6", socket.AF_INET6))
+TCP_LISTEN_STATE = "0A"
+WILDCARD_ADDRESSES = {"0.0.0.0", "::"}
+IPV4_MAPPED_PREFIX = "::ffff:"
+THREE_PROXY_PROCESS_NAME = "3proxy"
+
+def parse_proc_net_address(hex_address, family):
+    """
+    Адрес из /proc/net/tcp*: 32-битные слова в порядке байт хоста (на x86 -
+    little-endian). IPv4-mapped IPv6 возвращается как IPv4.
+    """
+    packed = bytes.fromhex(hex_address)
+    if sys.byteorder == "little":
+        packed = b"".join(packed[i:i + 4][::-1] for i in range(0, len(packed), 4))
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    address = socket.inet_ntop(socket.AF_INET6, packed)
+    if address.startswith(IPV4_MAPPED_PREFIX) and "." in address:
+        return address[len(IPV4_MAPPED_PREFIX):]
+    return address
+
+def read_listening_sockets(proc_files=PROC_NET_TCP_FILES):
+    """
+    Индекс слушающих TCP-сокетов: словарь порт -> [(адрес, inode сокета), ...].
+    Строится один раз; проверка порта - поиск в словаре.
+    """
+    listeners = {}
+    for proc_path, family in proc_files:
+        try:
+            with open(proc_path, "r") as f:
+                next(f, None) # заголовок
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 10 or fields[3] != TCP_LISTEN_STATE:
+                        continue
+                    hex_address, hex_port = fields[1].split(":")
+                    listeners.setdefault(int(hex_port, 16), []).append(
+                        (parse_proc_net_address(hex_address, family), int(fields[9]))
+                    )
+        except FileNotFoundError:
+            continue
+    return listeners
+
+def get_config_project(config_path):
+    """Имя проекта по пути к конфигу 3proxy (<проект>/full_proxy_config или <проект>/shards/full_proxy_config.N)."""
+    project_dir = os.path.dirname(config_path)
+    if os.path.basename(project_dir) == "shards":
+        project_dir = os.path.dirname(project_dir)
+    return os.path.basename(project_dir) or None
+
+def find_3proxy_socket_owners():
+    """
+    Сокеты запущенных процессов 3proxy: словарь inode -> проект (по пути к
+    конфигу в командной строке; относительный путь - от рабочей директории
+    процесса, как у юнитов systemd и PM2). Просматриваются дескрипторы только
+    процессов 3proxy. Без прав root дескрипторы 3proxy, запущенного от другого
+    пользователя (setuid), прочитать нельзя - такие процессы считаются.
+    Возвращает (словарь, число процессов 3proxy с непрочитанными дескрипторами).
+    """
+    owners = {}
+    unreadable_count = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/comm", "r") as f:
+                if f.read().strip() != THREE_PROXY_PROCESS_NAME:
+                    continue
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                arguments = [argument.decode(errors="replace") for argument in f.read().split(b"\0") if argument]
+            fd_dir = f"/proc/{pid}/fd"
+            fds = os.listdir(fd_dir)
+            config_path = arguments[-1] if len(arguments) > 1 else None
+            if config_path and not os.path.isabs(config_path):
+                config_path = os.path.join(os.readlink(f"/proc/{pid}/cwd"), config_path)
+            project_name = get_config_project(config_path) if config_path else None
+            for fd in fds:
+                target = os.readlink(os.path.join(fd_dir, fd))
+                if target.startswith("socket:["):
+                    owners[int(target[8:-1])] = project_name
+        except PermissionError:
+            unreadable_count += 1
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return owners, unreadable_count
+
+def find_occupied_ports(listeners, listen_ipv4, start_port, end_port, socket_owners, project_name):
+    """
+    Порты из [start_port, end_port], которые нельзя слушать на listen_ipv4: на
+    них уже слушает сокет на этом адресе или на всех адресах. Сокеты 3proxy
+    самого проекта project_name (повторная генерация) занятыми не считаются.
+    Возвращает словарь порт -> проект, чей 3proxy занимает порт (None - другой процесс).
+    """
+    occupied = {}
+    for port, port_listeners in listeners.items():
+        if not start_port <= port <= end_port:
+            continue
+        for address, inode in port_listeners:
+            if address != listen_ipv4 and address not in WILDCARD_ADDRESSES:
+                continue
+            owner = socket_owners.get(inode)
+            if owner == project_name:
+                continue
+            occupied[port] = owner
+            break
+    return occupied
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack, contextmanager
+
+# Имена файлов, которые генератор создает в директории проекта
+FULL_CONFIG_FILENAME = "full_proxy_config"
+CREDENTIALS_FILENAME = "proxy_configs"
+EXTRACTED_PROXY_FILENAME = "extracted_proxy"
+# Поддиректория с фрагментами конфига для шардов (по одному процессу 3proxy на шард)
+SHARDS_DIRNAME = "shards"
+
+# Размер буфера записи: строки копятся в памяти и сбрасываются крупными блоками
+WRITE_BUFFER_SIZE = 1 << 20
+
+def format_proxy_line(port, external_ipv4, ipv6_address):
+    """Строка прокси для основного файла конфига 3proxy."""
+    return f"proxy -64 -n -a -p{port} -i{external_ipv4} -e{ipv6_address}"
+
+def format_credentials_line(username, password, external_ipv4, port, ipv6_address, prefixlen):
+    """Строка для файла proxy_configs (адрес сохраняется с длиной префикса для привязки)."""
+    return f"user:{username} pass:{password} proxy_ip:{external_ipv4} proxy_port:{port} ipv6:{ipv6_address}/{prefixlen}"
+
+def format_extracted_line(external_ipv4, port, username, password):
+    """Строка для файла extracted_proxy в формате ip:port@username:password."""
+    return f"{external_ipv4}:{port}@{username}:{password}"
+
+def get_shard_config_path(shard_index):
+    """Путь к конфигу шарда относительно директории проекта."""
+    return os.path.join(SHARDS_DIRNAME, f"{FULL_CONFIG_FILENAME}.{shard_index}")
+
+def get_shard_index(record_index, total_count, shard_count):
+    """
+    Номер шарда для записи: прокси делятся на shard_count непрерывных
+    диапазонов портов примерно одинакового размера.
+    """
+    return record_index * shard_count // total_count
+
+def remove_stale_shard_configs(output_dir, shard_count):
+    """Удаляет конфиги шардов, оставшиеся от прошлой генерации с большим числом шардов."""
+    shards_dir = os.path.join(output_dir, SHARDS_DIRNAME)
+    if not os.path.isdir(shards_dir):
+        return
+    prefix = f"{FULL_CONFIG_FILENAME}."
+    for filename in os.listdir(shards_dir):
+        suffix = filename[len(prefix):]
+        if filename.startswith(prefix) and suffix.isdigit() and int(suffix) >= shard_count:
+            os.remove(os.path.join(shards_dir, filename))
+
+@contextmanager
+def atomic_open(file_path, buffering=WRITE_BUFFER_SIZE):
+    """
+    Открывает временный файл рядом с file_path и после успешной записи
+    переименовывает его в file_path. Запущенный 3proxy никогда не увидит
+    наполовину записанный файл; при ошибке временный файл удаляется.
+    """
+    directory = os.path.dirname(file_path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", buffering=buffering) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644) # mkstemp создает файл с правами 0600
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def format_monitor_line(config_path):
+    """Директива monitor: 3proxy сам перечитывает конфиг, когда файл меняется."""
+    return f"monitor {os.path.abspath(config_path)}\n"
+
+def config_has_monitor(config_path):
+    """Проверяет, есть ли в заголовках конфига директива monitor."""
+    with open(config_path, "r") as f:
+        for line in f:
+            if line.startswith("monitor "):
+                return True
+            if line.startswith("proxy "):
+                return False # Заголовки закончились
+    return False
+
+def count_shard_configs(output_dir):
+    """Количество конфигов шардов проекта (shards/full_proxy_config.0, .1, ...)."""
+    shard_count = 0
+    while os.path.exists(os.path.join(output_dir, get_shard_config_path(shard_count))):
+        shard_count += 1
+    return shard_count
+
+def _start_output(f, file_path, append, is_config, headers):
+    """
+    Начинает выходной файл: при дозаписи копирует текущее содержимое file_path,
+    иначе пишет заголовки. В конфиги 3proxy добавляется директива monitor,
+    если ее еще нет.
+    """
+    if not append:
+        if is_config:
+            f.write(headers)
+            f.write(format_monitor_line(file_path))
+        return
+    if is_config and not config_has_monitor(file_path):
+        f.write(format_monitor_line(file_path))
+    with open(file_path, "r") as existing:
+        shutil.copyfileobj(existing, f, WRITE_BUFFER_SIZE)
+
+def write_proxy_outputs(output_dir, headers, records, username, password, prefixlen, total_count=0, shard_count=0, append=False,
+                        full_config_headers=None):
+    """
+    За один проход записывает full_proxy_config, proxy_configs и extracted_proxy.
+    records - итерируемый объект кортежей (port, external_ipv4, ipv6_address);
+    каждая запись сразу уходит во все файлы, поэтому потребление памяти
+    не зависит от количества прокси. Если задан shard_count, строки прокси
+    дополнительно раскладываются по shards/full_proxy_config.<N> (для этого нужен
+    total_count - ожидаемое число записей). full_config_headers - заголовки
+    full_proxy_config, если они отличаются от заголовков шардов headers.
+    С append=True записи дописываются к существующим файлам (заголовки не нужны),
+    каждый файл по-прежнему подменяется атомарно. Возвращает количество записанных прокси.
+    """
+    written_count = 0
+    with ExitStack() as stack:
+        outputs = []
+        for filename, is_config in (
+            (FULL_CONFIG_FILENAME, True),
+            (CREDENTIALS_FILENAME, False),
+            (EXTRACTED_PROXY_FILENAME, False),
+        ):
+            file_path = os.path.join(output_dir, filename)
+            f = stack.enter_context(atomic_open(file_path))
+            _start_output(f, file_path, append, is_config, headers if full_config_headers is None else full_config_headers)
+            outputs.append(f)
+        config_file, credentials_file, extracted_file = outputs
+
+        shard_files = []
+        if shard_count:
+            os.makedirs(os.path.join(output_dir, SHARDS_DIRNAME), exist_ok=True)
+            for shard_index in range(shard_count):
+                shard_path = os.path.join(output_dir, get_shard_config_path(shard_index))
+                shard_file = stack.enter_context(atomic_open(shard_path))
+                _start_output(shard_file, shard_path, append, True, headers)
+                shard_files.append(shard_file)
+
+        for port, external_ipv4, ipv6_address in records:
+            proxy_line = format_proxy_line(port, external_ipv4, ipv6_address) + "\n"
+            config_file.write(proxy_line)
+            if shard_files:
+                shard_files[get_shard_index(written_count, total_count, shard_count)].write(proxy_line)
+            credentials_file.write(format_credentials_line(username, password, external_ipv4, port, ipv6_address, prefixlen) + "\n")
+            extracted_file.write(format_extracted_line(external_ipv4, port, username, password) + "\n")
+            written_count += 1
+
+    if shard_count and not append:
+        remove_stale_shard_configs(output_dir, shard_count)
+    return written_count
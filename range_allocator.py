@@ -0,0 +1,159 @@
+from bisect import bisect_left, bisect_right, insort
+
+# Диапазоны везде полуоткрытые: [start, end) - end не входит в диапазон.
+# В файле состояния они хранятся как списки [start, end].
+
+def ranges_from_values(values):
+    """Сворачивает набор целых чисел в отсортированный список диапазонов [start, end)."""
+    ranges = []
+    for value in sorted(set(values)):
+        if ranges and ranges[-1][1] == value:
+            ranges[-1][1] = value + 1
+        else:
+            ranges.append([value, value + 1])
+    return ranges
+
+def count_in_ranges(ranges):
+    """Количество значений в списке диапазонов."""
+    return sum(end - start for start, end in ranges)
+
+class RangeAllocator:
+    """
+    Выделяет непрерывные диапазоны целых чисел (порты, инкременты IPv6) из
+    [lower, upper) и помнит, какому проекту принадлежит каждый диапазон.
+
+    Свободное пространство хранится как список интервалов, отсортированный по
+    началу (для слияния соседей при освобождении), и как список (длина, начало)
+    для поиска наименьшего подходящего интервала. Поиск в обоих - bisect,
+    O(log n) по числу интервалов; вставка/удаление - сдвиг элементов списка.
+    """
+
+    def __init__(self, lower, upper, owners=None):
+        self.lower = lower
+        self.upper = upper
+        self.owners = {
+            owner: [list(run) for run in runs]
+            for owner, runs in (owners or {}).items()
+            if runs
+        }
+        self._free_starts = []
+        self._free_ends = {}
+        self._free_by_size = []
+        self.free_count = 0
+
+        # Свободные интервалы - дополнение к объединению всех занятых диапазонов
+        used = sorted(
+            (max(start, lower), min(end, upper))
+            for runs in self.owners.values()
+            for start, end in runs
+            if start < upper and end > lower
+        )
+        cursor = lower
+        for start, end in used:
+            if start > cursor:
+                self._add_free(cursor, start)
+            cursor = max(cursor, end)
+        if cursor < upper:
+            self._add_free(cursor, upper)
+
+    def _add_free(self, start, end):
+        insort(self._free_starts, start)
+        self._free_ends[start] = end
+        insort(self._free_by_size, (end - start, start))
+        self.free_count += end - start
+
+    def _remove_free(self, start):
+        end = self._free_ends.pop(start)
+        del self._free_starts[bisect_left(self._free_starts, start)]
+        del self._free_by_size[bisect_left(self._free_by_size, (end - start, start))]
+        self.free_count -= end - start
+        return end
+
+    def allocate(self, owner, count):
+        """
+        Выделяет owner до count значений. Сначала ищется наименьший свободный
+        интервал, вмещающий count целиком; если такого нет, берутся самые большие
+        интервалы по очереди. Возвращает список выделенных диапазонов [start, end)
+        в порядке возрастания; если свободного места меньше count, выделяется сколько есть.
+        """
+        runs = []
+        while count > 0 and self._free_by_size:
+            index = bisect_left(self._free_by_size, (count, self.lower))
+            if index == len(self._free_by_size):
+                index -= 1 # Целиком не помещается - берем самый большой интервал
+            size, start = self._free_by_size[index]
+            end = self._remove_free(start)
+            taken = min(size, count)
+            if taken < size:
+                self._add_free(start + taken, end)
+            runs.append([start, start + taken])
+            count -= taken
+        return self._assign(owner, runs)
+
+    def allocate_after(self, owner, count, cursor):
+        """
+        Выделяет owner до count значений первыми свободными от cursor и дальше
+        по кругу (после upper - снова от lower). В отличие от allocate, не
+        возвращает освободившееся только что "окно": повторные вызовы с cursor
+        за концом прошлого выделения проходят все свободное пространство по очереди.
+        Возвращает список выделенных диапазонов [start, end) в порядке возрастания.
+        """
+        runs = []
+        while count > 0 and self.free_count:
+            index = bisect_right(self._free_starts, cursor) - 1
+            if index < 0 or self._free_ends[self._free_starts[index]] <= cursor:
+                index += 1
+                if index == len(self._free_starts):
+                    cursor = self.lower
+                    continue
+            free_start = self._free_starts[index]
+            start = max(free_start, cursor)
+            free_end = self._remove_free(free_start)
+            taken = min(free_end - start, count)
+            if free_start < start:
+                self._add_free(free_start, start)
+            if start + taken < free_end:
+                self._add_free(start + taken, free_end)
+            runs.append([start, start + taken])
+            count -= taken
+            cursor = start + taken
+        return self._assign(owner, runs)
+
+    def _assign(self, owner, runs):
+        """Записывает выделенные диапазоны за owner; соседние диапазоны сливаются."""
+        merged = []
+        for start, end in sorted(runs):
+            if merged and merged[-1][1] == start:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        if merged:
+            owned = self.owners.setdefault(owner, [])
+            owned.extend(merged)
+            owned.sort()
+        return merged
+
+    def release(self, owner):
+        """Возвращает все диапазоны owner в свободное пространство. Возвращает количество освобожденных значений."""
+        released_count = 0
+        for start, end in self.owners.pop(owner, []):
+            start, end = max(start, self.lower), min(end, self.upper)
+            if start >= end:
+                continue
+            released_count += end - start
+            # Сливаем с соседним свободным интервалом слева
+            index = bisect_right(self._free_starts, start) - 1
+            if index >= 0:
+                left_start = self._free_starts[index]
+                if self._free_ends[left_start] == start:
+                    self._remove_free(left_start)
+                    start = left_start
+            # ...и справа
+            if end in self._free_ends:
+                end = self._remove_free(end)
+            self._add_free(start, end)
+        return released_count
+
+    def owned(self, owner):
+        """Диапазоны, принадлежащие owner."""
+        return self.owners.get(owner, [])
@@ -361,19 +361,20 @@ if __name__ == "__main__":
             print(f"Ошибка при запуске proxy_checker.sh для {current_project_name}. Продолжаем со следующей пачкой.")
             continue
         
-        # Скачиваем файл proxy_check_results.txt для текущей пачки
-        print(f"\n--- Скачивание proxy_check_results.txt для {current_project_name} ---")
-        proxy_results_remote_path = os.path.join(ACTUAL_CLONE_DIR, f"generated_proxy_configs/{current_project_name}/proxy_check_results.txt")
-        proxy_results_local_path = os.path.join(batch_output_dir, "proxy_check_results.txt")
+        # Скачиваем результаты проверки для текущей пачки: текстовые и те же в JSONL
+        for proxy_results_filename in ("proxy_check_results.txt", "proxy_check_results.jsonl"):
+            print(f"\n--- Скачивание {proxy_results_filename} для {current_project_name} ---")
+            proxy_results_remote_path = os.path.join(ACTUAL_CLONE_DIR, f"generated_proxy_configs/{current_project_name}/{proxy_results_filename}")
+            proxy_results_local_path = os.path.join(batch_output_dir, proxy_results_filename)
 
-        download_file_sftp(
-            hostname=REMOTE_HOST,
-            username=REMOTE_USER,
-            password=AUTH_PASSWORD,
-            key_filepath=AUTH_KEY_FILEPATH,
-            remote_path=proxy_results_remote_path,
-            local_path=proxy_results_local_path
-        )
-        print(f"Результаты проверки прокси для {current_project_name} сохранены в: {proxy_results_local_path}")
+            download_file_sftp(
+                hostname=REMOTE_HOST,
+                username=REMOTE_USER,
+                password=AUTH_PASSWORD,
+                key_filepath=AUTH_KEY_FILEPATH,
+                remote_path=proxy_results_remote_path,
+                local_path=proxy_results_local_path
+            )
+        print(f"Результаты проверки прокси для {current_project_name} сохранены в: {batch_output_dir}")
     
     print(f"\n--- Все пачки обработаны. Результаты сохранены в папке: {project_output_dir} ---")
@@ -0,0 +1,314 @@
+import errno
+import os
+import socket
+import struct
+# Минимальный клиент rtnetlink (Linux): добавление и удаление IPv6-адресов,
+# чтение адресов и маршрута по умолчанию без запуска ip и разбора его вывода.
+#
+# Пример:
+# with RtnetlinkSocket() as rtnl:
+#     errors = rtnl.add_addresses("eth0", [("2a03:a03:a03:1::2", 64)])
+#
+# Подписка на события IPv6-адресов:
+# with RtnetlinkSocket(groups=RTMGRP_IPV6_IFADDR) as events:
+#     for msg_type, index, address, prefixlen, flags in events.receive_address_events(1.0):
+#         ...
+
+NETLINK_ROUTE = 0
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+# Адрес сразу пригоден к использованию, без Duplicate Address Detection
+IFA_F_NODAD = 0x02
+# Duplicate Address Detection обнаружил конфликт: адрес есть, но не используется
+IFA_F_DADFAILED = 0x08
+
+# Группа multicast-рассылки событий IPv6-адресов (RTNLGRP_IPV6_IFADDR = 9)
+RTMGRP_IPV6_IFADDR = 1 << (9 - 1)
+
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RTN_UNICAST = 1
+RTNH_F_ONLINK = 4
+
+NLMSG_HEADER = struct.Struct("=IHHII")   # длина, тип, флаги, seq, pid
+IFADDRMSG = struct.Struct("=BBBBi")      # семейство, длина префикса, флаги, scope, индекс интерфейса
+RTMSG = struct.Struct("=BBBBBBBBI")      # семейство, dst_len, src_len, tos, таблица, протокол, scope, тип, флаги
+RTATTR_HEADER = struct.Struct("=HH")     # длина, тип
+NLMSGERR = struct.Struct("=i")
+# Заголовок атрибута IFA_ADDRESS с IPv6-адресом
+IPV6_ADDRESS_RTATTR = RTATTR_HEADER.pack(RTATTR_HEADER.size + 16, IFA_ADDRESS)
+
+# Сколько запросов отправляется одним sendto, прежде чем собирать подтверждения
+DEFAULT_WINDOW = 512
+RECV_BUFFER_SIZE = 1 << 20
+
+def _align(length):
+    return (length + 3) & ~3
+
+def _rtattr(attr_type, payload):
+    length = RTATTR_HEADER.size + len(payload)
+    return RTATTR_HEADER.pack(length, attr_type) + payload + b"\0" * (_align(length) - length)
+
+def _parse_rtattrs(data):
+    """Разбирает последовательность rtattr. Возвращает словарь тип -> содержимое."""
+    attrs = {}
+    offset = 0
+    while offset + RTATTR_HEADER.size <= len(data):
+        length, attr_type = RTATTR_HEADER.unpack_from(data, offset)
+        if length < RTATTR_HEADER.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR_HEADER.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+def _parse_address_message(data):
+    """
+    Разбирает ifaddrmsg с атрибутами. Возвращает (семейство, длина префикса,
+    флаги, индекс интерфейса, адрес целым числом или None).
+    """
+    family, prefixlen, flags, _, index = IFADDRMSG.unpack_from(data)
+    address_start = IFADDRMSG.size + RTATTR_HEADER.size
+    if data[IFADDRMSG.size:address_start] == IPV6_ADDRESS_RTATTR:
+        # Обычный случай: ядро первым атрибутом передает IFA_ADDRESS
+        # (IFA_LOCAL у IPv6 бывает только на point-to-point), без разбора всех атрибутов
+        packed = data[address_start:address_start + 16]
+    else:
+        attrs = _parse_rtattrs(data[IFADDRMSG.size:])
+        packed = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if IFA_FLAGS in attrs:
+            flags = struct.unpack("=I", attrs[IFA_FLAGS])[0]
+    return family, prefixlen, flags, index, int.from_bytes(packed, "big") if packed else None
+
+def get_interface_index(interface):
+    """Индекс интерфейса по имени. OSError, если интерфейса нет."""
+    return socket.if_nametoindex(interface)
+
+class RtnetlinkSocket:
+    """
+    Сокет AF_NETLINK/NETLINK_ROUTE. Запросы отправляются окнами по window
+    сообщений в одном sendto, подтверждения (NLMSG_ERROR с кодом 0 или
+    ошибкой) собираются по номеру seq, поэтому ошибка каждого адреса известна
+    без разбора текстового вывода.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, groups=0):
+        self.window = window
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        # groups - маска групп событий (RTMGRP_*); сокету с подпиской не стоит
+        # отправлять запросы: события будут перемешаны с ответами
+        self.sock.bind((0, groups))
+        self.seq = 0
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def _message(self, msg_type, flags, payload, seq):
+        return NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), msg_type, flags, seq, 0) + payload
+
+    def _iter_messages(self):
+        """Читает ответы ядра. Порождает (тип, seq, данные без заголовка)."""
+        while True:
+            data = self.sock.recv(RECV_BUFFER_SIZE)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, msg_type, _, seq, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    break
+                yield msg_type, seq, data[offset + NLMSG_HEADER.size:offset + length]
+                offset += _align(length)
+
+    def request_many(self, msg_type, flags, payloads):
+        """
+        Отправляет запросы с NLM_F_ACK окнами по self.window и собирает подтверждения.
+        Возвращает словарь индекс_запроса -> errno для неуспешных запросов.
+        """
+        errors = {}
+        payloads = list(payloads)
+        for window_start in range(0, len(payloads), self.window):
+            window_payloads = payloads[window_start:window_start + self.window]
+            first_seq = self.seq + 1
+            batch = b"".join(
+                self._message(msg_type, flags | NLM_F_REQUEST | NLM_F_ACK, payload, self._next_seq())
+                for payload in window_payloads
+            )
+            self.sock.sendto(batch, (0, 0))
+            pending = len(window_payloads)
+            for reply_type, seq, data in self._iter_messages():
+                if reply_type != NLMSG_ERROR or not first_seq <= seq <= self.seq:
+                    continue
+                error_code = -NLMSGERR.unpack_from(data)[0]
+                if error_code:
+                    errors[window_start + seq - first_seq] = error_code
+                pending -= 1
+                if not pending:
+                    break
+        return errors
+
+    def request(self, msg_type, flags, payload):
+        """Один запрос с подтверждением. OSError при ошибке."""
+        error_code = self.request_many(msg_type, flags, [payload]).get(0)
+        if error_code:
+            raise OSError(error_code, os.strerror(error_code))
+
+    def dump(self, msg_type, payload):
+        """Запрос с NLM_F_DUMP. Порождает данные каждого сообщения ответа."""
+        seq = self._next_seq()
+        self.sock.sendto(self._message(msg_type, NLM_F_REQUEST | NLM_F_DUMP, payload, seq), (0, 0))
+        for reply_type, reply_seq, data in self._iter_messages():
+            if reply_seq != seq:
+                continue
+            if reply_type == NLMSG_DONE:
+                return
+            if reply_type == NLMSG_ERROR:
+                error_code = -NLMSGERR.unpack_from(data)[0]
+                if error_code:
+                    raise OSError(error_code, os.strerror(error_code))
+                return
+            yield data
+
+    def _address_payload(self, interface_index, ipv6_address, prefixlen, nodad):
+        packed = socket.inet_pton(socket.AF_INET6, ipv6_address)
+        payload = IFADDRMSG.pack(socket.AF_INET6, prefixlen, 0, RT_SCOPE_UNIVERSE, interface_index)
+        payload += _rtattr(IFA_LOCAL, packed) + _rtattr(IFA_ADDRESS, packed)
+        if nodad:
+            payload += _rtattr(IFA_FLAGS, struct.pack("=I", IFA_F_NODAD))
+        return payload
+
+    def add_addresses(self, interface, addresses, nodad=True):
+        """
+        Добавляет адреса [(адрес, длина_префикса), ...] на интерфейс.
+        Возвращает словарь индекс -> errno (EEXIST - адрес уже привязан).
+        """
+        interface_index = get_interface_index(interface)
+        return self.request_many(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, (
+            self._address_payload(interface_index, ipv6_address, prefixlen, nodad)
+            for ipv6_address, prefixlen in addresses
+        ))
+
+    def delete_addresses(self, interface, addresses):
+        """
+        Удаляет адреса [(адрес, длина_префикса), ...] с интерфейса.
+        Возвращает словарь индекс -> errno (EADDRNOTAVAIL - адреса нет).
+        """
+        interface_index = get_interface_index(interface)
+        return self.request_many(RTM_DELADDR, 0, (
+            self._address_payload(interface_index, ipv6_address, prefixlen, False)
+            for ipv6_address, prefixlen in addresses
+        ))
+
+    def probe_ipv6_addresses(self, interface, addresses):
+        """
+        Проверяет адреса [(адрес, длина_префикса), ...] на интерфейсе запросами
+        RTM_GETADDR к конкретному адресу (без дампа всех адресов, root не нужен).
+        Возвращает словарь индекс -> errno (EADDRNOTAVAIL - адреса на интерфейсе нет).
+        """
+        interface_index = get_interface_index(interface)
+        return self.request_many(RTM_GETADDR, 0, (
+            IFADDRMSG.pack(socket.AF_INET6, prefixlen, 0, RT_SCOPE_UNIVERSE, interface_index)
+            + _rtattr(IFA_ADDRESS, socket.inet_pton(socket.AF_INET6, ipv6_address))
+            for ipv6_address, prefixlen in addresses
+        ))
+
+    def get_ipv6_address_prefixes(self, interface=None):
+        """IPv6-адреса на интерфейсе (или на всех интерфейсах): словарь адрес (целое число) -> длина префикса."""
+        interface_index = get_interface_index(interface) if interface else 0
+        addresses = {}
+        for data in self.dump(RTM_GETADDR, IFADDRMSG.pack(socket.AF_INET6, 0, 0, 0, 0)):
+            family, prefixlen, _, index, address = _parse_address_message(data)
+            if family != socket.AF_INET6 or (interface_index and index != interface_index):
+                continue
+            if address is not None:
+                addresses[address] = prefixlen
+        return addresses
+
+    def receive_address_events(self, timeout):
+        """
+        Ждет события адресов (сокет создан с groups=RTMGRP_IPV6_IFADDR) не дольше
+        timeout секунд. Возвращает список (RTM_NEWADDR/RTM_DELADDR, индекс
+        интерфейса, адрес целым числом, длина префикса, флаги); пустой - по таймауту.
+        OSError с errno ENOBUFS означает, что события потеряны (переполнение буфера).
+        """
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(RECV_BUFFER_SIZE)
+        except socket.timeout:
+            return []
+        finally:
+            self.sock.settimeout(None)
+        events = []
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if length < NLMSG_HEADER.size:
+                break
+            if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                family, prefixlen, flags, index, address = _parse_address_message(
+                    data[offset + NLMSG_HEADER.size:offset + length])
+                if family == socket.AF_INET6 and address is not None:
+                    events.append((msg_type, index, address, prefixlen, flags))
+            offset += _align(length)
+        return events
+
+    def get_ipv6_addresses(self, interface=None):
+        """Все IPv6-адреса (целыми числами) на интерфейсе или на всех интерфейсах."""
+        return set(self.get_ipv6_address_prefixes(interface))
+
+    def get_ipv6_default_gateways(self):
+        """Шлюзы IPv6 маршрутов по умолчанию основной таблицы (строки; пустая строка - маршрут без шлюза)."""
+        gateways = []
+        for data in self.dump(RTM_GETROUTE, RTMSG.pack(socket.AF_INET6, 0, 0, 0, 0, 0, 0, 0, 0)):
+            family, dst_len, _, _, table, _, _, route_type, _ = RTMSG.unpack_from(data)
+            attrs = _parse_rtattrs(data[RTMSG.size:])
+            if RTA_TABLE in attrs:
+                table = struct.unpack("=I", attrs[RTA_TABLE])[0]
+            if family != socket.AF_INET6 or dst_len != 0 or table != RT_TABLE_MAIN or route_type != RTN_UNICAST:
+                continue
+            gateway = attrs.get(RTA_GATEWAY)
+            gateways.append(socket.inet_ntop(socket.AF_INET6, gateway) if gateway else "")
+        return gateways
+
+    def add_ipv6_default_route(self, gateway, interface, onlink=True):
+        """Добавляет маршрут по умолчанию через gateway на interface (onlink - шлюз считается доступным напрямую)."""
+        payload = RTMSG.pack(socket.AF_INET6, 0, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT, RT_SCOPE_UNIVERSE,
+                             RTN_UNICAST, RTNH_F_ONLINK if onlink else 0)
+        payload += _rtattr(RTA_GATEWAY, socket.inet_pton(socket.AF_INET6, gateway))
+        payload += _rtattr(RTA_OIF, struct.pack("=I", get_interface_index(interface)))
+        self.request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, payload)
+
+def is_noop_error(action, error_code):
+    """Адрес уже привязан (при добавлении) или уже отсутствует (при удалении) - это не ошибка."""
+    if action == "add":
+        return error_code == errno.EEXIST
+    return error_code in (errno.EADDRNOTAVAIL, errno.ENOENT, errno.ESRCH)
@@ -0,0 +1,165 @@
+import fcntl
+import ipaddress
+import json
+import os
+import re
+from contextlib import contextmanager
+
+from ipv6_allocator import FIRST_PROXY_INCREMENT, get_increment_layout
+from proxy_output import CREDENTIALS_FILENAME, atomic_open
+from range_allocator import count_in_ranges, ranges_from_values
+
+# Файл состояния в директории generated_proxy_configs
+STATE_FILENAME = "proxy_states.json"
+# Рядом с файлом состояния лежит файл блокировки: сам файл состояния при
+# каждой записи подменяется переименованием, поэтому блокировать его нельзя
+LOCK_FILE_SUFFIX = ".lock"
+# Владелец старых адресов проекта после ротации, пока они не отвязаны
+DRAINING_OWNER_SUFFIX = "@draining"
+
+def get_draining_owner(project_name):
+    """Ключ владельца для адресов проекта, ожидающих отвязки после ротации."""
+    return f"{project_name}{DRAINING_OWNER_SUFFIX}"
+
+def load_state(state_file):
+    """
+    Читает состояние из файла JSON. Отсутствующий файл - пустое состояние,
+    поврежденный файл - ошибка ValueError (а не тихий сброс, который привел бы
+    к повторной выдаче уже занятых портов и адресов).
+    """
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(
+                f"Файл состояния {state_file} поврежден: {e}. "
+                f"Исправьте или удалите его вручную."
+            ) from e
+
+def write_state(state_file, state):
+    """Атомарно записывает состояние: временный файл, fsync и переименование."""
+    with atomic_open(state_file) as f:
+        json.dump(state, f, separators=(",", ":"))
+
+@contextmanager
+def _locked(state_file, lock_type):
+    directory = os.path.dirname(state_file) or "."
+    os.makedirs(directory, exist_ok=True)
+    with open(state_file + LOCK_FILE_SUFFIX, "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), lock_type)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def read_state(state_file):
+    """Читает состояние под разделяемой блокировкой (для команд, которые его не меняют)."""
+    with _locked(state_file, fcntl.LOCK_SH):
+        return load_state(state_file)
+
+@contextmanager
+def state_transaction(state_file):
+    """
+    Транзакция над состоянием: эксклюзивная блокировка на все время
+    чтения-изменения-записи, поэтому параллельные запуски генератора
+    выделяют диапазоны по очереди и не теряют чужие изменения.
+    Изменения записываются, только если блок завершился без исключения.
+    """
+    with _locked(state_file, fcntl.LOCK_EX):
+        state = load_state(state_file)
+        yield state
+        write_state(state_file, state)
+
+def collect_legacy_ownership(state, base_output_dir):
+    """
+    Восстанавливает владельцев портов и инкрементов IPv6 для состояния старого
+    формата (latest_port / latest_suffix_increment) по файлам proxy_configs
+    существующих проектов. Диапазоны удаленных проектов остаются свободными.
+    """
+    line_pattern = re.compile(r"proxy_ip:(\S+) proxy_port:(\d+) ipv6:([0-9a-fA-F:]+)/")
+    subnets = {
+        (external_ipv4, subnet_str): ipaddress.IPv6Network(subnet_str, strict=True)
+        for external_ipv4, ipv4_state in state.items()
+        for subnet_str in ipv4_state.get("ipv6_subnets", {})
+    }
+    ports = {}
+    suffixes = {}
+    if not os.path.isdir(base_output_dir):
+        return ports, suffixes
+
+    for project_name in os.listdir(base_output_dir):
+        credentials_path = os.path.join(base_output_dir, project_name, CREDENTIALS_FILENAME)
+        if not os.path.isfile(credentials_path):
+            continue
+        with open(credentials_path, "r") as f:
+            for line in f:
+                match = line_pattern.search(line)
+                if not match:
+                    continue
+                external_ipv4, port, ipv6_address = match.group(1), int(match.group(2)), match.group(3)
+                ports.setdefault(external_ipv4, {}).setdefault(project_name, []).append(port)
+                address_int = int(ipaddress.IPv6Address(ipv6_address))
+                for (subnet_ipv4, subnet_str), network in subnets.items():
+                    if subnet_ipv4 == external_ipv4 and ipaddress.IPv6Address(address_int) in network:
+                        shift, _ = get_increment_layout(network.prefixlen)
+                        increment = (address_int - int(network.network_address)) >> shift
+                        suffixes.setdefault((external_ipv4, subnet_str), {}).setdefault(project_name, []).append(increment)
+    return ports, suffixes
+
+def migrate_legacy_state(state, base_output_dir):
+    """
+    Переводит состояние со счетчиков latest_port / latest_suffix_increment
+    на диапазоны, закрепленные за проектами ("ports" и "suffixes").
+    """
+    if not any("latest_port" in ipv4_state for ipv4_state in state.values()):
+        return state
+    legacy_ports, legacy_suffixes = collect_legacy_ownership(state, base_output_dir)
+    for external_ipv4, ipv4_state in state.items():
+        if "latest_port" not in ipv4_state:
+            continue
+        del ipv4_state["latest_port"]
+        ipv4_state["ports"] = {
+            project_name: ranges_from_values(values)
+            for project_name, values in legacy_ports.get(external_ipv4, {}).items()
+        }
+        for subnet_str, subnet_state in ipv4_state.get("ipv6_subnets", {}).items():
+            subnet_state.pop("latest_suffix_increment", None)
+            subnet_state["suffixes"] = {
+                project_name: ranges_from_values(values)
+                for project_name, values in legacy_suffixes.get((external_ipv4, subnet_str), {}).items()
+            }
+    print("Состояние переведено на диапазоны портов и IPv6-адресов, закрепленные за проектами.")
+    return state
+
+def find_primary_address_owners(state):
+    """
+    Проекты, за которыми закреплен инкремент 0 (основной адрес сервера):
+    прежние версии генератора выдавали его прокси. Адреса после ротации не
+    учитываются - они освобождаются при --finish. Возвращает отсортированный
+    список (подсеть, проект).
+    """
+    owners = set()
+    for ipv4_state in state.values():
+        for subnet_str, subnet_state in ipv4_state.get("ipv6_subnets", {}).items():
+            for owner, runs in subnet_state.get("suffixes", {}).items():
+                if not owner.endswith(DRAINING_OWNER_SUFFIX) and any(start < FIRST_PROXY_INCREMENT for start, _ in runs):
+                    owners.add((subnet_str, owner))
+    return sorted(owners)
+
+def release_project(state, project_name):
+    """
+    Освобождает все порты и инкременты IPv6, закрепленные за проектом
+    (включая адреса, ожидающие отвязки после ротации), на всех внешних IPv4
+    и подсетях. Возвращает (освобождено_портов, освобождено_адресов).
+    """
+    released_ports = 0
+    released_suffixes = 0
+    for ipv4_state in state.values():
+        released_ports += count_in_ranges(ipv4_state.get("ports", {}).pop(project_name, []))
+        for subnet_state in ipv4_state.get("ipv6_subnets", {}).values():
+            subnet_suffixes = subnet_state.get("suffixes", {})
+            released_suffixes += count_in_ranges(subnet_suffixes.pop(project_name, []))
+            released_suffixes += count_in_ranges(subnet_suffixes.pop(get_draining_owner(project_name), []))
+    return released_ports, released_suffixes
@@ -0,0 +1,283 @@
+import argparse
+import os
+import sys
+# Примеры использования:
+# Сравнить текущие значения ядра с профилем проекта:
+# python3 sysctl_profile.py generated_proxy_configs/MyProject/sysctl_3proxy.conf
+#
+# Применить профиль (повторный запуск ничего не меняет):
+# sudo python3 sysctl_profile.py generated_proxy_configs/MyProject/sysctl_3proxy.conf --apply
+
+SYSCTL_PROFILE_FILENAME = "sysctl_3proxy.conf"
+PROC_SYS_DIR = "/proc/sys"
+
+# Ключи, значение которых должно совпадать точно; остальные числовые
+# значения - нижняя граница (профиль не уменьшает то, что уже больше)
+EXACT_SYSCTL_KEYS = {"net.ipv4.tcp_tw_reuse"}
+# Списки портов: значение профиля должно входить в текущее, при применении
+# списки объединяются (у каждого проекта свои порты, настройка ядра общая)
+PORT_LIST_SYSCTL_KEYS = {"net.ipv4.ip_local_reserved_ports"}
+# Ключи, которые профиль только проверяет и никогда не записывает. В файле
+# они закомментированы префиксом, поэтому sysctl -p их тоже не применит
+CHECK_ONLY_SYSCTL_KEYS = {"net.ipv4.ip_local_port_range"}
+CHECK_ONLY_PREFIX = "#check "
+# Статус проверки, при котором значение не меняется, а выводится предупреждение
+LOW_PORTS_STATUS = "мало портов"
+
+# Нижние границы, ниже которых профиль значения не опускает
+MIN_NEIGH_GC_THRESH3 = 8192
+MIN_ROUTE_MAX_SIZE = 65536
+MIN_SOMAXCONN = 4096
+# На старых ядрах somaxconn хранится в 16 битах
+MAX_SOMAXCONN = 65535
+NETDEV_MAX_BACKLOG = 16384
+# Запас fs.file-max для остальных процессов сервера
+FILE_MAX_RESERVE = 1 << 20
+MIN_NR_OPEN = 1 << 20
+
+def _next_power_of_two(value):
+    return 1 << max(0, value - 1).bit_length()
+
+def parse_port_list(value):
+    """Список портов в формате sysctl ("10000-10099,10200") -> отсортированные диапазоны [start, end)."""
+    ranges = []
+    for part in value.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        ranges.append([int(start), int(end or start) + 1])
+    return merge_port_ranges(ranges)
+
+def merge_port_ranges(ranges):
+    """Сортирует и сливает пересекающиеся и соседние диапазоны [start, end)."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def format_port_list(ranges):
+    """Диапазоны [start, end) -> список портов в формате sysctl."""
+    return ",".join(str(start) if end - start == 1 else f"{start}-{end - 1}" for start, end in merge_port_ranges(ranges))
+
+def _port_list_covers(current, recommended):
+    """Все порты recommended входят в current."""
+    current_ranges = parse_port_list(current)
+    return all(
+        any(start >= current_start and end <= current_end for current_start, current_end in current_ranges)
+        for start, end in parse_port_list(recommended)
+    )
+
+def count_ephemeral_ports(port_range, reserved_ports):
+    """
+    Сколько портов ядро может выдать исходящим соединениям: диапазон
+    ip_local_port_range ("32768 60999") без зарезервированных портов.
+    """
+    low, high = map(int, port_range.split())
+    reserved_count = sum(
+        max(0, min(end, high + 1) - max(start, low)) for start, end in parse_port_list(reserved_ports)
+    )
+    return high - low + 1 - reserved_count
+
+def build_sysctl_profile(num_proxies, shard_count, maxconn, limit_nofile, reserved_ports, anyip=False):
+    """
+    Рассчитывает sysctl для проекта: таблица соседей и маршрутов под число
+    привязанных адресов, очередь соединений под maxconn шарда, лимиты файлов
+    под LimitNOFILE всех шардов. reserved_ports - порты проекта в формате
+    sysctl (format_port_list), которые ядро не должно выдавать исходящим
+    соединениям (их слушает 3proxy). ip_local_port_range только проверяется:
+    исходящих портов (диапазон без зарезервированных) должно хватать на
+    maxconn всех шардов.
+    В режиме AnyIP добавляется net.ipv6.ip_nonlocal_bind: адреса прокси не
+    привязаны к интерфейсу, и без него 3proxy не сможет использовать их как -e.
+    Возвращает список (ключ, значение, комментарий).
+    """
+    gc_thresh3 = max(MIN_NEIGH_GC_THRESH3, _next_power_of_two(2 * num_proxies))
+    somaxconn = min(MAX_SOMAXCONN, max(MIN_SOMAXCONN, _next_power_of_two(maxconn)))
+    profile = [
+        ("net.ipv6.neigh.default.gc_thresh1", gc_thresh3 // 4, "Таблица соседей IPv6: один адрес прокси - до двух записей"),
+        ("net.ipv6.neigh.default.gc_thresh2", gc_thresh3 // 2, None),
+        ("net.ipv6.neigh.default.gc_thresh3", gc_thresh3, None),
+        ("net.ipv6.route.max_size", max(MIN_ROUTE_MAX_SIZE, _next_power_of_two(4 * num_proxies)),
+         "Каждый привязанный адрес добавляет локальный маршрут"),
+        ("net.ipv6.route.gc_thresh", max(MIN_ROUTE_MAX_SIZE, _next_power_of_two(4 * num_proxies)), None),
+        ("net.ipv4.tcp_tw_reuse", 1, "Повторное использование TIME_WAIT для исходящих соединений"),
+        ("net.core.somaxconn", somaxconn, "Очереди входящих соединений под maxconn шарда"),
+        ("net.ipv4.tcp_max_syn_backlog", somaxconn, None),
+        ("net.core.netdev_max_backlog", NETDEV_MAX_BACKLOG, None),
+        ("fs.nr_open", max(MIN_NR_OPEN, limit_nofile), "LimitNOFILE шарда не может превышать fs.nr_open"),
+        ("fs.file-max", shard_count * limit_nofile + FILE_MAX_RESERVE, None),
+    ]
+    if reserved_ports:
+        profile.append(("net.ipv4.ip_local_reserved_ports", reserved_ports,
+                        "Исходящие соединения не занимают порты, которые слушает 3proxy проекта"))
+    profile.append(("net.ipv4.ip_local_port_range", maxconn * shard_count,
+                    "Только проверка: исходящих портов (диапазон без зарезервированных) не меньше maxconn всех шардов"))
+    if anyip:
+        profile.append(("net.ipv6.ip_nonlocal_bind", 1, "AnyIP: исходящие адреса прокси не привязаны к интерфейсу"))
+    return profile
+
+def write_sysctl_profile(output_dir, profile, project_name):
+    """Записывает профиль в формате sysctl.d (sysctl_3proxy.conf) и возвращает путь."""
+    profile_path = os.path.join(output_dir, SYSCTL_PROFILE_FILENAME)
+    with open(profile_path, "w") as f:
+        f.write(f"# sysctl для проекта 3proxy {project_name}. Применение и проверка:\n")
+        f.write(f"# sudo python3 sysctl_profile.py {SYSCTL_PROFILE_FILENAME} --apply\n")
+        for key, value, comment in profile:
+            if comment:
+                f.write(f"\n# {comment}\n")
+            f.write(f"{CHECK_ONLY_PREFIX if key in CHECK_ONLY_SYSCTL_KEYS else ''}{key} = {value}\n")
+    return profile_path
+
+def update_reserved_ports(profile_path, reserved_ports):
+    """
+    Заменяет порты проекта в существующем профиле (дозапись прокси добавляет
+    порты, остальные значения профиля не пересчитываются). Из профилей прежних
+    версий убирается строка, задававшая ip_local_port_range; строка его
+    проверки (CHECK_ONLY_PREFIX) остается.
+    """
+    key = "net.ipv4.ip_local_reserved_ports"
+    removed_keys = {key, "net.ipv4.ip_local_port_range"}
+    with open(profile_path, "r") as f:
+        lines = f.readlines()
+    lines = [line for line in lines if line.split("=", 1)[0].strip() not in removed_keys]
+    if reserved_ports:
+        lines.append(f"{key} = {reserved_ports}\n")
+    with open(profile_path, "w") as f:
+        f.writelines(lines)
+
+def read_sysctl_profile(profile_path):
+    """
+    Читает файл в формате sysctl.d. Возвращает список (ключ, значение).
+    Проверяемые ключи читаются только из строк с CHECK_ONLY_PREFIX (строки
+    ip_local_port_range из профилей прежних версий пропускаются).
+    """
+    profile = []
+    with open(profile_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            check_only = line.startswith(CHECK_ONLY_PREFIX)
+            if check_only:
+                line = line[len(CHECK_ONLY_PREFIX):]
+            if not line or line.startswith(("#", ";")) or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            if check_only == (key.strip() in CHECK_ONLY_SYSCTL_KEYS):
+                profile.append((key.strip(), value.strip()))
+    return profile
+
+def _proc_path(key):
+    return os.path.join(PROC_SYS_DIR, *key.split("."))
+
+def is_satisfied(key, current, recommended):
+    """Числовое значение не ниже рекомендованного, остальные (диапазоны, строки) - совпадают."""
+    if key in PORT_LIST_SYSCTL_KEYS:
+        return _port_list_covers(current, recommended)
+    current_parts = current.split()
+    recommended_parts = recommended.split()
+    if key in EXACT_SYSCTL_KEYS or len(recommended_parts) != 1 or not recommended.isdigit():
+        return current_parts == recommended_parts
+    return len(current_parts) == 1 and current.isdigit() and int(current) >= int(recommended)
+
+def _read_sysctl(key):
+    """Текущее значение ключа или None, если его нет в ядре."""
+    try:
+        with open(_proc_path(key), "r") as f:
+            return " ".join(f.read().split())
+    except OSError:
+        return None
+
+def check_ephemeral_ports(current, min_ephemeral, profile):
+    """
+    Проверка ip_local_port_range: исходящих портов с учетом зарезервированных
+    сейчас и портов профиля (они добавятся при применении) не меньше
+    min_ephemeral. Возвращает (текущее для отчета, рекомендованное для отчета, статус).
+    """
+    reserved_ports = ",".join(
+        value for value in (_read_sysctl("net.ipv4.ip_local_reserved_ports"),
+                            dict(profile).get("net.ipv4.ip_local_reserved_ports"))
+        if value
+    )
+    ephemeral_count = count_ephemeral_ports(current, reserved_ports)
+    status = "ok" if ephemeral_count >= int(min_ephemeral) else LOW_PORTS_STATUS
+    return f"{current} ({ephemeral_count} исх.)", f">= {min_ephemeral} исх.", status
+
+def check_sysctl_profile(profile):
+    """
+    Сравнивает профиль с текущими значениями ядра.
+    Возвращает список (ключ, текущее, рекомендованное, статус), где статус -
+    "ok", "изменить", "нет в ядре" или (для проверяемых ключей) LOW_PORTS_STATUS.
+    """
+    results = []
+    for key, recommended in profile:
+        current = _read_sysctl(key)
+        if current is None:
+            results.append((key, None, recommended, "нет в ядре"))
+        elif key in CHECK_ONLY_SYSCTL_KEYS:
+            results.append((key, *check_ephemeral_ports(current, recommended, profile)))
+        else:
+            status = "ok" if is_satisfied(key, current, recommended) else "изменить"
+            results.append((key, current, recommended, status))
+    return results
+
+def warn_low_ephemeral_ports(results):
+    """Выводит предупреждение, если исходящих портов меньше maxconn всех шардов. Возвращает True, если вывел."""
+    low = [(key, current, recommended) for key, current, recommended, status in results if status == LOW_PORTS_STATUS]
+    for key, current, recommended in low:
+        print(f"Предупреждение: {key} = {current}, нужно {recommended}: исходящих портов (диапазон без "
+              f"зарезервированных портов 3proxy) меньше, чем соединений всех шардов. Расширьте ip_local_port_range "
+              f"или сдвиньте его за порты 3proxy.", file=sys.stderr)
+    return bool(low)
+
+def apply_sysctl_profile(profile):
+    """
+    Записывает в /proc/sys только значения, которые не удовлетворяют профилю.
+    Списки портов объединяются с текущими (порты других проектов остаются).
+    Возвращает (изменено, ошибок).
+    """
+    changed_count = 0
+    failed_count = 0
+    for key, current, recommended, status in check_sysctl_profile(profile):
+        if status != "изменить":
+            continue
+        if key in PORT_LIST_SYSCTL_KEYS:
+            recommended = format_port_list(parse_port_list(current) + parse_port_list(recommended))
+        try:
+            with open(_proc_path(key), "w") as f:
+                f.write(recommended)
+            changed_count += 1
+        except OSError as e:
+            print(f"Ошибка: не удалось установить {key} = {recommended}: {e}", file=sys.stderr)
+            failed_count += 1
+    return changed_count, failed_count
+
+def print_sysctl_report(results):
+    key_width = max(len(key) for key, _, _, _ in results)
+    for key, current, recommended, status in results:
+        print(f"{key:<{key_width}}  текущее: {current if current is not None else '-':<14}  "
+              f"рекомендуется: {recommended:<14}  {status}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка и применение sysctl-профиля проекта 3proxy.")
+    parser.add_argument("profile", help=f"Файл профиля ({SYSCTL_PROFILE_FILENAME} в директории проекта).")
+    parser.add_argument("--apply", action="store_true", help="Установить значения, не удовлетворяющие профилю (нужен root).")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.profile):
+        print(f"Ошибка: Файл профиля не найден: {args.profile}", file=sys.stderr)
+        sys.exit(1)
+    profile = read_sysctl_profile(args.profile)
+
+    if args.apply:
+        changed_count, failed_count = apply_sysctl_profile(profile)
+        print(f"sysctl: изменено {changed_count} значений, ошибок {failed_count}.")
+    results = check_sysctl_profile(profile)
+    print_sysctl_report(results)
+    warn_low_ephemeral_ports(results)
+    if any(status == "изменить" for _, _, _, status in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()